@@ -0,0 +1,256 @@
+#
+# SC3020
+# Project 2
+# Batch Conversion
+#
+
+import argparse
+import glob
+import logging
+import math
+import os
+import sys
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from pathlib import Path
+from typing import Optional
+
+from pipesyntax import generate
+from preprocessing import IndexCatalog, Postgres, close_pools, preprocess_plan
+from stream import add_postgres_args, postgres_conn_args
+
+log = logging.getLogger(__name__)
+
+# index catalog snapshot used by conversion worker processes
+_CATALOG = IndexCatalog()
+
+
+def init_worker(catalog: IndexCatalog):
+    """Initialize conversion worker process with the given index catalog snapshot."""
+    global _CATALOG
+    _CATALOG = catalog
+
+
+def convert_plan(plan: dict) -> str:
+    """Preprocess & generate pipesyntax SQL from the given QEP plan in a worker process.
+
+    Args:
+        plan: QEP plan as returned by Postgres.explain().
+    Returns:
+        str: Pipesyntax SQL generated from the plan.
+    """
+    subplans = []
+    return generate(preprocess_plan(plan, _CATALOG, subplans), subplans)
+
+
+def find_sql_files(source: str) -> list[str]:
+    """Find the SQL files in the given directory or matching the given glob pattern.
+
+    Args:
+        source: Directory of '*.sql' files or glob pattern of SQL files.
+    Returns:
+        list[str]: Paths of the SQL files found in sorted order.
+    """
+    pattern = os.path.join(source, "*.sql") if os.path.isdir(source) else source
+    return sorted(glob.glob(pattern, recursive=True))
+
+
+def output_paths(paths: list[str], out_dir: str) -> dict[str, Path]:
+    """Map the given SQL files to output files in the given directory, mirroring
+    their paths relative to the closest directory containing all of them.
+
+    SQL files found recursively in different directories may share a file name,
+    eg. 'a/q1.sql' & 'b/q1.sql': mirroring their directories keeps their output
+    files apart.
+
+    Args:
+        paths: Paths of the SQL files to convert.
+        out_dir: Directory to write the pipesyntax SQL files into.
+    Returns:
+        dict[str, Path]: Output file path by SQL file path.
+    """
+    if len(paths) == 0:
+        return {}
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+    return {p: Path(out_dir, os.path.relpath(os.path.abspath(p), root)) for p in paths}
+
+
+def convert_files(
+    paths: list[str],
+    out_dir: str,
+    db: Postgres,
+    workers: Optional[int] = None,
+    connections: int = 4,
+) -> list[tuple[str, float, Optional[str]]]:
+    """Convert the given SQL files into pipesyntax SQL files in the given directory.
+
+    EXPLAINs the SQL files concurrently over the given no. of connections, handing
+    each plan to a pool of worker processes to preprocess & generate pipesyntax SQL
+    as soon as it is fetched. Each SQL file is converted into a file of the same name
+    in the output directory, under the same subdirectories relative to the other
+    SQL files. See output_paths().
+
+    Args:
+        paths: Paths of the SQL files to convert.
+        out_dir: Directory to write the pipesyntax SQL files into.
+        db: Pooled Postgres DB to EXPLAIN the SQL with, see Postgres.pooled().
+        workers: No. of worker processes, no. of CPUs if not given.
+        connections: No. of SQL files to EXPLAIN concurrently.
+    Returns:
+        list[tuple[str, float, Optional[str]]]: For each SQL file in order: path,
+            seconds taken to convert it & error message if it failed to convert.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    outputs = output_paths(paths, out_dir)
+    # snapshot index catalog for worker processes in one query
+    catalog = db.snapshot_catalog()
+
+    started: dict[str, float] = {}
+    results: dict[str, tuple[float, Optional[str]]] = {}
+
+    def explain(path: str) -> dict:
+        started[path] = time.perf_counter()
+        return db.explain(Path(path).read_text())
+
+    def finish(path: str, error: Optional[str] = None):
+        results[path] = (time.perf_counter() - started[path], error)
+        if error is not None:
+            log.warning(f"Failed to convert {path}: {error}")
+
+    with ThreadPoolExecutor(connections) as explainers, ProcessPoolExecutor(
+        workers, initializer=init_worker, initargs=(catalog,)
+    ) as converters:
+        # path of sql file by future explaining / converting it
+        explaining: dict[Future, str] = {
+            explainers.submit(explain, p): p for p in paths
+        }
+        converting: dict[Future, str] = {}
+        pending = set(explaining)
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in explaining:
+                    path = explaining.pop(future)
+                    try:
+                        plan = future.result()
+                    except Exception as e:
+                        finish(path, str(e))
+                        continue
+                    # convert plan in worker process as soon as it is fetched
+                    converted = converters.submit(convert_plan, plan)
+                    converting[converted] = path
+                    pending.add(converted)
+                    continue
+
+                path = converting.pop(future)
+                try:
+                    sql = future.result()
+                except Exception as e:
+                    finish(path, str(e))
+                    continue
+                outputs[path].parent.mkdir(parents=True, exist_ok=True)
+                outputs[path].write_text(sql)
+                finish(path)
+
+    return [(path, *results[path]) for path in paths]
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Get the p-th percentile of the given values by nearest rank.
+
+    Args:
+        values: Values to get the percentile of.
+        p: Percentile to get from 0 to 100.
+    Returns:
+        float: p-th percentile of the values, 0 if there are no values.
+    """
+    if len(values) == 0:
+        return 0.0
+    ranked = sorted(values)
+    rank = min(max(math.ceil(p / 100 * len(ranked)), 1), len(ranked))
+    return ranked[rank - 1]
+
+
+def summarize(results: list[tuple[str, float, Optional[str]]], elapsed: float) -> str:
+    """Summarize throughput, latency percentiles & failures of converting SQL files.
+
+    Args:
+        results: Results of convert_files().
+        elapsed: Seconds taken to convert all the SQL files.
+    Returns:
+        str: Human readable summary.
+    """
+    latencies = [latency for _, latency, _ in results]
+    failures = [(path, error) for path, _, error in results if error is not None]
+    lines = [
+        f"Converted {len(results) - len(failures)}/{len(results)} queries"
+        f" in {elapsed:.2f}s ({len(results) / max(elapsed, 1e-9):.1f} queries/s)",
+        "Latency (ms): "
+        + " ".join(
+            f"p{p}={percentile(latencies, p) * 1000:.1f}" for p in [50, 90, 99, 100]
+        ),
+    ]
+    if len(failures) > 0:
+        lines.append(f"Failures ({len(failures)}):")
+        lines.extend(f"  {path}: {error}" for path, error in failures)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a batch of SQL files into pipesyntax SQL files."
+    )
+    parser.add_argument(
+        "source", help="Directory of '*.sql' files or glob pattern of SQL files."
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        default="pipesyntax",
+        help="Directory to write a pipesyntax SQL file per SQL file into.",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        help="No. of worker processes, default no. of CPUs.",
+    )
+    parser.add_argument(
+        "-c",
+        "--connections",
+        type=int,
+        default=4,
+        help="No. of pooled connections to EXPLAIN SQL files with.",
+    )
+    add_postgres_args(parser)
+    args = parser.parse_args()
+
+    paths = find_sql_files(args.source)
+    if len(paths) == 0:
+        parser.error(f"No SQL files found in: {args.source}")
+
+    db = Postgres.pooled(
+        min_size=args.connections,
+        max_size=args.connections,
+        **postgres_conn_args(args),
+    )
+    started = time.perf_counter()
+    try:
+        results = convert_files(
+            paths, args.output_dir, db, args.workers, args.connections
+        )
+    finally:
+        close_pools()
+    print(summarize(results, time.perf_counter() - started))
+    if any(error is not None for _, _, error in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
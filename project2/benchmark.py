@@ -0,0 +1,427 @@
+#
+# SC3020
+# Project 2
+# Benchmarks
+#
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from copy import deepcopy
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from pipesyntax import PipeSyntax, generate
+from preprocessing import (
+    DialectTransformer,
+    IndexCatalog,
+    LRUCache,
+    Postgres,
+    preprocess_plan,
+    preprocess_transformers,
+    pushup_aliases,
+    transform,
+)
+from stream import add_postgres_args, postgres_conn_args
+
+# recorded raw plans, index catalog snapshot & baseline timings of the benchmark suite
+BENCHMARK_DIR = Path(__file__).parent / "benchmarks"
+PLANS_PATH = BENCHMARK_DIR / "plans.json"
+CATALOG_PATH = BENCHMARK_DIR / "catalog.json"
+BASELINE_PATH = BENCHMARK_DIR / "baseline.json"
+# stages of conversion timed separately by the benchmark suite
+STAGES = ["transpile", "transform", "pushup", "register", "generate"]
+# stage that recorded plans known not to convert fail on, by plan name: test.json plan
+# lacks projected columns which are required by subplan registration
+KNOWN_FAILURES = {"test.json": "generate"}
+
+
+# shapes of the deep QEP plans benchmarked, see deep_plan()
+SHAPES = ["left", "right", "bushy"]
+
+
+def deep_plan(depth: int, shape: str = "left") -> dict:
+    """Build a QEP plan of depth joins in the given shape:
+    - left: left deep chain of joins nested depth levels deep, joining each table
+        to the join of the tables before it.
+    - right: right deep chain of joins nested depth levels deep, joining each
+        table to the join of the tables after it.
+    - bushy: balanced tree of joins, joining pairs of joins of the tables.
+
+    Mimics the QEP plan of a generated reporting query joining depth + 1 tables.
+
+    Args:
+        depth: No. of join QEP nodes in the QEP plan.
+        shape: Shape of the QEP plan's joins: "left", "right" or "bushy".
+    Returns:
+        dict: Raw QEP plan as returned by Postgres.explain().
+    """
+    if shape not in SHAPES:
+        raise ValueError(f"Unsupported QEP plan shape: {shape}")
+
+    def scan(i: int) -> dict:
+        return {
+            "Node Type": "Seq Scan",
+            "Relation Name": f"t{i}",
+            "Schema": "public",
+            "Alias": f"t{i}",
+            "Total Cost": 1.0,
+            "Output": [f"t{i}.x"],
+            "Filter": f"(t{i}.y > {i})",
+        }
+
+    def join(i: int, outer: dict, inner: dict) -> dict:
+        outer["Parent Relationship"], inner["Parent Relationship"] = "Outer", "Inner"
+        return {
+            "Node Type": "Hash Join",
+            "Join Type": "Inner",
+            "Total Cost": float(i),
+            "Output": inner["Output"],
+            "Hash Cond": f"({outer['Output'][0]} = {inner['Output'][0]})",
+            "Plans": [outer, inner],
+        }
+
+    if shape == "left":
+        plan = scan(0)
+        for i in range(1, depth + 1):
+            plan = join(i, plan, scan(i))
+        return plan
+    if shape == "right":
+        plan = scan(depth)
+        for i in range(depth - 1, -1, -1):
+            plan = join(depth - i, scan(i), plan)
+        return plan
+
+    # join adjacent pairs of subtrees level by level until one tree is left
+    plans, i = [scan(i) for i in range(depth + 1)], 0
+    while len(plans) > 1:
+        paired = []
+        for outer, inner in zip(plans[::2], plans[1::2]):
+            i += 1
+            paired.append(join(i, outer, inner))
+        plans = paired + plans[len(paired) * 2 :]
+    return plans[0]
+
+
+def benchmark_depth(depth: int, shape: str = "left") -> dict[str, float]:
+    """Benchmark preprocessing & generating pipesyntax SQL for a deep QEP plan.
+
+    Args:
+        depth: No. of join QEP nodes in the QEP plan to benchmark.
+        shape: Shape of the QEP plan's joins, see deep_plan().
+    Returns:
+        dict[str, float]: Seconds taken by each stage: "preprocess" & "generate".
+    """
+    plan = deep_plan(depth, shape)
+    started = time.perf_counter()
+    subplans = []
+    plan = preprocess_plan(plan, IndexCatalog({"public": {}}), subplans)
+    preprocessed = time.perf_counter()
+    generate(plan, subplans)
+    generated = time.perf_counter()
+    return {
+        "preprocess": preprocessed - started,
+        "generate": generated - preprocessed,
+    }
+
+
+def record_plans(db: Postgres, query_dir: Path = Path(__file__).parent / "queries"):
+    """Record raw plans of the TPC-H queries & test.json, and an index catalog snapshot
+    from the given Postgres DB for the benchmark suite.
+
+    Args:
+        db: Postgres DB with TPC-H data to EXPLAIN the TPC-H queries with.
+        query_dir: Directory of TPC-H queries named by query no.
+    """
+    plans = {}
+    for path in sorted(query_dir.glob("*.sql"), key=lambda p: int(p.stem)):
+        plans[path.stem] = db.explain(path.read_text())
+    with open(Path(__file__).parent / "test.json") as f:
+        plans["test.json"] = json.load(f)[0]["Plan"]
+
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    with open(PLANS_PATH, "w") as f:
+        json.dump(plans, f, indent=1)
+    with open(CATALOG_PATH, "w") as f:
+        db.snapshot_catalog().save(f)
+
+
+def time_stages(
+    plan: dict, catalog: IndexCatalog, fails_on: Optional[str] = None
+) -> dict[str, float]:
+    """Time each stage of converting the given raw QEP plan into pipesyntax SQL.
+
+    Stages timed are:
+    - transpile: transpiling expressions into pipesyntax dialect with a cold cache.
+    - transform: transforming with the preprocessing transformers, warm cache.
+    - pushup: pushing up aliases.
+    - register: registering subplans, which are only built once referenced.
+    - generate: building the IR of the plan & the subplans it references, then
+      rendering pipesyntax SQL.
+
+    Args:
+        plan: Raw QEP plan to convert.
+        catalog: Index catalog snapshot to look up index key columns.
+        fails_on: Stage the plan is known to fail to convert on, if any.
+    Returns:
+        dict[str, float]: Seconds taken by each stage in order, up to the stage the
+            plan is known to fail on.
+    Raises:
+        Exception: Error raised by a stage other than the stage the plan is known
+            to fail on.
+    """
+    timings = {}
+
+    def timed(stage: str, run: Callable[[], Any]) -> Any:
+        started = time.perf_counter()
+        result = run()
+        timings[stage] = time.perf_counter() - started
+        return result
+
+    cold, plan, subplans = deepcopy(plan), deepcopy(plan), []
+    try:
+        timed(
+            "transpile",
+            lambda: transform(cold, [DialectTransformer(LRUCache(maxsize=8192))]),
+        )
+        timed(
+            "transform",
+            lambda: transform(plan, preprocess_transformers(catalog, subplans)),
+        )
+        timed("pushup", lambda: pushup_aliases(plan))
+        pipesyntax = timed("register", lambda: PipeSyntax(plan, subplans))
+        timed("generate", lambda: pipesyntax.generate(plan, top_level=True))
+    except Exception:
+        # plan known to fail to convert: only report stages before the failed stage
+        if STAGES[len(timings)] != fails_on:
+            raise
+    return timings
+
+
+def benchmark_plans(
+    plans: dict[str, dict], catalog: IndexCatalog, repeat: int = 5
+) -> tuple[dict[str, dict[str, float]], float]:
+    """Benchmark each stage of converting the given raw QEP plans.
+
+    The calibration workload is timed after each run, so that it is timed under
+    the same machine load as the plans, see calibrate().
+
+    Args:
+        plans: Raw QEP plans by name to benchmark.
+        catalog: Index catalog snapshot to look up index key columns.
+        repeat: No. of times to time each plan, taking the fastest time.
+    Returns:
+        tuple[dict[str, dict[str, float]], float]: Fastest seconds taken by each
+            stage by plan name, only including stages up to the stage the plan is
+            known to fail on, see KNOWN_FAILURES, & fastest seconds taken by the
+            calibration workload.
+    """
+    results, calibrations = {}, []
+    for name, plan in plans.items():
+        fails_on = KNOWN_FAILURES.get(name)
+        runs = []
+        for _ in range(repeat):
+            runs.append(time_stages(plan, catalog, fails_on))
+            calibrations.append(calibrate())
+        results[name] = {stage: min(run[stage] for run in runs) for stage in runs[0]}
+    return results, min(calibrations)
+
+
+def total_stages(results: dict[str, dict[str, float]]) -> dict[str, float]:
+    """Total seconds taken by each stage across plans in benchmark_plans() results."""
+    return {
+        stage: sum(timings.get(stage, 0.0) for timings in results.values())
+        for stage in STAGES
+    }
+
+
+def calibrate() -> float:
+    """Time a fixed workload of the dict, string, regex & json operations conversion
+    consists of, independent of the code benchmarked.
+
+    Stage timings are normalized by the calibration time, so that they can be
+    compared against a baseline recorded on a faster or slower machine. Like the
+    stages of a plan, the workload takes about a millisecond.
+
+    Returns:
+        float: Seconds taken by the workload.
+    """
+    nodes = [
+        {
+            "Node Type": "Seq Scan",
+            "Relation Name": f"t{i}",
+            "Output": [f"t{i}.c{j}" for j in range(8)],
+            "Filter": f"((t{i}.c0 > {i}) AND (t{i}.c1 <> 'x{i}'::bpchar))",
+        }
+        for i in range(100)
+    ]
+    pattern = re.compile(r"'([^']*)'::bpchar")
+
+    def workload() -> list[str]:
+        rendered = []
+        for node in json.loads(json.dumps(nodes)):
+            node["Filter"] = pattern.sub(r"CAST('\1' AS STRING)", node["Filter"])
+            node["Output"] = sorted(c.replace(".", "_") for c in node["Output"])
+            rendered.append("\n".join(f"|> {k}: {v}" for k, v in node.items()))
+        return rendered
+
+    started = time.perf_counter()
+    workload()
+    return time.perf_counter() - started
+
+
+def compare_baseline(
+    totals: dict[str, float], baseline: dict[str, float], tolerance: float = 0.25
+) -> list[str]:
+    """Compare total time taken by each stage against the given baseline.
+
+    Args:
+        totals: Total time taken by each stage, see total_stages(), normalized by
+            the calibration time, see calibrate().
+        baseline: Baseline normalized total time taken by each stage.
+        tolerance: Fraction slower than the baseline a stage may be.
+    Returns:
+        list[str]: Stages slower than the baseline by more than the tolerance.
+    """
+    return [
+        stage
+        for stage, seconds in totals.items()
+        if stage in baseline and seconds > baseline[stage] * (1 + tolerance)
+    ]
+
+
+def run_suite(
+    repeat: int, tolerance: float, save_baseline: bool
+) -> Optional[list[str]]:
+    """Run the benchmark suite on the recorded plans, printing a report.
+
+    Args:
+        repeat: No. of times to time each plan, taking the fastest time.
+        tolerance: Fraction slower than the baseline a stage may be.
+        save_baseline: Whether to save the normalized timings as the new baseline.
+    Returns:
+        Stages regressed against the baseline, None if there is no baseline.
+    """
+    with open(PLANS_PATH) as f:
+        plans = json.load(f)
+    with open(CATALOG_PATH) as f:
+        catalog = IndexCatalog.load(f)
+
+    results, calibration = benchmark_plans(plans, catalog, repeat)
+    for name, timings in results.items():
+        if len(timings) < len(STAGES):
+            print(f"Plan {name}: failed on {STAGES[len(timings)]} stage.")
+    totals = total_stages(results)
+    # normalize by calibration time to compare with baselines of other machines
+    normalized = {stage: seconds / calibration for stage, seconds in totals.items()}
+
+    baseline = None
+    if BASELINE_PATH.exists():
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+    regressions = compare_baseline(normalized, baseline or {}, tolerance)
+
+    print(f"calibration: {calibration * 1000:.2f} ms")
+    print(
+        f"{'stage':>10} {'total (ms)':>11} {'normalized':>11}"
+        f" {'baseline':>9} {'ratio':>6}"
+    )
+    for stage, seconds in totals.items():
+        base = None if baseline is None else baseline.get(stage)
+        base_text = "-" if base is None else f"{base:.4f}"
+        ratio = "-" if base is None else f"{normalized[stage] / base:.2f}"
+        flag = " REGRESSED" if stage in regressions else ""
+        print(
+            f"{stage:>10} {seconds * 1000:>11.2f} {normalized[stage]:>11.4f}"
+            f" {base_text:>9} {ratio:>6}{flag}"
+        )
+
+    if save_baseline:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(normalized, f, indent=1)
+    return None if baseline is None else regressions
+
+
+def benchmark_deep(depths: list[int], shapes: list[str] = SHAPES):
+    """Benchmark conversion of deeply nested QEP plans of the given depths &
+    shapes, printing a report."""
+    print(
+        f"{'shape':>6} {'depth':>8} {'preprocess (s)':>15}"
+        f" {'generate (s)':>13} {'us/node':>8}"
+    )
+    for shape in shapes:
+        for depth in depths:
+            timings = benchmark_depth(depth, shape)
+            # each join adds a join & a scan qep node
+            per_node = sum(timings.values()) / (2 * depth + 1) * 1e6
+            print(
+                f"{shape:>6} {depth:>8} {timings['preprocess']:>15.3f}"
+                f" {timings['generate']:>13.3f} {per_node:>8.1f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pipesyntax conversion.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    suite = commands.add_parser(
+        "suite",
+        help="Benchmark stages of converting recorded TPC-H plans against a baseline.",
+    )
+    suite.add_argument(
+        "--repeat", type=int, default=5, help="No. of times to time each plan."
+    )
+    suite.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Fraction slower than the baseline a stage may be before failing.",
+    )
+    suite.add_argument(
+        "--save-baseline", action="store_true", help="Save timings as the baseline."
+    )
+
+    deep = commands.add_parser(
+        "deep", help="Benchmark conversion of deeply nested QEP plans."
+    )
+    deep.add_argument(
+        "--depths",
+        type=int,
+        nargs="+",
+        default=[1000, 2000, 4000, 8000],
+        help="Depths of the QEP plans to benchmark.",
+    )
+    deep.add_argument(
+        "--shapes",
+        nargs="+",
+        choices=SHAPES,
+        default=SHAPES,
+        help="Shapes of the QEP plans' joins to benchmark.",
+    )
+
+    record = commands.add_parser(
+        "record", help="Record plans of the TPC-H queries for the benchmark suite."
+    )
+    add_postgres_args(record)
+    args = parser.parse_args()
+
+    if args.command == "suite":
+        regressions = run_suite(args.repeat, args.tolerance, args.save_baseline)
+        if regressions:
+            print(f"Regressed stages: {', '.join(regressions)}")
+            sys.exit(1)
+    elif args.command == "deep":
+        benchmark_deep(args.depths, args.shapes)
+    elif args.command == "record":
+        db = Postgres(**postgres_conn_args(args))
+        try:
+            record_plans(db)
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -15,14 +15,20 @@ from preprocessing import Postgres
 
 
 @pytest.fixture(scope="module")
-def db() -> Iterable[Postgres]:
+def conn_args() -> dict:
+    """Fixture of the connection arguments of the test Postgres DB"""
+    return {
+        "host": "localhost",
+        "port": 5432,
+        "user": "postgres",
+        "password": os.environ["POSTGRES_PASSWORD"],
+    }
+
+
+@pytest.fixture(scope="module")
+def db(conn_args: dict) -> Iterable[Postgres]:
     with DockerCompose(".", keep_volumes=True, wait=True):
-        yield Postgres(
-            host="localhost",
-            port=5432,
-            user="postgres",
-            password=os.environ["POSTGRES_PASSWORD"],
-        )
+        yield Postgres(**conn_args)
 
 
 @pytest.fixture
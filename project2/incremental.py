@@ -0,0 +1,280 @@
+#
+# SC3020
+# Project 2
+# Incremental Conversion
+#
+
+import hashlib
+import marshal
+import weakref
+from collections import OrderedDict
+from typing import Optional, Union
+
+import timing
+from pipeir import Node
+from pipesyntax import IRCache, generate, is_subplan
+from preprocessing import (
+    IndexCatalog,
+    Postgres,
+    count_parameters,
+    preprocess_transformers,
+    pushup_alias,
+    transform,
+)
+
+
+def hash_subtrees(plan: dict) -> dict[int, bytes]:
+    """Hash the content of each subtree of the given raw QEP plan.
+
+    Subtrees are hashed bottom up from the content of their root QEP node & the
+    hashes of their nested plans, so subtrees hash the same exactly when their
+    content is the same.
+
+    Args:
+        plan: Raw QEP plan as returned by Postgres.explain(), before preprocessing.
+    Returns:
+        dict[int, bytes]: Content hash of the subtree of each QEP node by its id.
+    """
+    hashes: dict[int, bytes] = {}
+    # traverse post-order with an explicit stack to support deeply nested plans
+    stack = [(plan, False)]
+    while len(stack) > 0:
+        node, nested = stack.pop()
+        plans = node.get("Plans", [])
+        if not nested and len(plans) > 0:
+            stack.append((node, True))
+            stack.extend((plan, False) for plan in plans)
+            continue
+        # marshal serializes the json values of raw qep nodes faster than json
+        content = marshal.dumps({k: v for k, v in node.items() if k != "Plans"})
+        digest = hashlib.blake2b(content, digest_size=16)
+        for plan in plans:
+            digest.update(hashes[id(plan)])
+        hashes[id(node)] = digest.digest()
+    return hashes
+
+
+class SubtreeCache(IRCache):
+    """Cache of preprocessed QEP subtrees & the IR generated for them, by the content
+    hash of the raw subtree they were preprocessed from. See hash_subtrees().
+
+    Preprocessing & generating a subtree only depends on its content, so subtrees
+    with the same content can reuse the cached preprocessed subtree & its IR.
+    Least recently used subtrees are evicted over maxsize.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        # preprocessed qep subtrees by content hash in least recently used order
+        self.subtrees: OrderedDict[bytes, dict] = OrderedDict()
+        # ir generated for cached subtrees by content hash
+        self.generated: dict[bytes, Node] = {}
+        # content hash of cached subtrees by id of their root qep node
+        self.keys: dict[int, bytes] = {}
+        # InitPlan & SubPlan qep nodes in cached subtrees in traversal order
+        self.subplans: dict[bytes, list[dict]] = {}
+        # joined text of ir nodes kept while the ir nodes are in use
+        self.memo: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def lookup(self, key: bytes) -> Optional[dict]:
+        """Get the preprocessed subtree with the given content hash, None if not cached.
+        The cached subtree itself is returned, not a copy."""
+        node = self.subtrees.get(key)
+        if node is not None:
+            self.subtrees.move_to_end(key)
+        return node
+
+    def remember(self, key: bytes, node: dict, subplans: list[dict]):
+        """Cache the given preprocessed subtree & the InitPlan & SubPlan QEP nodes in
+        it under the given content hash, evicting least recently used subtrees over
+        maxsize."""
+        if key in self.subtrees:
+            self.forget(key)
+        self.subtrees[key] = node
+        self.keys[id(node)] = key
+        self.subplans[key] = subplans
+        while len(self.subtrees) > self.maxsize:
+            self.forget(next(iter(self.subtrees)))
+
+    def forget(self, key: bytes):
+        """Evict the subtree with the given content hash & its IR."""
+        node = self.subtrees.pop(key)
+        del self.keys[id(node)]
+        del self.subplans[key]
+        self.generated.pop(key, None)
+
+    def get(self, node: dict) -> Optional[Node]:
+        key = self.keys.get(id(node))
+        return None if key is None else self.generated.get(key)
+
+    def put(self, node: dict, ir: Node):
+        key = self.keys.get(id(node))
+        if key is not None:
+            self.generated[key] = ir
+
+
+class IncrementalConverter:
+    """Converts successive query plans, eg. of a query being edited, into pipesyntax
+    SQL, reusing the preprocessed subtrees & IR of previous conversions.
+
+    Only subtrees whose content changed since they were last converted are
+    preprocessed & generated again, so converting the plan of a slightly edited
+    query costs time proportional to the subtrees changed by the edit, besides
+    hashing the plan. Preprocessed subtrees depend on the index key columns looked
+    up in the DB: convert with a new converter when the DB schema changes.
+
+    Preprocessed plans returned share their subtrees with the cache & with the plans
+    of other conversions, and cached IR is looked up by the identity of their QEP
+    nodes, so they are not copied: treat them as read-only. Mutating a returned plan
+    corrupts later conversions; deepcopy it first to edit it.
+    """
+
+    def __init__(
+        self,
+        db: Union[Postgres, IndexCatalog],
+        maxsize: int = 4096,
+        share: bool = False,
+    ):
+        """Create an incremental converter.
+
+        Args:
+            db: Postgres DB or index catalog snapshot to look up index key columns.
+            maxsize: Maximum no. of subtrees cached across conversions.
+            share: Whether to share repeated subtrees & SubPlans as WITH entries.
+                See pipesyntax.PipeSyntax.
+        """
+        self.db = db
+        self.cache = SubtreeCache(maxsize)
+        self.share = share
+
+    def convert(
+        self,
+        sql: str,
+        generic: bool = False,
+        parallel: bool = False,
+        analyze: bool = False,
+        timeout: Optional[float] = None,
+    ) -> tuple[dict, str]:
+        """Plan & convert the given SQL into pipesyntax SQL using the Postgres DB.
+        See Postgres.explain() & convert_plan()."""
+        plan = self.db.explain(sql, generic, parallel, analyze, timeout)  # type: ignore
+        return self.convert_plan(plan, count_parameters(sql) if generic else 0)
+
+    def convert_plan(self, plan: dict, parameters: int = 0) -> tuple[dict, str]:
+        """Preprocess & convert the given raw QEP plan into pipesyntax SQL, reusing
+        the subtrees converted before.
+
+        Args:
+            plan: Raw QEP plan to convert, transformed in place.
+            parameters: No. of parameters of the SQL template the plan is the
+                generic plan of. See preprocessing.preprocess_plan().
+        Returns:
+            tuple[dict, str]: Preprocessed QEP plan, sharing subtrees with the cache
+                so it must not be mutated, & the pipesyntax SQL generated.
+        """
+        subplans: list[dict] = []
+        plan = self.preprocess(plan, parameters, subplans)
+        return plan, self.generate(plan, subplans)
+
+    def generate(self, plan: dict, subplans: Optional[list[dict]] = None) -> str:
+        """Generate pipesyntax SQL from the given plan preprocessed by preprocess(),
+        reusing the IR generated before for unchanged subtrees.
+
+        Args:
+            plan: QEP plan preprocessed by preprocess().
+            subplans: InitPlan & SubPlan QEP nodes registered by preprocess(), if
+                given, to skip searching the plan for them.
+        Returns:
+            str: Pipesyntax SQL generated from the plan.
+        """
+        return generate(plan, subplans, cache=self.cache, share=self.share)
+
+    @timing.timed("incremental.preprocess")
+    def preprocess(
+        self,
+        plan: dict,
+        parameters: int = 0,
+        subplans: Optional[list[dict]] = None,
+    ) -> dict:
+        """Preprocess the given raw QEP plan, substituting subtrees preprocessed
+        before & only transforming the rest. See preprocessing.preprocess_plan().
+
+        Args:
+            plan: Raw QEP plan to preprocess, transformed in place.
+            parameters: No. of parameters of the SQL template the plan is the
+                generic plan of. See preprocessing.preprocess_plan().
+            subplans: If given, list to register the InitPlan & SubPlan QEP nodes of
+                the preprocessed plan into, including those of substituted
+                subtrees, to pass to generate().
+        Returns:
+            dict: Preprocessed QEP plan, possibly the given plan itself or a cached
+                plan. Its subtrees are shared with the cache, so it must not be
+                mutated.
+        """
+        with timing.span("incremental.hash"):
+            hashes = hash_subtrees(plan)
+            if parameters > 0:
+                # subtrees preprocessed with named parameters are cached apart
+                salt = parameters.to_bytes(4, "big")
+                hashes = {key: digest + salt for key, digest in hashes.items()}
+        # preprocessed subtrees already in the plan: a subtree occurring more than
+        # once is only substituted once, as qep nodes are identified by id
+        reused: set[int] = set()
+        # subplans in each substituted subtree by id, as cached when substituted
+        reused_subplans: dict[int, list[dict]] = {}
+
+        def substitute(node: dict) -> Optional[dict]:
+            cached = self.cache.lookup(hashes[id(node)])
+            if cached is None or id(cached) in reused:
+                return None
+            reused.add(id(cached))
+            reused_subplans[id(cached)] = self.cache.subplans[hashes[id(node)]]
+            return cached
+
+        cached = substitute(plan)
+        if cached is not None:
+            if subplans is not None:
+                subplans.extend(reused_subplans[id(cached)])
+            return cached
+        # substitute changed subtrees' unchanged nested plans, preorder
+        changed = []
+        stack = [plan]
+        while len(stack) > 0:
+            node = stack.pop()
+            changed.append(node)
+            if "Plans" in node:
+                node["Plans"] = [substitute(p) or p for p in node["Plans"]]
+                stack.extend(p for p in node["Plans"] if id(p) not in reused)
+
+        transform(
+            plan,
+            preprocess_transformers(self.db, parameters=parameters),
+            leave=pushup_alias,
+            skip=lambda node: id(node) in reused,
+        )
+        # cache changed subtrees still in the preprocessed plan, bottom up so that
+        # larger subtrees are evicted last: qep nodes dropped when transforming,
+        # eg. parallel partial aggregates, are not cached
+        kept = set()
+        stack = [plan]
+        while len(stack) > 0:
+            node = stack.pop()
+            kept.add(id(node))
+            stack.extend(p for p in node.get("Plans", []) if id(p) not in reused)
+        # subplans in each kept subtree in traversal order, from those of its nested
+        # plans: substituted subtrees' subplans are cached with them
+        nested_subplans: dict[int, list[dict]] = {}
+        for node in reversed(changed):
+            if id(node) not in kept:
+                continue
+            found = [node] if is_subplan(node) else []
+            for p in node.get("Plans", []):
+                if id(p) in reused:
+                    found.extend(reused_subplans[id(p)])
+                else:
+                    found.extend(nested_subplans.pop(id(p)))
+            nested_subplans[id(node)] = found
+            self.cache.remember(hashes[id(node)], node, found)
+        if subplans is not None:
+            subplans.extend(nested_subplans[id(plan)])
+        return plan
@@ -1,17 +1,23 @@
 import json
 import os
+import threading
+import time
 import tkinter as tk
+from concurrent.futures import Future, ThreadPoolExecutor
 from tkinter import messagebox, ttk
-from typing import Any, Dict, Union
+from typing import Any, Callable, Dict, Optional, Union
 
-import psycopg
 from dotenv import load_dotenv
 
-import pipesyntax
-from preprocessing import Postgres, preprocess
+import timing
+from incremental import IncrementalConverter
+from preprocessing import Postgres, close_pools
 
 load_dotenv()
 
+# milliseconds between polls of the background task for its result & elapsed time
+POLL_INTERVAL_MS = 100
+
 
 def todo(function: Any) -> Any:
     """Not implemented yet."""
@@ -27,9 +33,20 @@ class GUI:
         self.query_text = None
         self.result_text = None
         self.qep_text = None
-        self.connect = None
-        self.cur = None
-        self.db = None
+        self.db: Union[Postgres, None] = None
+        # converter reusing the subtrees of previous conversions of edited queries
+        self.converter: Union[IncrementalConverter, None] = None
+        self.status_label = None
+        # per stage timings of the last conversion
+        self.timings: Union[timing.Timings, None] = None
+        # worker running connects & conversions off the Tk event loop, one at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # background task running on the worker, its description & start time
+        self.task: Optional[Future] = None
+        self.task_name = ""
+        self.task_started = 0.0
+        # whether the background task was cancelled: its result is discarded
+        self.cancelled = False
 
     def run(self) -> None:
         """Initialize and run the GUI, but no function yet."""
@@ -90,11 +107,21 @@ class GUI:
         sample_query = "SELECT c.c_custkey, c.c_name, c.c_nationkey, n.n_name\nFROM customer c\nJOIN nation n ON c.c_nationkey = n.n_nationkey\nWHERE c.c_acctbal > 1000\nORDER BY c.c_custkey\nLIMIT 10;"
         self.query_text.insert("1.0", sample_query)
 
-        # Convert button
+        # Convert & cancel buttons with progress of the running background task
+        action_frame = ttk.Frame(main_frame)
+        action_frame.grid(row=2, column=0, pady=5)
         self.convert_btn = ttk.Button(
-            main_frame, text="Convert", command=self.convert_query
+            action_frame, text="Convert", command=self.convert_query
+        )
+        self.convert_btn.grid(row=0, column=0, padx=5)
+        self.cancel_btn = ttk.Button(
+            action_frame, text="Cancel", command=self.cancel_task, state=tk.DISABLED
+        )
+        self.cancel_btn.grid(row=0, column=1, padx=5)
+        self.progress_bar = ttk.Progressbar(
+            action_frame, mode="indeterminate", length=200
         )
-        self.convert_btn.grid(row=2, column=0, pady=5)
+        self.progress_bar.grid(row=0, column=2, padx=5)
 
         # output frame
         results_frame = ttk.Frame(main_frame)
@@ -126,6 +153,10 @@ class GUI:
         result_scroll.grid(row=0, column=1, sticky=("ns"))
         self.result_text["yscrollcommand"] = result_scroll.set
 
+        # status bar showing time spent in the slowest stages of the last conversion
+        self.status_label = ttk.Label(main_frame, text="", anchor="w")
+        self.status_label.grid(row=4, column=0, columnspan=2, sticky="we")
+
         # weight
         self.root.columnconfigure(0, weight=1)
         self.root.rowconfigure(0, weight=1)
@@ -135,10 +166,9 @@ class GUI:
         results_frame.rowconfigure(0, weight=1)
 
         def on_closing():
-            if self.connect:
-                if self.cur:
-                    self.cur.close()
-                self.connect.close()
+            self.cancel_task()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            close_pools()
             if self.root:
                 self.root.destroy()
 
@@ -146,59 +176,150 @@ class GUI:
         # Start GUI
         self.root.mainloop()
 
+    def run_task(
+        self,
+        name: str,
+        task: Callable[[], Any],
+        done: Callable[[Any], None],
+        failed: Callable[[Exception], None],
+    ) -> None:
+        """Run the given task on the background worker, keeping the GUI responsive.
+
+        Shows progress & elapsed time while the task runs, then hands its result or
+        error back to the given callbacks on the Tk event loop through root.after.
+
+        Args:
+            name: Description of the task shown while it runs.
+            task: Fn run on the worker thread: must not touch Tk widgets.
+            done: Fn called with the result of the task if it succeeds.
+            failed: Fn called with the error raised by the task if it fails.
+        """
+        if self.task is not None:
+            messagebox.showwarning("Warning", f"{self.task_name} is still running")
+            return
+        self.task = self.executor.submit(task)
+        self.task_name = name
+        self.task_started = time.monotonic()
+        self.cancelled = False
+        self.set_busy(True)
+        self.poll_task(done, failed)
+
+    def poll_task(
+        self, done: Callable[[Any], None], failed: Callable[[Exception], None]
+    ) -> None:
+        """Update the elapsed time of the running background task until it finishes,
+        then hand its result or error to the given callbacks. See run_task()."""
+        if self.task is None or self.root is None:
+            return
+        elapsed = time.monotonic() - self.task_started
+        if not self.task.done():
+            self.set_status(f"{self.task_name}... {elapsed:.1f}s")
+            self.root.after(POLL_INTERVAL_MS, self.poll_task, done, failed)
+            return
+
+        task, self.task = self.task, None
+        self.set_busy(False)
+        if self.cancelled:
+            self.set_status(f"{self.task_name} cancelled after {elapsed:.1f}s")
+            return
+        error = task.exception()
+        if error is not None:
+            self.set_status(f"{self.task_name} failed after {elapsed:.1f}s")
+            failed(error)  # type: ignore
+            return
+        done(task.result())
+
+    def cancel_task(self) -> None:
+        """Cancel the running background task, aborting its running statements on
+        the server side. Its result is discarded once it stops."""
+        if self.task is None or self.cancelled:
+            return
+        self.cancelled = True
+        self.set_status(f"Cancelling {self.task_name.lower()}...")
+        if self.db is not None:
+            # sending the cancel request waits on the network: send off the event loop
+            threading.Thread(target=self.db.cancel, daemon=True).start()
+
+    def set_busy(self, busy: bool) -> None:
+        """Enable the cancel button & show progress only while a task is running."""
+        if self.root is None:
+            return
+        state = tk.DISABLED if busy else tk.NORMAL
+        self.connect_btn["state"] = state
+        self.convert_btn["state"] = state
+        self.cancel_btn["state"] = tk.NORMAL if busy else tk.DISABLED
+        if busy:
+            self.progress_bar.start()
+        else:
+            self.progress_bar.stop()
+
+    def set_status(self, text: str) -> None:
+        """Show the given text in the status bar."""
+        if self.status_label is not None:
+            self.status_label["text"] = text
+
     def connect_db(self) -> None:
-        """Connect to database"""
-        try:
-            para = {
-                "host": (
-                    self.host_entry.get()
-                    if self.host_entry
-                    else os.getenv("DB_HOST", "localhost")
-                ),
-                "dbname": (
-                    self.db_entry.get()
-                    if self.db_entry
-                    else os.getenv("DB_NAME", "postgres")
-                ),
-                "user": (
-                    self.user_entry.get()
-                    if self.user_entry
-                    else os.getenv("DB_USER", "postgres")
-                ),
-                "password": (
-                    self.pwd_entry.get()
-                    if self.pwd_entry
-                    else os.getenv("DB_PASSWORD", "SC3020")
-                ),
-                "port": (
-                    self.port_entry.get()
-                    if self.port_entry
-                    else os.getenv("DB_PORT", 5432)
-                ),
-            }
-            if self.connect:
-                if self.cur:
-                    self.cur.close()
-                self.connect.close()
-            print("connecting")
-            self.connect = psycopg.connect(**para)
-            self.db = para
-            self.cur = self.connect.cursor()
-            # try
-            print("connected")
-            self.cur.execute("SELECT version();")
-            version = self.cur.fetchone()
-            if version is None:
-                messagebox.showinfo("Success", "Connected to PostgreSQL")
-            else:
-                messagebox.showinfo("Success", f"Connected to PostgreSQL\n{version[0]}")
+        """Connect to database on the background worker"""
+        para = {
+            "host": (
+                self.host_entry.get()
+                if self.host_entry
+                else os.getenv("DB_HOST", "localhost")
+            ),
+            "dbname": (
+                self.db_entry.get()
+                if self.db_entry
+                else os.getenv("DB_NAME", "postgres")
+            ),
+            "user": (
+                self.user_entry.get()
+                if self.user_entry
+                else os.getenv("DB_USER", "postgres")
+            ),
+            "password": (
+                self.pwd_entry.get()
+                if self.pwd_entry
+                else os.getenv("DB_PASSWORD", "SC3020")
+            ),
+            "port": (
+                self.port_entry.get() if self.port_entry else os.getenv("DB_PORT", 5432)
+            ),
+        }
+        self.run_task(
+            "Connecting",
+            lambda: self._connect(para),
+            self._show_connected,
+            lambda e: messagebox.showerror(
+                "Error", f"Failed to connect to PostgreSQL\n{str(e)}"
+            ),
+        )
 
-        except psycopg.Error as e:
-            messagebox.showerror("Error", f"Failed to connect to PostgreSQL\n{str(e)}")
+    def _connect(self, para: dict) -> tuple[Postgres, Optional[str]]:
+        """Connect to the database with the given connection args, on the worker.
+
+        Returns:
+            Postgres DB & its version, if fetched.
+        """
+        # borrow connections from the shared pool for all conversions
+        db = Postgres.pooled(**para)
+        with db.connect() as connection:
+            version = connection.execute("SELECT version();").fetchone()
+        return db, None if version is None else version[0]
+
+    def _show_connected(self, connected: tuple[Postgres, Optional[str]]) -> None:
+        self.db, version = connected
+        # converter reuses subtrees converted with the same database only,
+        # sharing repeated subtrees to keep the displayed sql short
+        self.converter = IncrementalConverter(self.db, share=True)
+        self.set_status("Connected")
+        if version is None:
+            messagebox.showinfo("Success", "Connected to PostgreSQL")
+        else:
+            messagebox.showinfo("Success", f"Connected to PostgreSQL\n{version}")
 
     def convert_query(self) -> None:
-        """Convert SQL query to Pipe Syntax"""
-        if not self.connect or not self.cur:
+        """Convert SQL query to Pipe Syntax on the background worker"""
+        if not self.db:
             messagebox.showwarning("Warning", "Please connect to database first")
             return
         if not self.query_text:
@@ -208,56 +329,66 @@ class GUI:
         if not query:
             messagebox.showwarning("Warning", "Please enter a SQL query")
             return
-        try:
-            qep = self._generate_qep(query)
-            if self.qep_text is None:
-                messagebox.showwarning("Warning", "QEP text widget is not initialized")
-                return
-            self.qep_text.delete("1.0", tk.END)
-            self.qep_text.insert("1.0", json.dumps(qep, indent=2))
-            pipe_syntax = self._generate_pipe_syntax(qep)
-            if self.result_text is None:
-                messagebox.showwarning(
-                    "Warning", "Result text widget is not initialized"
-                )
-                return
-            self.result_text.delete("1.0", tk.END)
-            self.result_text.insert("1.0", pipe_syntax)
+        self.run_task(
+            "Converting",
+            lambda: self._convert(query),
+            self._show_conversion,
+            lambda e: messagebox.showerror("Error", f"Conversion failed: {str(e)}"),
+        )
 
-        except Exception as e:
-            messagebox.showerror("Error", f"Conversion failed: {str(e)}")
+    def _convert(self, query: str) -> tuple[Any, str, timing.Timings]:
+        """Convert the given SQL query to Pipe Syntax, on the worker.
+
+        Returns:
+            QEP, Pipe Syntax & timings of the conversion.
+        """
+        with timing.record() as timings:
+            # subplans registered when preprocessing, so generating skips searching
+            subplans: list[dict] = []
+            qep = self._generate_qep(query, subplans)
+            pipe_syntax = self._generate_pipe_syntax(qep, subplans)
+        return qep, pipe_syntax, timings
+
+    def _show_conversion(self, conversion: tuple[Any, str, timing.Timings]) -> None:
+        qep, pipe_syntax, self.timings = conversion
+        self.set_status(f"Converted in {self.timings.summary()}")
+        if self.qep_text is None:
+            messagebox.showwarning("Warning", "QEP text widget is not initialized")
+            return
+        self.qep_text.delete("1.0", tk.END)
+        self.qep_text.insert("1.0", json.dumps(qep, indent=2))
+        if self.result_text is None:
+            messagebox.showwarning("Warning", "Result text widget is not initialized")
+            return
+        self.result_text.delete("1.0", tk.END)
+        self.result_text.insert("1.0", pipe_syntax)
 
-    def _generate_qep(self, query: str) -> Union[Dict[str, Any], str]:
+    def _generate_qep(self, query: str, subplans: list[dict]) -> Dict[str, Any]:
         try:
-            if not self.db:
+            if not self.db or not self.converter:
                 raise Exception("No database connection")
-            db = Postgres(
-                host=self.db["host"],
-                port=self.db["port"],
-                dbname=self.db["dbname"],
-                user=self.db["user"],
-                password=self.db["password"],
+            # only transform subtrees changed since the previous conversion
+            qep_result = self.converter.preprocess(
+                self.db.explain(query), subplans=subplans
             )
-            qep_result = preprocess(query, db)
             if qep_result:
                 return qep_result
             else:
                 raise Exception("No QEP generated")
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to generate QEP\n{str(e)}")
-            return "None"
+            raise Exception(f"Failed to generate QEP\n{str(e)}") from e
 
-    def _generate_pipe_syntax(self, qep: Any) -> str:
+    def _generate_pipe_syntax(self, qep: Any, subplans: list[dict]) -> str:
         try:
-
-            pipe_syntax = pipesyntax.generate(qep)
+            if not self.converter:
+                raise Exception("No database connection")
+            # only generate subtrees changed since the previous conversion
+            pipe_syntax = self.converter.generate(qep, subplans)
             if pipe_syntax is None:
-                messagebox.showerror("Error", "Pipe syntax generation failed \n")
-                pipe_syntax = "Pipe syntax generation failed"
+                raise Exception("Pipe syntax generation failed")
             return f"The output of pipesyntax.main is:\n\n{pipe_syntax}"
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to generate pipe syntax: {str(e)}")
-            return str(e)
+            raise Exception(f"Failed to generate pipe syntax: {str(e)}") from e
 
 
 if __name__ == "__main__":
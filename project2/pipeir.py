@@ -0,0 +1,533 @@
+#
+# SC3020
+# Project 2
+# Pipesyntax Intermediate Representation
+#
+
+import re
+from typing import MutableMapping, Optional, Sequence, Union
+
+import timing
+
+# line boundaries split on by str.splitlines(), captured when splitting
+LINE_BREAK_REGEX = re.compile(r"(\r\n|[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029])")
+
+
+def indent(sql: str, indent: int = 2) -> str:
+    """Indent SQL statement with given indent.
+
+    Args:
+        sql: SQL statement to reindent.
+        indent: Indent level.
+    Returns:
+        Indented SQL statement.
+    """
+    return "\n".join(" " * indent + line for line in sql.splitlines())
+
+
+## Pipe operators
+class Operator:
+    """Pipe operator of a Pipe, eg. 'WHERE' in '|> WHERE ...'."""
+
+    __slots__ = ()
+
+    def __str__(self) -> str:
+        return Renderer().render_operator(self)
+
+
+class From(Operator):
+    """FROM operator reading the given relation under the given alias."""
+
+    __slots__ = ("relation", "alias")
+
+    def __init__(self, relation: str, alias: str):
+        self.relation = relation
+        self.alias = alias
+
+
+class Where(Operator):
+    """WHERE operator filtering rows on all of the given conditions."""
+
+    __slots__ = ("conditions",)
+
+    def __init__(self, conditions: list[str]):
+        self.conditions = conditions
+
+
+class Select(Operator):
+    """SELECT operator projecting the given columns."""
+
+    __slots__ = ("columns",)
+
+    def __init__(self, columns: list[str]):
+        self.columns = columns
+
+
+class Aggregate(Operator):
+    """AGGREGATE operator computing the given aggregates, grouped by the given keys
+    if given."""
+
+    __slots__ = ("aggregates", "group_by")
+
+    def __init__(self, aggregates: list[str], group_by: Optional[list[str]] = None):
+        self.aggregates = aggregates
+        self.group_by = group_by
+
+
+class OrderBy(Operator):
+    """ORDER BY operator sorting on the given keys, in the given direction if given."""
+
+    __slots__ = ("keys", "direction")
+
+    def __init__(self, keys: list[str], direction: Optional[str] = None):
+        self.keys = keys
+        self.direction = direction
+
+
+class Limit(Operator):
+    """LIMIT operator keeping the given no. of rows."""
+
+    __slots__ = ("count",)
+
+    def __init__(self, count: int):
+        self.count = count
+
+
+class Join(Operator):
+    """JOIN operator joining the lhs & rhs pipelines, each under an alias if given."""
+
+    __slots__ = ("clause", "lhs", "rhs", "lhs_alias", "rhs_alias", "condition")
+
+    def __init__(
+        self,
+        clause: str,
+        lhs: "Node",
+        rhs: "Node",
+        lhs_alias: Optional[str] = None,
+        rhs_alias: Optional[str] = None,
+        condition: Optional[str] = None,
+    ):
+        """Create a JOIN operator.
+
+        Args:
+            clause: SQL join clause, eg. 'INNER JOIN', see pipesyntax.join_clause().
+            lhs: Pipeline producing the left hand side rows.
+            rhs: Pipeline producing the right hand side rows.
+            lhs_alias: Alias of the left hand side rows if any.
+            rhs_alias: Alias of the right hand side rows if any.
+            condition: Join condition if any.
+        """
+        self.clause = clause
+        self.lhs = lhs
+        self.rhs = rhs
+        self.lhs_alias = lhs_alias
+        self.rhs_alias = rhs_alias
+        self.condition = condition
+
+
+## Nodes
+class Node:
+    """Node of the pipesyntax IR, rendered into pipesyntax SQL by a Renderer.
+
+    Nodes are empty if they render no SQL. Nodes are immutable once created, so
+    the same node can be reused in the IR of other queries & weakly referenced.
+    """
+
+    __slots__ = ("__weakref__",)
+
+    def __bool__(self) -> bool:
+        return True
+
+    def __str__(self) -> str:
+        return self.render()
+
+    def render(self) -> str:
+        """Render the node into pipesyntax SQL."""
+        return Renderer().render(self)
+
+
+# rendered part of a node: text or nested nodes
+Part = Union[str, Node]
+
+
+class Rope(Node):
+    """SQL text built up from string & nested node parts without copying them.
+
+    Parts are only joined into a single string when rendered, so building SQL text
+    takes time linear in its size regardless of how deeply ropes are nested.
+    Indented ropes render the same as indent() applied on the text of their parts.
+    """
+
+    __slots__ = ("parts", "indent")
+
+    def __init__(self, *parts: Part, indent: int = 0):
+        """Create a rope of the given parts.
+
+        Args:
+            parts: Strings or nodes to join in order.
+            indent: Indent level of the rope's text, not indented if 0.
+        """
+        # skip empty parts so that a rope is empty exactly when it has no parts
+        self.parts: list[Part] = [part for part in parts if part]
+        self.indent = indent
+
+    def __bool__(self) -> bool:
+        return len(self.parts) > 0
+
+
+class Pipe(Node):
+    """Chain of pipe operators applied to the rows of its input pipelines, annotated
+    with the cost of the QEP node it was generated from."""
+
+    __slots__ = ("inputs", "operators", "cost", "annotations")
+
+    def __init__(
+        self,
+        operators: list[Operator],
+        cost: float = 0,
+        inputs: Sequence[Node] = (),
+        annotations: Sequence[str] = (),
+    ):
+        """Create a pipe.
+
+        Args:
+            operators: Pipe operators to chain using the "|>" pipeline operator.
+            cost: Cost of the pipe operators.
+            inputs: Pipelines producing the input rows of the pipe operators.
+            annotations: Comments annotating the pipe with execution stats.
+        """
+        self.operators = operators
+        self.cost = cost
+        # skip empty inputs, eg. bitmap index scans, which have no rows to pipe
+        self.inputs = [node for node in inputs if node]
+        self.annotations = annotations
+
+
+class Passthrough(Node):
+    """Rows of the given pipelines passed through as is, annotated with comments."""
+
+    __slots__ = ("nodes", "annotations")
+
+    def __init__(self, nodes: Sequence[Node] = (), annotations: Sequence[str] = ()):
+        self.nodes = [node for node in nodes if node]
+        self.annotations = annotations
+
+    def __bool__(self) -> bool:
+        return len(self.nodes) > 0 or len(self.annotations) > 0
+
+
+class Subquery(Node):
+    """Pipeline nested in parenthesis, eg. the SQL of an InitPlan or SubPlan."""
+
+    __slots__ = ("body",)
+
+    def __init__(self, body: Node):
+        self.body = body
+
+
+class With(Node):
+    """WITH statement defining the given named subqueries before the body if given."""
+
+    __slots__ = ("entries", "body")
+
+    def __init__(self, entries: list[tuple[str, Node]], body: Optional[Node] = None):
+        self.entries = entries
+        self.body = body
+
+    def __bool__(self) -> bool:
+        return len(self.entries) > 0 or bool(self.body)
+
+
+class SetOperation(Node):
+    """Set operation combining the rows of the given pipelines with the given
+    operator, eg. 'UNION ALL', annotated with its cost."""
+
+    __slots__ = ("operator", "operands", "cost")
+
+    def __init__(self, operator: str, operands: list[Node], cost: float = 0):
+        self.operator = operator
+        self.operands = operands
+        self.cost = cost
+
+
+# max length of text joined into a single string when rendering, longer text is
+# joined as a Rope: bounds the text copied when joining the text of each node,
+# so rendering is linear in the size of the SQL
+ROPE_LEAF_SIZE = 4096
+
+
+class Renderer:
+    """Renders pipesyntax IR into pipesyntax SQL.
+
+    Each node is expanded into text & nested node parts, which are joined bottom up
+    into the node's text: short text is joined into strings, long text into ropes
+    rendered in a single pass at the end. Rendering takes time linear in the size
+    of the SQL & supports arbitrarily deeply nested nodes.
+    Override the render_* & expand_* methods to render alternative formats.
+    """
+
+    def __init__(self, memo: Optional[MutableMapping[Node, Union[str, Rope]]] = None):
+        """Create a renderer.
+
+        Args:
+            memo: If given, joined text of IR nodes by node, filled as nodes are
+                joined & reused when joining the same nodes again, eg. a
+                weakref.WeakKeyDictionary shared across renders of IR reusing nodes.
+        """
+        self.memo = memo
+
+    @timing.timed("pipesyntax.render")
+    def render(self, node: Node) -> str:
+        """Render the given IR node into pipesyntax SQL."""
+        text = self.join(node)
+        return text if isinstance(text, str) else self.render_rope(text)
+
+    def join(self, node: Node) -> Union[str, Rope]:
+        """Join the text of the given IR node bottom up, a Rope if the text is long.
+
+        Joins nested nodes with an explicit stack to support deeply nested nodes.
+        """
+        # stack of (node, its parts & no. of nested nodes in its parts if the nested
+        # nodes were already joined, else None & 0)
+        stack: list[tuple[Node, Optional[list[Part]], int]] = [(node, None, 0)]
+        # text of joined nested nodes pending use by their parent node
+        joined: list[Union[str, Rope]] = []
+        memo = self.memo
+        while len(stack) > 0:
+            current, parts, n_nested = stack.pop()
+            if parts is None:
+                if memo is not None and current in memo:
+                    # reuse text of node joined before
+                    joined.append(memo[current])
+                    continue
+                parts = (
+                    current.parts if isinstance(current, Rope) else self.expand(current)
+                )
+                nested = [part for part in parts if type(part) is not str]
+                if len(nested) > 0:
+                    # join nested nodes first, reversed to join them in order
+                    stack.append((current, parts, len(nested)))
+                    nested.reverse()
+                    stack.extend([(part, None, 0) for part in nested])
+                    continue
+                short = True
+            else:
+                # substitute the joined text of nested nodes in order
+                texts = iter(joined[-n_nested:])
+                del joined[-n_nested:]
+                parts = [part if type(part) is str else next(texts) for part in parts]
+                short = all(type(part) is str for part in parts)
+
+            level = current.indent if isinstance(current, Rope) else 0
+            text = None
+            if short:
+                # join short text into a string
+                text = "".join(parts)  # type: ignore
+                if len(text) > ROPE_LEAF_SIZE:
+                    text = None
+                elif level > 0:
+                    text = indent(text, level)
+            if text is None:
+                text = Rope(*parts, indent=level)
+            if memo is not None and not isinstance(current, Rope):
+                memo[current] = text
+            joined.append(text)
+        return joined[0]
+
+    def render_rope(self, rope: Rope) -> str:
+        """Render the given rope of text parts into a string in a single pass."""
+        out: list[str] = []
+        # indent prefixes of open indented ropes, cumulative & own
+        prefixes: list[tuple[str, str]] = []
+        # no. of open indented ropes that have started writing their prefix
+        started = 0
+        # depth of the indented rope with a line break pending output, 0 if none:
+        # line breaks are only output once more text follows, as indent() drops
+        # the trailing line break of the indented text
+        pending, pending_cr = 0, False
+
+        def flush():
+            nonlocal started, pending
+            if pending > 0:
+                out.append("\n" + prefixes[pending - 1][0])
+                pending = 0
+            # write prefixes of indented ropes that are yet to start
+            for _, own in prefixes[started:]:
+                out.append(own)
+            started = len(prefixes)
+
+        # traverse with an explicit stack to support deeply nested ropes
+        stack: list[Union[Part, None]] = [rope]
+        while len(stack) > 0:
+            part = stack.pop()
+            if part is None:
+                # end of indented rope: drop its trailing line break
+                if pending == len(prefixes):
+                    pending = 0
+                prefixes.pop()
+                started = min(started, len(prefixes))
+                continue
+            if isinstance(part, Rope):
+                if part.indent > 0:
+                    own = " " * part.indent
+                    outer = prefixes[-1][0] if len(prefixes) > 0 else ""
+                    prefixes.append((outer + own, own))
+                    stack.append(None)
+                stack.extend(reversed(part.parts))
+                continue
+
+            # write text, indenting lines in indented ropes
+            depth = len(prefixes)
+            if depth == 0:
+                out.append(part)  # type: ignore
+                continue
+            if pending == depth and pending_cr and part[0] == "\n":  # type: ignore
+                # "\r\n" line break split across parts
+                part, pending_cr = part[1:], False  # type: ignore
+            # lines of text interleaved with the line breaks between them
+            lines = LINE_BREAK_REGEX.split(part)  # type: ignore
+            if len(lines[0]) > 0 or pending > 0 or started < depth:
+                flush()
+                out.append(lines[0])
+            if len(lines) == 1:
+                continue
+            line_break = "\n" + prefixes[-1][0]
+            if len(lines) > 3:
+                # lines followed by line breaks
+                out.append(line_break + line_break.join(lines[2:-2:2]))
+            pending, pending_cr = depth, lines[-2] == "\r"
+            if len(lines[-1]) > 0:
+                out.append(line_break + lines[-1])
+                pending = 0
+        return "".join(out)
+
+    def expand(self, node: Node) -> list[Part]:
+        """Expand the given IR node into its text & nested node parts,
+        dispatching on the type of IR node."""
+        if isinstance(node, Pipe):
+            return self.expand_pipe(node)
+        if isinstance(node, Passthrough):
+            return self.expand_passthrough(node)
+        if isinstance(node, Subquery):
+            return self.expand_subquery(node)
+        if isinstance(node, With):
+            return self.expand_with(node)
+        if isinstance(node, SetOperation):
+            return self.expand_set_operation(node)
+
+        raise ValueError(f"Unsupported IR node: {type(node).__name__}")
+
+    def render_annotations(self, annotations: Sequence[str]) -> str:
+        """Render the given annotations as SQL comments, one per line."""
+        return "".join(f"-- {annotation}\n" for annotation in annotations)
+
+    def expand_pipe(self, pipe: Pipe) -> list[Part]:
+        """Expand pipe into pipesyntax SQL parts in the format:
+        [<inputs>
+        |> ]<OPERATOR 1>
+        |> <OPERATOR 2>
+        ...
+        -- cost: <cost>
+        [-- <annotation>]
+        """
+        # chain inputs with "|>" operator if there are any
+        parts: list[Part] = [*pipe.inputs, "|> "] if len(pipe.inputs) > 0 else []
+        # text rendered since the last nested node part
+        text = ""
+        for i, operator in enumerate(pipe.operators):
+            separator = "\n|> " if i > 0 else ""
+            if isinstance(operator, Join):
+                parts.append(text + separator)
+                parts.extend(self.expand_join(operator))
+                text = ""
+                continue
+            text += separator + self.render_operator(operator)
+        annotations = (
+            self.render_annotations(pipe.annotations) if pipe.annotations else ""
+        )
+        parts.append(f"{text}\n-- cost: {pipe.cost}\n{annotations}")
+        return parts
+
+    def expand_join(self, join: Join) -> list[Part]:
+        """Expand JOIN operator into pipesyntax SQL parts in the format:
+        <lhs>[|> AS `<lhs alias>`]
+        |> <clause> (
+          <rhs>
+          [|> AS `<rhs alias>`]
+        )[ ON <condition>]
+        """
+        lhs_alias = "" if join.lhs_alias is None else f"|> AS `{join.lhs_alias}`"
+        rhs_alias = "" if join.rhs_alias is None else f"|> AS `{join.rhs_alias}`"
+        join_on = "" if join.condition is None else f" ON {join.condition}"
+        return [
+            join.lhs,
+            f"{lhs_alias}\n|> {join.clause} (\n",
+            Rope(join.rhs, rhs_alias, indent=2),
+            f"\n){join_on}",
+        ]
+
+    def render_operator(self, operator: Operator) -> str:
+        """Render the given pipe operator, other than JOIN, into pipesyntax SQL,
+        dispatching on the type of pipe operator."""
+        if isinstance(operator, From):
+            return f"FROM `{operator.relation}` AS `{operator.alias}`"
+        if isinstance(operator, Where):
+            # conditions already have parenthesis around them so precedence is
+            # already preserved when joining them with 'AND'
+            return f"WHERE {' AND '.join(operator.conditions)}"
+        if isinstance(operator, Select):
+            return f"SELECT {', '.join(operator.columns)}"
+        if isinstance(operator, Aggregate):
+            grouping = (
+                ""
+                if operator.group_by is None
+                else f" GROUP BY {', '.join(operator.group_by)}"
+            )
+            return f"AGGREGATE {', '.join(operator.aggregates)}{grouping}"
+        if isinstance(operator, OrderBy):
+            direction = "" if operator.direction is None else f" {operator.direction}"
+            return f"ORDER BY {', '.join(operator.keys)}{direction}"
+        if isinstance(operator, Limit):
+            return f"LIMIT {operator.count}"
+        if isinstance(operator, Join):
+            return Rope(*self.expand_join(operator)).render()
+
+        raise ValueError(f"Unsupported pipe operator: {type(operator).__name__}")
+
+    def expand_passthrough(self, passthrough: Passthrough) -> list[Part]:
+        """Expand passthrough into the pipesyntax SQL of its pipelines, followed by
+        its annotations."""
+        return [*passthrough.nodes, self.render_annotations(passthrough.annotations)]
+
+    def expand_subquery(self, subquery: Subquery) -> list[Part]:
+        """Expand subquery into its body indented in parenthesis."""
+        return ["(\n", Rope(subquery.body, indent=2), "\n)"]
+
+    def expand_with(self, with_: With) -> list[Part]:
+        """Expand WITH statement into pipesyntax SQL parts in the format:
+        [WITH `<name>` AS <subquery>, ...
+        ]<body>
+        """
+        parts: list[Part] = []
+        for i, (name, subquery) in enumerate(with_.entries):
+            parts.extend([f"{'WITH' if i == 0 else ','} `{name}` AS ", subquery])
+        if len(with_.entries) > 0:
+            parts.append("\n")
+        if with_.body is not None:
+            parts.append(with_.body)
+        return parts
+
+    def expand_set_operation(self, set_operation: SetOperation) -> list[Part]:
+        """Expand set operation into its pipelines separated by its operator, eg.:
+        <pipeline 1>
+        UNION ALL
+        <pipeline 2>
+        -- cost: <cost>
+        """
+        parts: list[Part] = []
+        for i, operand in enumerate(set_operation.operands):
+            if i > 0:
+                parts.append(f"\n{set_operation.operator}\n")
+            parts.append(operand)
+        parts.append(f"\n-- cost: {set_operation.cost}\n")
+        return parts
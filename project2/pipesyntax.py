@@ -8,40 +8,60 @@
 # setup logging
 import logging
 import re
+from abc import ABC, abstractmethod
+from typing import Callable, MutableMapping, Optional, Union
+
+import timing
+from pipeir import (
+    Aggregate,
+    From,
+    Join,
+    Limit,
+    Node,
+    OrderBy,
+    Passthrough,
+    Pipe,
+    Renderer,
+    Rope,
+    Select,
+    Subquery,
+    Where,
+    With,
+)
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
 
-def gen_chunk(statements: list[str], cost: float = 0, in_sql: str = "") -> str:
-    """Generate Pipeline SQL from given statements and cost.
+def gen_annotations(node: dict) -> list[str]:
+    """Generate comments annotating parallelism & actual execution stats of QEP node.
 
     Args:
-        statements: List of SQL statements to chain using "|>" pipeline operator.
-        cost: Cost of the SQL statements.
-        in_sql: SQL statement to prepend to the generated SQL chunk.
-    Returns: Pipesyntax SQL in the format:
-        [<in_sql>
-        |> ]<STATEMENT 1>
-        |> <STATEMENT 2>
-        ...
-        -- cost: <cost>
-    """
-    # chain in_sql with "|>" operator if it is not empty
-    in_sql_pipe = "" if len(in_sql) == 0 else f"{in_sql}|> "
-    return in_sql_pipe + "\n|> ".join(statements) + f"\n-- cost: {cost}\n"
-
-
-def indent(sql: str, indent: int = 2) -> str:
-    """Indent SQL statement with given indent.
-
-    Args:
-        sql: SQL statement to reindent.
-        indent: Indent level.
+        node: Preprocessed QEP node.
     Returns:
-        Indented SQL statement.
+        Comments in the format below, each only if the QEP node has the stats:
+        workers: <workers planned>[ (launched: <workers launched>)]
+        actual: rows=<rows> loops=<loops> time=<total time>ms shared hit=<blocks> read=<blocks>
     """
-    return "\n".join(" " * indent + line for line in sql.splitlines())
+    annotations = []
+    if "Workers Planned" in node:
+        launched = (
+            f" (launched: {node['Workers Launched']})"
+            if "Workers Launched" in node
+            else ""
+        )
+        annotations.append(f"workers: {node['Workers Planned']}{launched}")
+    if "Actual Loops" in node:
+        if node["Actual Loops"] == 0:
+            annotations.append("actual: never executed")
+        else:
+            annotations.append(
+                f"actual: rows={node['Actual Rows']} loops={node['Actual Loops']}"
+                f" time={node['Actual Total Time']}ms"
+                f" shared hit={node.get('Shared Hit Blocks', 0)}"
+                f" read={node.get('Shared Read Blocks', 0)}"
+            )
+    return annotations
 
 
 def join_clause(join_type: str) -> str:
@@ -68,99 +88,387 @@ def join_clause(join_type: str) -> str:
     raise ValueError(f"Unsupported join type: {join_type}")
 
 
+def is_subplan(node: dict) -> bool:
+    """Whether the given QEP node is the root of an InitPlan or SubPlan."""
+    return node.get("Parent Relationship") in ["InitPlan", "SubPlan"]
+
+
+# qep node keys read when generating pipesyntax sql from a qep node:
+# subtrees that agree on these keys generate identical sql
+SUBTREE_KEYS = (
+    "Node Type",
+    "Relation Name",
+    "Alias",
+    "CTE Name",
+    "Index Key",
+    "Scan Direction",
+    "Join Type",
+    "Join On",
+    "Total Cost",
+    "Plan Rows",
+    "Output",
+    "Group Key",
+    "Sort Key",
+    "Filters",
+    "Workers Planned",
+    "Workers Launched",
+    "Actual Rows",
+    "Actual Loops",
+    "Actual Total Time",
+    "Shared Hit Blocks",
+    "Shared Read Blocks",
+)
+# qep node keys holding expressions of a qep node
+EXPRESSION_KEYS = ("Output", "Filters", "Join On", "Group Key", "Sort Key")
+# table alias qualifying a column reference in an expression
+QUALIFIER_REGEX = re.compile(r"\b([A-Za-z_]\w*)\.")
+
+
+def expressions(node: dict) -> list[str]:
+    """Expressions of the given QEP node."""
+    exprs = []
+    for key in EXPRESSION_KEYS:
+        if key in node:
+            value = node[key]
+            exprs.extend([value] if isinstance(value, str) else value)
+    return exprs
+
+
+def same_subtree(lhs: dict, rhs: dict) -> bool:
+    """Whether the given QEP subtrees generate identical pipesyntax SQL."""
+    # compare with an explicit stack to support deeply nested plans
+    stack = [(lhs, rhs)]
+    while len(stack) > 0:
+        lhs, rhs = stack.pop()
+        if any(lhs.get(key) != rhs.get(key) for key in SUBTREE_KEYS):
+            return False
+        lhs_plans, rhs_plans = lhs.get("Plans", []), rhs.get("Plans", [])
+        if len(lhs_plans) != len(rhs_plans):
+            return False
+        stack.extend(zip(lhs_plans, rhs_plans))
+    return True
+
+
+def is_self_contained(node: dict) -> bool:
+    """Whether the given QEP subtree can be generated on its own, outside of the
+    query it is part of: it only references tables it reads itself, without
+    parameters, CTEs or nested subplans."""
+    aliases, qualifiers = set(), set()
+    # traverse with an explicit stack to support deeply nested plans
+    stack = [node]
+    while len(stack) > 0:
+        current = stack.pop()
+        if (current is not node and is_subplan(current)) or "CTE Name" in current:
+            return False
+        if "Alias" in current:
+            aliases.add(current["Alias"])
+        for expr in expressions(current):
+            if "$" in expr or "@" in expr or "`(" in expr:
+                # parameters or subplan references
+                return False
+            qualifiers.update(QUALIFIER_REGEX.findall(expr))
+        stack.extend(current.get("Plans", []))
+    return qualifiers <= aliases
+
+
+class IRCache(ABC):
+    """Cache of the IR generated for preprocessed QEP subtrees, reused when generating
+    plans that share subtrees, eg. successive plans of an edited query.
+
+    Only IR of subtrees that generate the same IR wherever they occur is cached:
+    subtrees without shared subtrees or SubPlan references.
+    """
+
+    # if given, joined text of IR nodes reused when rendering, see Renderer
+    memo: Optional[MutableMapping[Node, Union[str, Rope]]] = None
+
+    @abstractmethod
+    def get(self, node: dict) -> Optional[Node]:
+        """Get the cached IR of the subtree of the given QEP node, None if not cached."""
+
+    @abstractmethod
+    def put(self, node: dict, ir: Node):
+        """Cache the given IR generated for the subtree of the given QEP node."""
+
+
 class PipeSyntax:
-    """Pipesyntax SQL Generator generates SQL from QEP."""
+    """Pipesyntax SQL Generator generates SQL from QEP.
+
+    QEP nodes are either raw QEP node dicts or compact plannode.PlanNode.
+    """
+
+    def __init__(
+        self,
+        plan: dict = {},
+        subplans: Optional[list[dict]] = None,
+        cache: Optional[IRCache] = None,
+        share: bool = False,
+    ):
+        """Create a Pipesyntax SQL Generator for the given preprocessed QEP plan.
 
-    def __init__(self, plan: dict = {}):
-        self.subplans = {
+        Args:
+            plan: Preprocessed QEP plan to register subplans of.
+            subplans: InitPlan & SubPlan QEP nodes of the plan in traversal order,
+                as registered by preprocessing.preprocess_plan(). If given, registers
+                the subplans directly instead of searching the plan for them.
+            cache: If given, cache of IR generated for subtrees, reused instead of
+                generating cached subtrees again.
+            share: Whether to generate identical subtrees & SubPlans referenced
+                more than once in the plan once as WITH entries, referenced by
+                name. See find_shared(). Finding them costs an extra pass over the
+                plan, so sharing is opt-in.
+        """
+        # qep nodes of registered subplans by name, by parent relationship
+        self.subplans: dict[str, dict[str, dict]] = {
             "InitPlan": {},
             "SubPlan": {},
         }
-        self.register_subplan(plan)
+        # ir of subplans by name, built on first reference
+        self.subplan_irs: dict[str, Subquery] = {}
+        # sql of subplans by name, rendered on first reference
+        self.subplan_sqls: dict[str, str] = {}
+        # ir generated for qep nodes by id, pending use by their parent qep node
+        self.generated: dict[int, Node] = {}
+        # identical subtrees shared as WITH entries: key of each subtree by id of
+        # its qep node & name of the WITH entry of each key, once generated
+        self.shared_subtrees: dict[int, tuple[int, int]] = {}
+        self.shared_names: dict[tuple[int, int], str] = {}
+        # names of SubPlans shared as WITH entries
+        self.shared_subplans: set[str] = set()
+        # WITH entries of shared subtrees & SubPlans in the order generated
+        self.shared_entries: list[tuple[str, Node]] = []
+        # ids of qep nodes whose subtree has shared subtrees
+        self.sharing: set[int] = set()
+        if share and len(plan) > 0:
+            self.find_shared(plan)
+        self.cache = cache
+        self.renderer = Renderer(None if cache is None else cache.memo)
+        # ids of qep nodes whose subtree ir cannot be cached
+        self.uncached: set[int] = set()
+
+        if subplans is None:
+            self.register_subplan(plan)
+        else:
+            for node in subplans:
+                self.register(node)
 
     def register_subplan(self, node: dict):
         """Register subplans in the given QEP node."""
-        if "Parent Relationship" in node and node["Parent Relationship"] in [
-            "InitPlan",
-            "SubPlan",
-        ]:
-            # recursively generate inner sql of subplan
+        # traverse preorder with an explicit stack to support deeply nested plans
+        stack = [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            if is_subplan(node):
+                self.register(node)
+
+            if "Plans" in node:
+                # reversed to pop nested plans in order
+                stack.extend(reversed(node["Plans"]))
+
+    @timing.timed("pipesyntax.find_shared")
+    def find_shared(self, plan: dict):
+        """Find subtrees & SubPlans of the given QEP plan to share as WITH entries.
+
+        Identical subtrees are found by fingerprinting subtrees bottom up &
+        comparing subtrees with the same fingerprint. Subtrees are only shared if
+        they appear more than once, outside other shared subtrees, & are rooted at
+        an aliased QEP node that can be referenced by its alias. SubPlans are only
+        shared if referenced more than once. Both are only shared if they are
+        self-contained, see is_self_contained(), so correlated subtrees remain
+        inline.
+        """
+        # collect qep nodes preorder with an explicit stack: reversed, nested plans
+        # come before the qep nodes they are nested in
+        nodes, subplans = [], {}
+        stack = [plan]
+        while len(stack) > 0:
+            node = stack.pop()
+            nodes.append(node)
+            if "Plans" in node:
+                stack.extend(node["Plans"])
+            if node.get("Parent Relationship") == "SubPlan":
+                subplans[node["Subplan Name"]] = node
+
+        # fingerprint subtrees bottom up, noting fingerprints seen more than once
+        fingerprints: dict[int, int] = {}
+        seen, repeated = set(), set()
+        for node in reversed(nodes):
+            fingerprint = hash(
+                (
+                    node.get("Node Type"),
+                    node.get("Alias"),
+                    node.get("Total Cost"),
+                    node.get("Plan Rows"),
+                    (
+                        tuple([fingerprints[id(p)] for p in node["Plans"]])
+                        if "Plans" in node
+                        else ()
+                    ),
+                )
+            )
+            fingerprints[id(node)] = fingerprint
+            if fingerprint in seen:
+                repeated.add(fingerprint)
+            seen.add(fingerprint)
+
+        if len(subplans) > 0:
+            self.find_shared_subplans(nodes, subplans)
+        if len(repeated) == 0:
+            return
+
+        # occurrences of identical subtrees by key: fingerprint & index of the
+        # subtree among different subtrees with the same fingerprint
+        occurrences: dict[tuple[int, int], list[dict]] = {}
+        distinct: dict[int, list[dict]] = {}
+        contained: dict[tuple[int, int], bool] = {}
+        # traverse preorder, skipping the nested plans of repeated shared subtrees
+        # as they are only generated once
+        stack = [plan]
+        while len(stack) > 0:
+            node = stack.pop()
+            fingerprint = fingerprints[id(node)]
+            if fingerprint in repeated and "Alias" in node and not is_subplan(node):
+                subtrees = distinct.setdefault(fingerprint, [])
+                index = next(
+                    (i for i, s in enumerate(subtrees) if same_subtree(s, node)),
+                    len(subtrees),
+                )
+                if index == len(subtrees):
+                    subtrees.append(node)
+                key = (fingerprint, index)
+                occurrences.setdefault(key, []).append(node)
+                if len(occurrences[key]) > 1:
+                    if key not in contained:
+                        contained[key] = is_self_contained(node)
+                    if contained[key]:
+                        continue
+            stack.extend(reversed(node.get("Plans", [])))
+
+        for key, subtrees in occurrences.items():
+            if contained.get(key, False):
+                self.shared_subtrees.update((id(node), key) for node in subtrees)
+        # note subtrees with shared subtrees, generated depending on the whole plan
+        for node in reversed(nodes):
+            if id(node) in self.shared_subtrees or any(
+                id(p) in self.sharing for p in node.get("Plans", [])
+            ):
+                self.sharing.add(id(node))
+
+    def find_shared_subplans(self, nodes: list[dict], subplans: dict[str, dict]):
+        """Find SubPlans referenced more than once to share as WITH entries.
+
+        Args:
+            nodes: QEP nodes of the plan to count SubPlan references in.
+            subplans: SubPlan QEP nodes in the plan by name.
+        """
+        references: dict[str, int] = {}
+        for node in nodes:
+            for expr in expressions(node):
+                if "SubPlan" in expr:
+                    for name in self.QUOTED_SUBPLAN_REGEX.findall(expr):
+                        references[name] = references.get(name, 0) + 1
+
+        self.shared_subplans = {
+            name
+            for name, count in references.items()
+            if count > 1 and name in subplans and is_self_contained(subplans[name])
+        }
+
+    def register(self, node: dict):
+        """Register the given InitPlan or SubPlan QEP node as a subplan, to be built
+        on first reference. See subplan_ir()."""
+        self.subplans[node["Parent Relationship"]][node["Subplan Name"]] = node
+
+    @timing.timed("pipesyntax.subplan_ir")
+    def subplan_ir(self, name: str) -> Subquery:
+        """Get the IR of the registered subplan with the given name, building it on
+        first use, so subplans that are never referenced are never built."""
+        if name not in self.subplan_irs:
+            node = self.subplans["InitPlan"].get(name) or self.subplans["SubPlan"][name]
+            # recursively generate inner ir of subplan
             inner = node.copy()
             inner["Parent Relationship"] = ""
-            inner_sql = gen_chunk(
-                [f"{self.generate(inner)}|> {self.gen_projection(inner)}"],
-                inner["Total Cost"],
+            self.subplan_irs[name] = Subquery(
+                Pipe(
+                    [self.gen_projection(inner)],
+                    inner["Total Cost"],
+                    inputs=[self.build(inner)],
+                )
             )
-            self.subplans[node["Parent Relationship"]][
-                node["Subplan Name"]
-            ] = f"(\n{indent(inner_sql)}\n)"
-
-        if "Plans" in node:
-            for i, plan in enumerate(node["Plans"]):
-                self.register_subplan(plan)
+        return self.subplan_irs[name]
 
     QUOTED_SUBPLAN_REGEX = re.compile(r"`\((SubPlan \d+)\)`")
 
-    def resolve_subplan(self, expr: str) -> str:
-        """Resolve subplan references in the given expression."""
-
-        if match := re.search(self.QUOTED_SUBPLAN_REGEX, expr):
-            subplan_name = match[1]
-            # resolve subplan references to the actual sql
-            if subplan_name in self.subplans["SubPlan"]:
-                return re.sub(
-                    self.QUOTED_SUBPLAN_REGEX,
-                    self.subplans["SubPlan"][subplan_name],
-                    expr,
-                )
-            log.warning(f"Subplan {subplan_name} not found")
-
-        return expr
+    def subplan_sql(self, name: str) -> Optional[str]:
+        """Get the SQL of the registered SubPlan with the given name, building &
+        rendering it on first use. None if no such SubPlan is registered."""
+        if name not in self.subplan_sqls:
+            if name not in self.subplans["SubPlan"]:
+                return None
+            self.subplan_sqls[name] = self.renderer.render(self.subplan_ir(name))
+        return self.subplan_sqls[name]
+
+    def share_subplan(self, name: str) -> str:
+        """Generate reference to the WITH entry of the given shared SubPlan, adding
+        the SubPlan's IR as the WITH entry on first reference."""
+        if not any(entry == name for entry, _ in self.shared_entries):
+            # build first: the subplan's shared subtrees are added before it
+            subquery = self.subplan_ir(name)
+            self.shared_entries.append((name, subquery))
+        return f"(FROM `{name}`)"
 
-    def gen_projection(self, node: dict) -> str:
-        """Generate projection as SELECT statement from QEP node."""
+    def resolve_subplan(self, expr: str) -> str:
+        """Resolve all subplan references in the given expression in a single pass."""
+
+        def resolve(match: re.Match) -> str:
+            if match[1] in self.shared_subplans:
+                # reference shared subplan by name
+                return self.share_subplan(match[1])
+            # resolve subplan reference to the actual sql
+            sql = self.subplan_sql(match[1])
+            if sql is None:
+                log.warning(f"Subplan {match[1]} not found")
+                return match[0]
+            return sql
+
+        # substitute with a function so sql is not processed for backslash escapes
+        return self.QUOTED_SUBPLAN_REGEX.sub(resolve, expr)
+
+    def gen_projection(self, node: dict) -> Select:
+        """Generate projection as SELECT operator from QEP node."""
         # resolve subplan references in projected columns
-        columns = [self.resolve_subplan(c) for c in node["Output"]]
-        return f"SELECT {', '.join(columns)}"
+        return Select([self.resolve_subplan(c) for c in node["Output"]])
 
-    def gen_filters(self, node: dict) -> list[str]:
-        """Generate filters from QEP node as WHERE statements
+    def gen_filters(self, node: dict) -> list[Where]:
+        """Generate filters from QEP node as WHERE operators
 
         Args:
             node: Preprocessed QEP node.
         Returns:
-            List of WHERE statements generated from the filters.
+            List of WHERE operators generated from the filters.
         """
         if "Filters" not in node:
             return []
-        filters = [self.resolve_subplan(f) for f in node["Filters"]]
-        # filters already have parenthesis around them so precedence is already preserved
-        # when joining them with 'AND'
-        return [f"WHERE {' AND '.join(filters)}"]
+        return [Where([self.resolve_subplan(f) for f in node["Filters"]])]
 
-    def gen_scan(self, node: dict) -> str:
-        """Generate SQL statements from given scan QEP node.
+    def gen_scan(self, node: dict) -> Node:
+        """Generate pipe from given scan QEP node.
 
         Args:
             node: Preprocessed scan QEP node.
         Returns:
-            Generated SQL statement with cost.
+            Generated pipe with cost.
         """
 
         if node["Node Type"] == "Bitmap Index Scan":
             # bitmap index scans only reduces rows for a bitmap heap scan
             # which will recheck the filter condition on actual rows
             # we can safely ignore when generating functionally equivalent pipeline sql
-            return ""
-
-        # recursively generate sql in nested plans
-        in_sql = "".join(self.gen_nested(node))
+            return Passthrough()
 
-        # generate statements for scan
-        statements = (
-            [
-                f"FROM `{node['Relation Name']}` AS `{node['Alias']}`",
-            ]
+        # generate operators for scan
+        operators = (
+            [From(node["Relation Name"], node["Alias"])]
             + self.gen_filters(node)
             + [self.gen_projection(node)]
         )
@@ -169,23 +477,23 @@ class PipeSyntax:
             # index scans read rows in the order of the index
             # reflect this by adding an ORDER BY
             direction = "ASC" if node["Scan Direction"] == "Forward" else "DESC"
-            statements.append(f"ORDER BY {', '.join(node['Index Key'])} {direction}")
-        return gen_chunk(statements, node["Total Cost"], in_sql)
+            operators.append(OrderBy(node["Index Key"], direction))
+        # recursively generate ir in nested plans as inputs
+        return Pipe(
+            operators,
+            node["Total Cost"],
+            inputs=self.gen_nested(node),
+            annotations=gen_annotations(node),
+        )
 
-    def gen_aggregate(self, node: dict) -> str:
-        """Generate SQL statements from given aggregate QEP node.
+    def gen_aggregate(self, node: dict) -> Node:
+        """Generate pipe from given aggregate QEP node.
 
         Args:
             node: Preprocessed aggregate QEP node.
         Returns:
-            Generated SQL statements with cost.
+            Generated pipe with cost.
         """
-        # recursively generate sql in nested plans
-        in_sql = "".join(self.gen_nested(node))
-
-        grouping = (
-            f" GROUP BY {', '.join(node['Group Key'])}" if "Group Key" in node else ""
-        )
         # qep lists grouping keys first but aggregate expects only aggregation expressions
         group_keys = set()
         if "Group Key" in node:
@@ -197,154 +505,301 @@ class PipeSyntax:
 
         # skip the grouping keys when building aggregates
         aggregates = [o for o in node["Output"] if o not in group_keys]
-        statements = [
-            f"AGGREGATE {', '.join(aggregates)}{grouping}"
+        operators = [
+            Aggregate(aggregates, node.get("Group Key"))
             # filters needed to implement to 'HAVING' filter on aggregation
         ] + self.gen_filters(node)
-        return gen_chunk(statements, node["Total Cost"], in_sql)
+        # recursively generate ir in nested plans as inputs
+        return Pipe(
+            operators,
+            node["Total Cost"],
+            inputs=self.gen_nested(node),
+            annotations=gen_annotations(node),
+        )
 
-    def gen_orderby(self, node: dict) -> str:
-        """Generate SQL statements from given sort QEP node.
+    def gen_orderby(self, node: dict) -> Node:
+        """Generate pipe from given sort QEP node.
 
         Args:
             node: Preprocessed orderby QEP node.
         Returns:
-            Generated SQL statements with cost.
+            Generated pipe with cost.
         """
-        # recursively generate sql in nested plans
-        in_sql = "".join(self.gen_nested(node))
-        statements = self.gen_filters(node) + [
+        operators = self.gen_filters(node) + [
             self.gen_projection(node),
-            f"ORDER BY {', '.join(node['Sort Key'])}",
+            OrderBy(node["Sort Key"]),
         ]
+        # recursively generate ir in nested plans as inputs
+        return Pipe(
+            operators,
+            node["Total Cost"],
+            inputs=self.gen_nested(node),
+            annotations=gen_annotations(node),
+        )
 
-        return gen_chunk(statements, node["Total Cost"], in_sql)
-
-    def gen_limit(self, node: dict) -> str:
-        """Generate SQL statements from given limit QEP node.
+    def gen_limit(self, node: dict) -> Node:
+        """Generate pipe from given limit QEP node.
 
         Args:
             node: Preprocessed limit QEP node.
         Returns:
-            Generated SQL statements with cost.
+            Generated pipe with cost.
         """
-        # recursively generate sql in nested plans
-        in_sql = "".join(self.gen_nested(node))
-
-        statements = [
-            f"LIMIT {node['Plan Rows']}",
+        operators = [
+            Limit(node["Plan Rows"]),
             self.gen_projection(node),
         ]
-        return gen_chunk(
-            statements,
+        # recursively generate ir in nested plans as inputs
+        return Pipe(
+            operators,
             node["Total Cost"],
-            in_sql,
+            inputs=self.gen_nested(node),
+            annotations=gen_annotations(node),
         )
 
-    def gen_join(self, node: dict) -> str:
-        """Generate SQL statements from given join QEP node.
+    def gen_join(self, node: dict) -> Node:
+        """Generate pipe from given join QEP node.
 
         Args:
             node: Preprocessed join QEP node.
         Returns:
-            Generated SQL statements with cost.
+            Generated pipe with cost.
         """
 
-        # recursively generate sql in nested plans
+        # recursively generate ir in nested plans
         operands = self.gen_nested(node)
         if len(operands) < 2:
             raise ValueError(f"Expected >= 2 operands, got: {len(operands)}")
         if len(operands) > 2:
             logging.warning(f"Ignoring {len(operands)-2} operands, assuming Subplan.")
 
-        lhs_sql, rhs_sql = operands[0], operands[1]
-
-        # fetch aliases from child plans
-        def alias(n):
-            return f"|> AS `{n['Alias']}`" if "Alias" in n else ""
-
-        lhs_alias = alias(node["Plans"][0])
-        rhs_alias = alias(node["Plans"][1])
-
-        # generate join statement
-        join_on = (
-            f" ON {self.resolve_subplan(node['Join On'])}" if "Join On" in node else ""
+        # generate join operator, fetching aliases from child plans
+        join = Join(
+            join_clause(node["Join Type"]),
+            operands[0],
+            operands[1],
+            lhs_alias=node["Plans"][0].get("Alias"),
+            rhs_alias=node["Plans"][1].get("Alias"),
+            condition=(
+                self.resolve_subplan(node["Join On"]) if "Join On" in node else None
+            ),
         )
 
-        join_sql = f"""{lhs_sql + lhs_alias}
-|> {join_clause(node['Join Type'])} (
-{indent(rhs_sql+rhs_alias)}
-){join_on}"""
+        operators = [join] + self.gen_filters(node) + [self.gen_projection(node)]
+        return Pipe(operators, node["Total Cost"], annotations=gen_annotations(node))
 
-        statements = [join_sql] + self.gen_filters(node) + [self.gen_projection(node)]
-        return gen_chunk(statements, node["Total Cost"])
+    def gen_gather(self, node: dict) -> Node:
+        """Generate IR from given gather QEP node.
 
-    def gen_initplans(self) -> str:
-        """Generate registered initplans as a single WITH SQL statement"""
-        initplans = self.subplans["InitPlan"]
-        if len(initplans) == 0:
-            return ""
+        Gather nodes collect the rows produced by parallel workers executing the
+        nested plans, which does not change the rows: only annotate the workers planned.
 
-        initplan_sqls = [f"`{name}` AS {sql}" for name, sql in initplans.items()]
-        return f"WITH {', '.join(initplan_sqls)}\n"
+        Args:
+            node: Preprocessed gather QEP node.
+        Returns:
+            Generated IR of the nested plans annotated with workers planned.
+        """
+        return Passthrough(self.gen_nested(node), gen_annotations(node))
+
+    @timing.timed("pipesyntax.gen_initplans")
+    def gen_initplans(self, body: Optional[Node] = None) -> With:
+        """Generate registered initplans as a single WITH statement before the
+        given body if given, after the shared subtrees & SubPlans generated."""
+        # build initplans first, as building them may generate shared subtrees
+        initplans = [
+            (name, self.subplan_ir(name)) for name in self.subplans["InitPlan"]
+        ]
+        return With(self.shared_entries + initplans, body)
 
+    def gen_shared(self, node: dict, ir: Optional[Node] = None) -> Node:
+        """Generate reference to the WITH entry of the given shared subtree,
+        adding the given IR of the subtree as the WITH entry if not yet added.
+
+        Args:
+            node: Preprocessed QEP node at the root of a shared subtree.
+            ir: Generated IR of the subtree, if the subtree is not yet generated.
+        Returns:
+            Pipe reading the rows of the subtree from its WITH entry.
+        """
+        key = self.shared_subtrees[id(node)]
+        if key not in self.shared_names:
+            name = f"Subtree {len(self.shared_names) + 1}"
+            self.shared_names[key] = name
+            self.shared_entries.append((name, Subquery(ir)))  # type: ignore
+        return Pipe([From(self.shared_names[key], node["Alias"])], node["Total Cost"])
+
+    @timing.timed("pipesyntax.generate")
     def generate(self, node: dict, top_level: bool = False) -> str:
         """Generate pipesyntax SQL statements from given preprocessed QEP node.
+
+        Builds the IR of the QEP node, rendering it into a string once at the end.
+
         Args:
             node: Preprocessed query execution plan node.
             top_level: Whether the node is a top level node.
         Returns:
             Pipesyntax SQL statements generated from the QEP node.
         """
-        if "Parent Relationship" in node and node["Parent Relationship"] in [
-            "InitPlan",
-            "SubPlan",
-        ]:
+        if top_level:
+            # include initplans in the top level qep node sql
+            return self.renderer.render(self.gen_initplans(self.build(node)))
+        return self.renderer.render(self.build(node))
+
+    @timing.timed("pipesyntax.build")
+    def build(self, node: dict) -> Node:
+        """Build pipesyntax IR from given preprocessed QEP node, to be rendered once
+        all IR is built. See generate().
+
+        Generates nested plans bottom up with an explicit stack, so that
+        arbitrarily deep plans can be generated.
+
+        Args:
+            node: Preprocessed query execution plan node.
+        Returns:
+            Pipesyntax IR generated from the QEP node.
+        """
+        # stack of (qep node, whether its nested plans were generated)
+        stack = [(node, False)]
+        while len(stack) > 0:
+            current, nested = stack.pop()
+            shared = id(current) in self.shared_subtrees
+            if shared and self.shared_subtrees[id(current)] in self.shared_names:
+                # identical subtree already generated: reference its WITH entry
+                self.generated[id(current)] = self.gen_shared(current)
+                continue
+            if (
+                not nested
+                and self.cache is not None
+                and id(current) not in self.sharing
+            ):
+                ir = self.cache.get(current)
+                if ir is not None:
+                    # subtree generated before: reuse its cached ir
+                    self.generated[id(current)] = ir
+                    continue
+            if nested or is_subplan(current) or "Plans" not in current:
+                # nested plans already generated: generate qep node
+                ir = self.gen_node(current)
+                self.generated[id(current)] = (
+                    self.gen_shared(current, ir) if shared else ir
+                )
+                if self.cache is not None:
+                    self.cache_subtree(current, ir)
+                continue
+            stack.append((current, True))
+            # reversed to generate nested plans in order
+            stack.extend((plan, False) for plan in reversed(current["Plans"]))
+
+        return self.generated.pop(id(node))
+
+    def cache_subtree(self, node: dict, ir: Node):
+        """Cache the given IR generated for the subtree of the given QEP node,
+        unless it has shared subtrees or resolves SubPlan references, which are
+        generated depending on the rest of the plan.
+        """
+        if (
+            id(node) in self.sharing
+            or any(id(plan) in self.uncached for plan in node.get("Plans", []))
+            or any("`(" in expr for expr in expressions(node))
+        ):
+            self.uncached.add(id(node))
+            return
+        self.cache.put(node, ir)  # type: ignore
+
+    def gen_node(self, node: dict) -> Node:
+        """Generate pipesyntax IR from given preprocessed QEP node,
+        dispatching on the type of QEP node.
+
+        The gen_* method generating the QEP node is timed as a span here, once per
+        QEP node, instead of timing each nested gen_* call.
+
+        Args:
+            node: Preprocessed query execution plan node.
+        Returns:
+            Pipesyntax IR generated from the QEP node.
+        """
+        if is_subplan(node):
             # skip already registered subplans
             log.warning("Skipping node.", node)
-            return ""
+            return Passthrough()
 
-        if top_level:
-            # include initplans in the top level qep node sql
-            return self.gen_initplans() + self.generate(node)
+        gen = self.node_generator(node)
+        timings = timing.current()
+        if timings is None:
+            return gen(node)
+        with timings.span(f"pipesyntax.{gen.__name__}"):
+            return gen(node)
 
+    def node_generator(self, node: dict) -> Callable[[dict], Node]:
+        """Get the gen_* method generating the given preprocessed QEP node."""
         if "Relation Name" in node:
-            return self.gen_scan(node)
+            return self.gen_scan
         if node["Node Type"] in ["HashAggregate", "Aggregate", "Group"]:
-            return self.gen_aggregate(node)
+            return self.gen_aggregate
         if "Sort Key" in node:
-            return self.gen_orderby(node)
+            return self.gen_orderby
         if "Join Type" in node:
-            return self.gen_join(node)
+            return self.gen_join
         if node["Node Type"] == "Limit":
-            return self.gen_limit(node)
+            return self.gen_limit
+        if node["Node Type"] in ["Gather", "Gather Merge"]:
+            return self.gen_gather
+        return self.gen_unknown
+
+    def gen_unknown(self, node: dict) -> Node:
+        """Generate IR from given QEP node of unknown type.
 
-        # unknown qep node: ignore node and generate from nested qep nodes
+        Ignores the node & generates from its nested QEP nodes, keeping its actual
+        execution stats, eg. of a Hash or Materialize.
+
+        Args:
+            node: Preprocessed QEP node.
+        Returns:
+            Generated IR of the nested plans annotated with the node's stats.
+        """
         log.warning(f"Ignoring node: {node['Node Type']}")
-        return "".join(self.gen_nested(node))
+        return Passthrough(self.gen_nested(node), gen_annotations(node))
 
-    def gen_nested(self, node: dict) -> list[str]:
-        """Generate SQL statements from nested plans in gven QEP node.
+    def gen_nested(self, node: dict) -> list[Node]:
+        """Generate IR from nested plans in gven QEP node.
         Args:
             node: Preprocessed QEP node.
         Returns:
-            List of Generated SQL statements.
+            List of Generated IR nodes.
         """
         if "Plans" not in node:
             return []
 
-        return [self.generate(plan) for plan in node["Plans"]]
+        # use ir of nested plans already generated by build() if any
+        return [
+            (
+                self.generated.pop(id(plan))
+                if id(plan) in self.generated
+                else self.build(plan)
+            )
+            for plan in node["Plans"]
+        ]
 
 
-def generate(plan: dict) -> str:
+def generate(
+    plan: dict,
+    subplans: Optional[list[dict]] = None,
+    cache: Optional[IRCache] = None,
+    share: bool = False,
+) -> str:
     """Generate pipesyntax SQL from given preprocesed QEP plan.
 
     Traverses the plan preorder generating pipesyntax sql.
 
     Args:
         plan : Query execution plan
+        subplans: InitPlan & SubPlan QEP nodes registered by preprocessing the plan.
+            See PipeSyntax.
+        cache: Cache of IR generated for subtrees to reuse. See PipeSyntax.
+        share: Whether to share repeated subtrees & SubPlans as WITH entries.
+            See PipeSyntax.
     Returns:
         str: Pipesyntax SQL generated from the plan
     """
 
-    return PipeSyntax(plan).generate(plan, top_level=True)
+    return PipeSyntax(plan, subplans, cache, share).generate(plan, top_level=True)
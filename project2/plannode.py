@@ -0,0 +1,202 @@
+#
+# SC3020
+# Project 2
+# Compact QEP Plan Node
+#
+
+import json
+import sys
+from collections.abc import MutableMapping
+from operator import attrgetter
+from typing import Any, Iterator, Mapping, Optional, Union
+
+# qep node keys read when preprocessing & generating pipesyntax sql from qep plans,
+# including keys added by preprocessing: other EXPLAIN keys are dropped when decoding
+PLAN_NODE_KEYS = (
+    "Node Type",
+    "Parent Relationship",
+    "Subplan Name",
+    "CTE Name",
+    "Relation Name",
+    "Schema",
+    "Alias",
+    "Index Name",
+    "Index Key",
+    "Scan Direction",
+    "Join Type",
+    "Join On",
+    "Partial Mode",
+    "Total Cost",
+    "Plan Rows",
+    "Output",
+    "Group Key",
+    "Sort Key",
+    "Filter",
+    "Join Filter",
+    "Hash Cond",
+    "Index Cond",
+    "Merge Cond",
+    "Recheck Cond",
+    "Filters",
+    "Workers Planned",
+    "Workers Launched",
+    "Actual Rows",
+    "Actual Loops",
+    "Actual Total Time",
+    "Shared Hit Blocks",
+    "Shared Read Blocks",
+    "Plans",
+)
+# attribute slot of each qep node key
+PLAN_NODE_SLOTS = {key: key.lower().replace(" ", "_") for key in PLAN_NODE_KEYS}
+get_slots = attrgetter(*PLAN_NODE_SLOTS.values())
+# value of the slots of qep node keys missing from the qep node
+MISSING = object()
+
+
+class PlanNode(MutableMapping):
+    """Compact QEP plan node that only holds the QEP node keys in PLAN_NODE_KEYS.
+
+    Stores QEP node keys in attribute slots instead of a dict, with nested plans
+    in a tuple. Behaves like the raw QEP node dict, so it can be passed anywhere
+    a QEP node dict is accepted, eg. Transformers & PipeSyntax.
+    Setting QEP node keys not in PLAN_NODE_KEYS raises KeyError.
+    """
+
+    __slots__ = tuple(PLAN_NODE_SLOTS.values())
+
+    def __init__(self, fields: Mapping[str, Any] = {}):
+        for slot in self.__slots__:
+            setattr(self, slot, MISSING)
+        for key, value in fields.items():
+            self[key] = value
+
+    def __getitem__(self, key: str) -> Any:
+        value = getattr(self, PLAN_NODE_SLOTS[key])
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        if key not in PLAN_NODE_SLOTS:
+            raise KeyError(f"Unsupported QEP node key: {key}")
+        if key == "Plans":
+            value = tuple(value)
+        setattr(self, PLAN_NODE_SLOTS[key], value)
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        setattr(self, PLAN_NODE_SLOTS[key], MISSING)
+
+    def __contains__(self, key: object) -> bool:
+        slot = PLAN_NODE_SLOTS.get(key)  # type: ignore
+        return slot is not None and getattr(self, slot) is not MISSING
+
+    def __iter__(self) -> Iterator[str]:
+        # fetch all slots at once instead of checking each slot for a value
+        return (
+            key
+            for key, value in zip(PLAN_NODE_KEYS, get_slots(self))
+            if value is not MISSING
+        )
+
+    def get(self, key: str, default: Any = None) -> Any:
+        slot = PLAN_NODE_SLOTS.get(key)
+        value = MISSING if slot is None else getattr(self, slot)
+        return default if value is MISSING else value
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"PlanNode({dict(self.items())})"
+
+    def copy(self) -> "PlanNode":
+        """Shallow copy the QEP plan node."""
+        return PlanNode(self)
+
+    def to_dict(self) -> dict:
+        """Convert the QEP plan node & its nested plans into QEP node dicts."""
+        plan = dict(self.items())
+        # convert nested plans with an explicit stack to support deeply nested plans
+        stack = [plan]
+        while len(stack) > 0:
+            node = stack.pop()
+            if "Plans" in node:
+                node["Plans"] = [dict(child.items()) for child in node["Plans"]]
+                stack.extend(node["Plans"])
+        return plan
+
+
+def intern_value(value: Any) -> Any:
+    """Intern the given QEP node value if it is a string or a list of strings,
+    so identical expressions repeated across QEP nodes share the same string."""
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        return [sys.intern(v) if isinstance(v, str) else v for v in value]
+    return value
+
+
+def decode_node(node: Mapping[str, Any]) -> Union[PlanNode, Mapping[str, Any]]:
+    """Decode the given raw QEP node dict into a PlanNode.
+
+    Drops keys not in PLAN_NODE_KEYS & interns expression strings.
+    Nested plans are expected to be decoded already.
+    Usable as a json object_hook, which passes through non QEP node dicts as is.
+
+    Args:
+        node: Raw QEP node dict as parsed from EXPLAIN FORMAT JSON output.
+    Returns:
+        Decoded PlanNode, or the given dict as is if it is not a QEP node.
+    """
+    if "Node Type" not in node:
+        return node
+    plan_node = PlanNode()
+    for key, value in node.items():
+        if key in PLAN_NODE_SLOTS:
+            plan_node[key] = intern_value(value)
+    return plan_node
+
+
+def decode_plan(plan: Mapping[str, Any]) -> PlanNode:
+    """Decode the given raw QEP plan into PlanNodes.
+
+    Args:
+        plan: Raw QEP plan, eg. as returned by Postgres.explain().
+    Returns:
+        PlanNode: Root of the decoded QEP plan.
+    """
+    # decode nested plans before their parents with an explicit stack
+    # to support deeply nested plans
+    decoded: dict[int, PlanNode] = {}
+    stack: list[tuple[Mapping[str, Any], bool]] = [(plan, False)]
+    while len(stack) > 0:
+        node, nested = stack.pop()
+        if nested or "Plans" not in node:
+            fields = dict(node)
+            if "Plans" in node:
+                fields["Plans"] = [decoded.pop(id(child)) for child in node["Plans"]]
+            decoded[id(node)] = decode_node(fields)  # type: ignore
+            continue
+        stack.append((node, True))
+        stack.extend((child, False) for child in node["Plans"])
+    return decoded[id(plan)]
+
+
+def loads_plan(text: str) -> Optional[PlanNode]:
+    """Parse the QEP plan from the given EXPLAIN FORMAT JSON output into PlanNodes,
+    decoding QEP nodes as they are parsed.
+
+    Args:
+        text: EXPLAIN FORMAT JSON output: a list of, or a single, {"Plan": ...} object.
+    Returns:
+        Root PlanNode of the first QEP plan in the output, None if there is none.
+    """
+    document = json.loads(text, object_hook=decode_node)
+    documents = document if isinstance(document, list) else [document]
+    for document in documents:
+        if "Plan" in document:
+            return document["Plan"]
+    return None
@@ -4,70 +4,778 @@
 # QEP Preprocessing
 #
 
+import asyncio
+import json
 import re
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Callable, Iterable, Optional
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Hashable, Iterable, Iterator, Optional, TextIO, Union
 
 import psycopg
 import sqlglot
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
 
+import timing
 
 ## Postgres integration
-class Postgres:
-    """Postgres DB facade."""
+# connection pools shared by all Postgres facades, keyed by connection info & sizing
+_POOLS: dict[tuple, ConnectionPool] = {}
+_POOLS_LOCK = threading.Lock()
 
-    def __init__(self, **conn_args) -> None:
-        self.connection = psycopg.connect(**conn_args)
 
-    def explain(self, sql: str) -> dict:
-        """Fetch the query plan of the given sql statement."""
-        # fetch query plan by executing 'EXPLAIN'
-        with self.connection.transaction():
-            # disable parallel query planning to simplify plan retrieved
-            self.connection.execute("SET max_parallel_workers_per_gather = 0;")
-            # fetch verbose plan to include projected columns
-            cursor = self.connection.execute("""EXPLAIN (VERBOSE, FORMAT JSON)""" + sql)  # type: ignore
-            result = cursor.fetchone()
+def shared_pool(
+    min_size: int = 1,
+    max_size: int = 4,
+    max_idle: float = 300.0,
+    timeout: float = 30.0,
+    **conn_args,
+) -> ConnectionPool:
+    """Get the connection pool shared by callers connecting with the given conn args
+    & pool sizing, so callers asking for a differently sized pool get their own pool.
+
+    Creates the pool on first use & waits for its first connections to be established,
+    so that connection errors surface to the caller instead of on first borrow.
+
+    Args:
+        min_size: Minimum no. of connections kept open by the pool.
+        max_size: Maximum no. of connections the pool can grow to.
+        max_idle: Seconds an idle connection above min_size is kept before it is closed.
+        timeout: Seconds to wait for a connection before giving up.
+        conn_args: Connection arguments passed to psycopg.
+
+    Returns:
+        ConnectionPool: Shared connection pool for the given connection args.
+    """
+    conninfo = make_conninfo(**conn_args)
+    key = (conninfo, min_size, max_size, max_idle, timeout)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None or pool.closed:
+            pool = ConnectionPool(
+                conninfo,
+                min_size=min_size,
+                max_size=max_size,
+                max_idle=max_idle,
+                timeout=timeout,
+                # health check connections before lending them out
+                check=ConnectionPool.check_connection,
+                open=True,
+            )
+            try:
+                pool.wait(timeout)
+            except Exception:
+                pool.close()
+                raise
+            _POOLS[key] = pool
+    return pool
+
+
+def close_pools():
+    """Close all shared connection pools."""
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.close()
+        _POOLS.clear()
+
+
+class LRUCache:
+    """Thread-safe least recently used cache with a size limit & time to live.
+
+    Attributes:
+        maxsize: Maximum no. of entries kept before evicting the least recently used.
+        ttl: Seconds an entry is kept before it expires, or None to never expire.
+        hits: No. of lookups that found an entry.
+        misses: No. of lookups that found no entry.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # cached values with their insertion time in least recently used order
+        self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Get the cached value of the given key or None if not cached / expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (
+                self.ttl is None or time.monotonic() - entry[0] < self.ttl
+            ):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                # drop expired entry
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value: Any):
+        """Cache the given value under the given key, evicting entries over maxsize."""
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all cached entries."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        """Get cache statistics: hits, misses, hit rate & no. of cached entries."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+                "size": len(self.entries),
+            }
+
+
+# sql string literals / quoted identifiers & runs of whitespace / comments:
+# E'...' strings with backslash escapes & $tag$...$tag$ dollar quoted strings
+# are matched before plain quotes, so their content is also left untouched
+SQL_NORMALIZE_REGEX = re.compile(
+    r"(?P<quoted>(?<![\w$])[eE]'(?:[^'\\]|\\.|'')*'"
+    r"|(?<![\w$])\$(?P<tag>(?:[A-Za-z_]\w*)?)\$.*?\$(?P=tag)\$"
+    r"|'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")"
+    r"|(?P<space>(?:\s+|--[^\n]*|/\*.*?\*/)+)",
+    re.DOTALL,
+)
+
+
+def normalize_sql(sql: str) -> str:
+    """Normalize the given SQL by removing comments & collapsing whitespace.
+
+    Quoted string literals & identifiers are left untouched, including E'...'
+    strings with backslash escapes & dollar quoted strings, so SQL differing only
+    in the content of literals normalizes differently.
+
+    Args:
+        sql: SQL statement to normalize.
+    Returns:
+        str: Normalized SQL statement.
+    """
+
+    def rewrite(m: re.Match) -> str:
+        if m.group("quoted") is not None:
+            return m.group("quoted")
+        return " "
+
+    return re.sub(SQL_NORMALIZE_REGEX, rewrite, sql).strip().rstrip(";").strip()
+
+
+class IndexCatalog:
+    """Snapshot of the key columns of indexes in the DB catalog.
+
+    Attributes:
+        keys: Index key columns in index key order by index name by schema name.
+        version: Version of the DB catalog the snapshot was taken at.
+    """
+
+    def __init__(
+        self, keys: Optional[dict[str, dict[str, list[str]]]] = None, version: str = ""
+    ):
+        self.keys = {} if keys is None else keys
+        self.version = version
+
+    def get_index_key(self, index: str, schema: str = "public") -> list[str]:
+        """Get the key columns of the given index in the given schema.
+
+        Args:
+            index: Index name
+            schema: Schema name
+
+        Returns:
+            list[str]: List of index key column names in index key order,
+                empty if the index does not exist in the snapshotted schema.
+        Raises:
+            KeyError: If the schema is not in the snapshot.
+        """
+        return self.keys[schema].get(index, [])
+
+    def save(self, file: TextIO):
+        """Save the snapshot into the given file as compact JSON.
+
+        Args:
+            file: File to save the snapshot into.
+        """
+        snapshot = {"version": self.version, "keys": self.keys}
+        json.dump(snapshot, file, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, file: TextIO) -> "IndexCatalog":
+        """Load the snapshot saved by save() from the given file.
+
+        Args:
+            file: File to load the snapshot from.
+        Returns:
+            IndexCatalog: Loaded index catalog snapshot.
+        """
+        snapshot = json.load(file)
+        return cls(snapshot["keys"], snapshot.get("version", ""))
+
+
+class BasePostgres:
+    """Connection independent state shared by the sync & async Postgres DB facades.
+
+    Query plans are cached by normalized SQL, planner settings & catalog / statistics
+    version, so plans are refetched when any of these change.
+    """
+
+    def __init__(self, plan_cache: Optional[LRUCache] = None) -> None:
+        self.plan_cache = (
+            LRUCache(maxsize=256, ttl=3600.0) if plan_cache is None else plan_cache
+        )
+        # snapshot of index key columns, invalidated when DDL changes the catalog
+        self.catalog = IndexCatalog()
+        self.catalog_lock = threading.Lock()
+
+    def validate_catalog(self, version: str):
+        """Invalidate the index catalog snapshot if DDL has changed the catalog version."""
+        with self.catalog_lock:
+            if self.catalog.version != version:
+                self.catalog = IndexCatalog(version=version)
+
+    def update_catalog(self, rows: Iterable[tuple[str, str, str]], schemas: list[str]):
+        """Update the index catalog snapshot with the given index key rows.
+
+        Args:
+            rows: Rows of (schema, index, column) in index key order.
+            schemas: Names of the schemas the rows were loaded for.
+        Returns:
+            IndexCatalog: Index catalog snapshot, updated with the given schemas.
+        """
+        keys: dict[str, dict[str, list[str]]] = {s: {} for s in schemas}
+        for schema, index, column in rows:
+            keys[schema].setdefault(index, []).append(column)
+
+        with self.catalog_lock:
+            self.catalog.keys.update(keys)
+            return self.catalog
+
+    def plan_key(
+        self, sql: str, state: tuple[str, str, str], generic: bool = False
+    ) -> tuple:
+        """Get the plan cache key of the given SQL & planner state, and whether the
+        generic plan of the SQL is cached."""
+        return (normalize_sql(sql), *state, generic)
+
+
+class Postgres(BasePostgres):
+    """Postgres DB facade.
+
+    Either holds a single dedicated connection or borrows connections from a pool.
+    """
+
+    def __init__(
+        self,
+        pool: Optional[ConnectionPool] = None,
+        plan_cache: Optional[LRUCache] = None,
+        **conn_args,
+    ) -> None:
+        super().__init__(plan_cache)
+        self.pool = pool
+        self.connection = None if pool is not None else psycopg.connect(**conn_args)
+        # connections in use, whose running statements can be cancelled
+        self.active: set[psycopg.Connection] = set()
+        self.active_lock = threading.Lock()
+
+    @classmethod
+    def pooled(
+        cls,
+        min_size: int = 1,
+        max_size: int = 4,
+        max_idle: float = 300.0,
+        **conn_args,
+    ) -> "Postgres":
+        """Create a Postgres facade that borrows connections from the pool shared by
+        facades with the same connection args & pool sizing. See shared_pool().
+
+        Args:
+            min_size: Minimum no. of connections kept open by the pool.
+            max_size: Maximum no. of connections the pool can grow to.
+            max_idle: Seconds an idle connection above min_size is kept before it is closed.
+            conn_args: Connection arguments passed to psycopg.
+        """
+        return cls(
+            pool=shared_pool(
+                min_size=min_size, max_size=max_size, max_idle=max_idle, **conn_args
+            )
+        )
+
+    @contextmanager
+    def connect(self) -> Iterator[psycopg.Connection]:
+        """Borrow a connection, from the pool in pooled mode, for the duration of the context."""
+        if self.pool is None:
+            with self.track(self.connection):  # type: ignore
+                yield self.connection  # type: ignore
+            return
+        with self.pool.connection() as connection, self.track(connection):
+            yield connection
+
+    @contextmanager
+    def track(self, connection: psycopg.Connection) -> Iterator[None]:
+        """Track the given connection as in use for the duration of the context,
+        so that statements running on it can be cancelled. See cancel()."""
+        with self.active_lock:
+            self.active.add(connection)
+        try:
+            yield
+        finally:
+            with self.active_lock:
+                self.active.discard(connection)
+
+    def cancel(self, timeout: float = 5.0):
+        """Cancel the statements running on the connections in use, eg. a slow
+        EXPLAIN, on the server side. Safe to call from any thread: cancelled
+        statements raise psycopg.errors.QueryCanceled in the threads running them.
+
+        Args:
+            timeout: Seconds to wait for the server to receive each cancel request.
+        """
+        with self.active_lock:
+            connections = list(self.active)
+        for connection in connections:
+            connection.cancel_safe(timeout=timeout)
+
+    def close(self):
+        """Close the dedicated connection. Shared pools are left open for other callers."""
+        if self.connection is not None:
+            self.connection.close()
+
+    @timing.timed("postgres.explain")
+    def explain(
+        self,
+        sql: str,
+        generic: bool = False,
+        parallel: bool = False,
+        analyze: bool = False,
+        timeout: Optional[float] = None,
+    ) -> dict:
+        """Fetch the query plan of the given sql statement.
+
+        Query plans are served from the plan cache if the planner settings &
+        catalog / statistics version are unchanged since the plan was cached.
+
+        Args:
+            sql: SQL statement to fetch the query plan of.
+            generic: Whether to fetch the generic plan of a SQL statement template
+                with '$1', '$2', ... parameter placeholders, that serves all bindings
+                of its parameters.
+            parallel: Whether to keep parallel query planning, which is disabled
+                by default to simplify the plan retrieved.
+            analyze: Whether to execute the SQL statement to include actual rows,
+                loops, timings & buffer usage in the query plan. The statement is
+                executed in a transaction that is always rolled back.
+                Analyzed plans are never cached.
+            timeout: Seconds to wait for the SQL statement to execute before
+                cancelling it when analyzing, or None to wait indefinitely.
+        Returns:
+            dict: Query plan of the SQL statement.
+        """
+        if analyze and generic:
+            raise ValueError("Generic plans of SQL templates cannot be analyzed.")
+
+        # roll back any changes made by executing the sql statement when analyzing
+        with self.connect() as connection, connection.transaction(
+            force_rollback=analyze
+        ):
+            if not parallel:
+                # disable parallel query planning to simplify plan retrieved
+                connection.execute("SET LOCAL max_parallel_workers_per_gather = 0;")
+            if analyze:
+                if timeout is not None:
+                    connection.execute(
+                        f"SET LOCAL statement_timeout = {int(timeout * 1000)};"
+                    )
+                return self.explain_query(
+                    connection,
+                    """EXPLAIN (ANALYZE, BUFFERS, TIMING, VERBOSE, FORMAT JSON)""" + sql,  # type: ignore
+                )
+
+            state = self.planner_state(connection)
+            self.validate_catalog(state[0])
+
+            key = self.plan_key(sql, state, generic)
+            plan_json = self.plan_cache.get(key)
+            if plan_json is None:
+                plan = (
+                    self.explain_generic(connection, sql)
+                    if generic
+                    else self.explain_query(connection, """EXPLAIN (VERBOSE, FORMAT JSON)""" + sql)  # type: ignore
+                )
+                # cache serialized plan as callers are free to modify the returned plan
+                plan_json = json.dumps(plan)
+                self.plan_cache.put(key, plan_json)
+        return json.loads(plan_json)
+
+    def explain_query(self, connection: psycopg.Connection, query: str) -> dict:
+        """Execute the given EXPLAIN query & return the query plan it fetched."""
+        cursor = connection.execute(query)  # type: ignore
+        result = cursor.fetchone()
         if result is None:
             raise RuntimeError("fetch of query plan of SQL returned no results.")
         return result[0][0]["Plan"]
 
+    def explain_generic(self, connection: psycopg.Connection, sql: str) -> dict:
+        """Fetch the generic query plan of the given parameterized SQL statement.
+
+        Uses EXPLAIN's GENERIC_PLAN option on Postgres 16+. On older versions,
+        prepares the statement & explains its execution with forced generic planning.
+        """
+        if connection.info.server_version >= 160000:
+            return self.explain_query(
+                connection, """EXPLAIN (VERBOSE, FORMAT JSON, GENERIC_PLAN)""" + sql
+            )
+
+        n_params = count_parameters(sql)
+        args = f"({', '.join(['NULL'] * n_params)})" if n_params > 0 else ""
+        name = "pipesyntax_generic"
+        connection.execute(f"PREPARE {name} AS {sql}")  # type: ignore
+        try:
+            # savepoint keeps the transaction usable to deallocate on failure
+            with connection.transaction():
+                connection.execute("SET LOCAL plan_cache_mode = force_generic_plan;")
+                return self.explain_query(
+                    connection, f"EXPLAIN (VERBOSE, FORMAT JSON) EXECUTE {name}{args}"
+                )
+        finally:
+            # prepared statements outlive transactions: deallocate explicitly
+            connection.execute(f"DEALLOCATE {name}")  # type: ignore
+
+    def explain_script(self, sqls: list[str]) -> Iterator[Union[dict, Exception]]:
+        """Fetch the query plans of the given sql statements in pipeline mode.
+
+        Sends the EXPLAIN of all statements not in the plan cache in one pipeline.
+        Each statement is explained in its own subtransaction, so a failing statement
+        does not abort the rest: scripts with errors still take one round trip.
+
+        Args:
+            sqls: SQL statements to fetch query plans of.
+        Returns:
+            Iterator of query plan, or error raised when planning, per statement
+            in the order of the given statements.
+        """
+        with self.connect() as connection:
+            with connection.transaction():
+                connection.execute("SET LOCAL max_parallel_workers_per_gather = 0;")
+                state = self.planner_state(connection)
+            self.validate_catalog(state[0])
+
+            keys = [self.plan_key(sql, state) for sql in sqls]
+            results: list[Union[str, Exception, None]] = [
+                self.plan_cache.get(key) for key in keys
+            ]
+            pending = [i for i, result in enumerate(results) if result is None]
+            if len(pending) > 0:
+                fetched = self.explain_pipeline(connection, [sqls[i] for i in pending])
+                for i, result in zip(pending, fetched):
+                    if isinstance(result, dict):
+                        result = json.dumps(result)
+                        self.plan_cache.put(keys[i], result)
+                    results[i] = result
+
+        for result in results:
+            yield json.loads(result) if isinstance(result, str) else result  # type: ignore
+
+    def explain_pipeline(
+        self, connection: psycopg.Connection, sqls: list[str]
+    ) -> list[Union[dict, psycopg.Error]]:
+        """Fetch the query plans of the given sql statements in one pipeline.
+
+        Statements are explained by a temporary PL/pgSQL function that rolls back
+        to a savepoint when explaining fails, returning the error instead of
+        aborting the pipeline's transaction. The function is dropped by rolling
+        back the transaction.
+
+        Args:
+            connection: Connection to send the pipeline on.
+            sqls: SQL statements to fetch query plans of.
+        Returns:
+            list[Union[dict, psycopg.Error]]: Query plan, or error raised when
+                planning, per statement.
+        """
+        with connection.transaction(force_rollback=True), connection.pipeline():
+            connection.execute("SET LOCAL max_parallel_workers_per_gather = 0;")
+            connection.execute(EXPLAIN_ISOLATED_SQL)
+            cursors = [
+                # not prepared: the function is recreated by every pipeline
+                connection.execute(
+                    "SELECT * FROM pg_temp.pipesyntax_explain(%s);",
+                    (sql,),
+                    prepare=False,
+                )
+                for sql in sqls
+            ]
+
+        results: list[Union[dict, psycopg.Error]] = []
+        for cursor in cursors:
+            result = cursor.fetchone()
+            if result is None:
+                raise RuntimeError("fetch of query plan of SQL returned no results.")
+            plan, code, message = result
+            if plan is not None:
+                results.append(plan[0]["Plan"])
+                continue
+            try:
+                error = psycopg.errors.lookup(code)
+            except KeyError:
+                error = psycopg.DatabaseError
+            results.append(error(message))
+        return results
+
+    def planner_state(self, connection: psycopg.Connection) -> tuple[str, str, str]:
+        """Fetch the state of the DB that determines the query plans produced.
+
+        Returns:
+            tuple[str, str, str]: Catalog version, planner settings & statistics version.
+        """
+        result = connection.execute(PLANNER_STATE_SQL).fetchone()
+        if result is None:
+            raise RuntimeError("Fetch of planner state returned no results.")
+        return result
+
+    def catalog_version(self, connection: psycopg.Connection) -> str:
+        """Fetch a version of the DB catalog that changes whenever DDL is executed.
+
+        Fingerprints the catalog rows of user objects by their count & creating
+        transaction ids, which change when objects are created, altered or dropped.
+        """
+        result = connection.execute(f"SELECT {CATALOG_VERSION_SQL};").fetchone()
+        if result is None:
+            raise RuntimeError("Fetch of catalog version returned no results.")
+        return result[0]
+
+    @timing.timed("postgres.load_index_keys")
+    def load_index_keys(self, schemas: Iterable[str]) -> IndexCatalog:
+        """Load the key columns of all indexes in the given schemas in one query.
+
+        Args:
+            schemas: Names of the schemas to load index key columns of.
+
+        Returns:
+            IndexCatalog: Index catalog snapshot, updated with the given schemas.
+        """
+        schemas = list(schemas)
+        with self.connect() as connection, connection.transaction():
+            self.validate_catalog(self.catalog_version(connection))
+            cursor = connection.execute(INDEX_KEYS_SQL, (schemas,))
+            rows = cursor.fetchall()
+        return self.update_catalog(rows, schemas)
+
+    def snapshot_catalog(self, schemas: Optional[Iterable[str]] = None) -> IndexCatalog:
+        """Snapshot the key columns of all indexes in the given schemas, which can be
+        saved to convert saved QEP plans without the DB, see IndexCatalog.save().
+
+        Args:
+            schemas: Names of the schemas to snapshot, all user schemas if not given.
+        Returns:
+            IndexCatalog: Index catalog snapshot of only the given schemas.
+        """
+        if schemas is None:
+            with self.connect() as connection, connection.transaction():
+                schemas = [row[0] for row in connection.execute(SCHEMAS_SQL)]
+        schemas = list(schemas)
+        catalog = self.load_index_keys(schemas)
+        return IndexCatalog({s: catalog.keys[s] for s in schemas}, catalog.version)
+
+    @timing.timed("postgres.get_index_key")
     def get_index_key(self, index: str, schema: str = "public") -> list[str]:
         """Get the key columns of the given index / relation in the given schema.
 
+        Key columns are looked up in the index catalog snapshot, which is loaded
+        for the whole schema on first lookup.
+
         Args:
             index (str): Index name
             schema (str): Schema name
 
         Returns:
-            list[str]: List of index key column names
+            list[str]: List of index key column names in index key order
         """
-        # query primary key from information schema
-        with self.connection.transaction():
-            cursor = self.connection.execute(
-                """
+        catalog = self.catalog
+        if schema not in catalog.keys:
+            catalog = self.load_index_keys([schema])
+        return catalog.get_index_key(index, schema)
+
+
+class AsyncPostgres(BasePostgres):
+    """Asyncio Postgres DB facade that borrows connections from an async connection pool."""
+
+    def __init__(
+        self, pool: AsyncConnectionPool, plan_cache: Optional[LRUCache] = None
+    ) -> None:
+        super().__init__(plan_cache)
+        self.pool = pool
+
+    @classmethod
+    async def pooled(
+        cls,
+        min_size: int = 1,
+        max_size: int = 4,
+        max_idle: float = 300.0,
+        timeout: float = 30.0,
+        **conn_args,
+    ) -> "AsyncPostgres":
+        """Create a async Postgres facade backed by a new async connection pool.
+
+        Args:
+            min_size: Minimum no. of connections kept open by the pool.
+            max_size: Maximum no. of connections the pool can grow to.
+            max_idle: Seconds an idle connection above min_size is kept before it is closed.
+            timeout: Seconds to wait for a connection before giving up.
+            conn_args: Connection arguments passed to psycopg.
+        """
+        pool = AsyncConnectionPool(
+            make_conninfo(**conn_args),
+            min_size=min_size,
+            max_size=max_size,
+            max_idle=max_idle,
+            timeout=timeout,
+            check=AsyncConnectionPool.check_connection,
+            open=False,
+        )
+        await pool.open(wait=True, timeout=timeout)
+        return cls(pool)
+
+    async def close(self):
+        """Close the async connection pool."""
+        await self.pool.close()
+
+    async def explain(self, sql: str) -> dict:
+        """Fetch the query plan of the given sql statement. See Postgres.explain()."""
+        async with self.pool.connection() as connection, connection.transaction():
+            # disable parallel query planning to simplify plan retrieved
+            await connection.execute("SET LOCAL max_parallel_workers_per_gather = 0;")
+            cursor = await connection.execute(PLANNER_STATE_SQL)
+            state = await cursor.fetchone()
+            if state is None:
+                raise RuntimeError("Fetch of planner state returned no results.")
+            self.validate_catalog(state[0])
+
+            key = self.plan_key(sql, state)
+            plan_json = self.plan_cache.get(key)
+            if plan_json is None:
+                # fetch verbose query plan to include projected columns
+                cursor = await connection.execute("""EXPLAIN (VERBOSE, FORMAT JSON)""" + sql)  # type: ignore
+                result = await cursor.fetchone()
+                if result is None:
+                    raise RuntimeError(
+                        "fetch of query plan of SQL returned no results."
+                    )
+                plan_json = json.dumps(result[0][0]["Plan"])
+                self.plan_cache.put(key, plan_json)
+        return json.loads(plan_json)
+
+    async def load_index_keys(self, schemas: Iterable[str]) -> IndexCatalog:
+        """Load the key columns of all indexes in the given schemas in one query.
+        See Postgres.load_index_keys()."""
+        schemas = list(schemas)
+        async with self.pool.connection() as connection, connection.transaction():
+            cursor = await connection.execute(f"SELECT {CATALOG_VERSION_SQL};")
+            version = await cursor.fetchone()
+            if version is None:
+                raise RuntimeError("Fetch of catalog version returned no results.")
+            self.validate_catalog(version[0])
+            cursor = await connection.execute(INDEX_KEYS_SQL, (schemas,))
+            rows = await cursor.fetchall()
+        return self.update_catalog(rows, schemas)
+
+
+# fingerprint of catalog rows of user objects (oid >= FirstNormalObjectId)
+CATALOG_VERSION_SQL = """
+concat_ws(
+    ':',
+    (SELECT count(*) || '/' || sum(xmin::text::bigint) FROM pg_class WHERE oid >= 16384),
+    (SELECT count(*) || '/' || sum(xmin::text::bigint) FROM pg_index WHERE indexrelid >= 16384),
+    (SELECT count(*) || '/' || sum(xmin::text::bigint) FROM pg_attribute WHERE attrelid >= 16384)
+)
+"""
+
+# creates a function that explains the given sql statement, rolling back to a
+# savepoint & returning the error raised instead if explaining fails
+EXPLAIN_ISOLATED_SQL = """
+CREATE FUNCTION pg_temp.pipesyntax_explain(
+    sql text, OUT plan json, OUT error_code text, OUT error_message text
+) LANGUAGE plpgsql AS $$
+BEGIN
+    EXECUTE 'EXPLAIN (VERBOSE, FORMAT JSON) ' || sql INTO plan;
+EXCEPTION WHEN OTHERS THEN
+    error_code := SQLSTATE;
+    error_message := SQLERRM;
+END
+$$;
+"""
+
+# catalog version, planner settings & table statistics version
+PLANNER_STATE_SQL = f"""
+SELECT
+    {CATALOG_VERSION_SQL},
+    (
+        SELECT string_agg(name || '=' || setting, ',' ORDER BY name)
+        FROM pg_settings
+        WHERE category LIKE 'Query Tuning%'
+            OR name IN ('search_path', 'work_mem', 'max_parallel_workers_per_gather')
+    ),
+    concat_ws(
+        ':',
+        -- statistics updated in place by VACUUM / ANALYZE
+        (SELECT sum(reltuples) || '/' || sum(relpages) FROM pg_class WHERE oid >= 16384),
+        (
+            SELECT max(greatest(last_analyze, last_autoanalyze))::text
+            FROM pg_stat_user_tables
+        )
+    );
+"""
+
+# key columns of all indexes in the given schemas in index key order
+INDEX_KEYS_SQL = """
 SELECT
+    n.nspname,
+    i.relname,
     a.attname
 FROM
     pg_index ix
 JOIN
     pg_class i ON i.oid = ix.indexrelid
-JOIN
-    pg_attribute a ON a.attrelid = ix.indrelid
-                 AND a.attnum = ANY(ix.indkey)
 JOIN
     pg_namespace n ON n.oid = i.relnamespace
+CROSS JOIN LATERAL
+    unnest(ix.indkey::int2[]) WITH ORDINALITY AS k(attnum, position)
+JOIN
+    pg_attribute a ON a.attrelid = ix.indrelid
+                 AND a.attnum = k.attnum
 WHERE
-    i.relname = %s
-    AND n.nspname = %s;
-        """,
-                (index, schema),
-            )
-            result = cursor.fetchall()
-        if result is None:
-            raise RuntimeError("Fetch of index key columns returned no results.")
-
-        return [r[0] for r in result]
+    n.nspname = ANY(%s)
+    -- skip non key columns added with INCLUDE
+    AND k.position <= ix.indnkeyatts
+ORDER BY
+    n.nspname, i.relname, k.position;
+"""
+
+# names of all user schemas, excluding system & temporary schemas
+SCHEMAS_SQL = """
+SELECT
+    nspname
+FROM
+    pg_namespace
+WHERE
+    nspname <> 'information_schema'
+    AND nspname NOT LIKE 'pg\\_%'
+ORDER BY
+    nspname;
+"""
 
 
 ## QEP preprocessing
@@ -101,27 +809,45 @@ CORRECT_ARRAY_REGEX = re.compile(
 )
 
 
-def apply(plan: dict, transform: Callable[[dict, int, str], dict]) -> dict:
+def apply(
+    plan: dict,
+    transform: Callable[[dict, int, str], dict],
+    leave: Optional[Callable[[dict, int, str], None]] = None,
+    skip: Optional[Callable[[dict], bool]] = None,
+) -> dict:
     """Apply the given transform fn on the given QEP.
     Traverses the given QEP nodes post-order and calling the given transform fn on each node.
-    Transform fn is given QEP node & depth (root=0)."""
-
-    def dfs(qep_node: dict, depth: int, subplan: str):
-        """Perform post-order DFS to transform the QEP plan nodes"""
-        # update subplan name if recursed into a different subplan
+    Transform fn is given QEP node & depth (root=0).
+    If given, leave fn is called on each node after its children have been traversed.
+    If given, subtrees of QEP nodes the skip fn returns True for are left as is:
+    neither transformed, left nor traversed.
+    Traverses with an explicit stack, so arbitrarily deep QEPs can be traversed."""
+    # stack of (qep node, depth, subplan name, whether its children were traversed)
+    stack = [(plan, 0, "MainPlan", False)]
+    while len(stack) > 0:
+        qep_node, depth, subplan, traversed = stack.pop()
+        if traversed:
+            # children of qep node have been traversed: leave qep node
+            if leave is not None:
+                leave(qep_node, depth, subplan)
+            continue
+        if skip is not None and skip(qep_node):
+            continue
+
+        # update subplan name if traversed into a different subplan
         key = "Subplan Name"
         if key in qep_node:
             subplan = qep_node[key]
 
         # transform using given fn
         qep_node = transform(qep_node, depth, subplan)
-        # recursively traverse children if any
+        # revisit qep node to leave it after traversing its children
+        if leave is not None:
+            stack.append((qep_node, depth, subplan, True))
+        # traverse children if any, reversed to pop them in order
         if "Plans" in qep_node:
-            for child in qep_node["Plans"]:
-                dfs(child, depth + 1, subplan)
-        return plan
-
-    plan = dfs(plan, depth=0, subplan="MainPlan")
+            for child in reversed(qep_node["Plans"]):
+                stack.append((child, depth + 1, subplan, False))
     return plan
 
 
@@ -151,7 +877,14 @@ def correct_sql_arrays(expr: str) -> str:
 
 
 class Transformer(ABC):
-    """QEP node transformer that takes as input a QEP node, transforms it and returns it"""
+    """QEP node transformer that takes as input a QEP node, transforms it and returns it
+
+    QEP nodes are either raw QEP node dicts or compact plannode.PlanNode.
+    """
+
+    # qep node keys the transformer transforms on: only qep nodes with at least one
+    # of the keys are dispatched to the transformer, all qep nodes if None
+    keys: Optional[frozenset[str]] = None
 
     @abstractmethod
     def transform(self, qep_node: dict, depth: int, subplan: str) -> dict:
@@ -167,23 +900,84 @@ class Transformer(ABC):
         """
         pass
 
+    def prepare(self, plan: dict):
+        """Prepare to transform the nodes of the given QEP plan.
+
+        Called once with the whole QEP plan before any of its nodes are transformed,
+        allowing work to be batched across nodes.
+
+        Args:
+            plan: QEP plan to be transformed.
+        """
+        pass
+
 
 class IndexKeyTransformer(Transformer):
     """QEP node transformer that adds index key columns for index nodes"""
 
-    def __init__(self, db: Postgres):
+    keys = frozenset({"Index Name"})
+
+    def __init__(self, db: Union[Postgres, IndexCatalog]):
         self.db = db
 
     def transform(self, qep_node: dict, depth: int, subplan: str) -> dict:
         relation = "Index Name"
         if relation in qep_node:
-            qep_node["Index Key"] = self.db.get_index_key(qep_node[relation])
+            qep_node["Index Key"] = self.db.get_index_key(
+                qep_node[relation], qep_node.get("Schema", "public")
+            )
         return qep_node
 
 
+class ParallelTransformer(Transformer):
+    """QEP node transformer that folds parallel aggregation into one aggregate.
+
+    Parallel plans split aggregation into 'Partial' aggregates computed by each worker,
+    whose results are gathered & combined by a 'Finalize' aggregate. Replaces the nested
+    plans of the 'Finalize' aggregate with the input of the 'Partial' aggregate,
+    keeping the no. of workers planned & launched when analyzed as "Workers Planned"
+    & "Workers Launched".
+
+    'Partial' aggregates that cannot be folded, eg. partitionwise aggregates
+    appended under a 'Finalize' aggregate, compute partial aggregate states that have
+    no pipesyntax equivalent: transforming their 'Finalize' aggregate raises a
+    ValueError.
+    """
+
+    # qep node types allowed between 'Finalize' & 'Partial' aggregates
+    GATHER_NODE_TYPES = {"Gather", "Gather Merge", "Sort", "Incremental Sort"}
+
+    keys = frozenset({"Partial Mode"})
+
+    def transform(self, qep_node: dict, depth: int, subplan: str) -> dict:
+        if qep_node.get("Partial Mode") != "Finalize":
+            return qep_node
+
+        node, workers, launched = qep_node, 0, None
+        while len(node.get("Plans", [])) == 1:
+            node = node["Plans"][0]
+            workers = max(workers, node.get("Workers Planned", 0))
+            if "Workers Launched" in node:
+                launched = max(launched or 0, node["Workers Launched"])
+            if node.get("Partial Mode") == "Partial":
+                qep_node["Plans"] = node.get("Plans", [])
+                qep_node["Workers Planned"] = workers
+                if launched is not None:
+                    qep_node["Workers Launched"] = launched
+                return qep_node
+            if node["Node Type"] not in self.GATHER_NODE_TYPES:
+                break
+        raise ValueError(
+            "Unsupported parallel plan: 'Partial' aggregates under"
+            f" {node['Node Type']} cannot be folded into the 'Finalize' aggregate"
+        )
+
+
 class SubplanNameTransformer(Transformer):
     """QEP node transformer that conforms Subplan naming."""
 
+    keys = frozenset({"Subplan Name"})
+
     def transform(self, qep_node: dict, depth: int, subplan: str) -> dict:
         key = "Subplan Name"
         if key in qep_node:
@@ -192,15 +986,48 @@ class SubplanNameTransformer(Transformer):
         return qep_node
 
 
+def collect_exprs(plan: dict) -> list[str]:
+    """Collect the unique expressions in the given QEP plan in traversal order."""
+    exprs: dict[str, None] = {}
+
+    def collect(qep_node: dict, depth: int, subplan: str) -> dict:
+        for key in qep_node.keys():
+            if key in EXPR_LIST_KEYS:
+                exprs.update(dict.fromkeys(qep_node[key]))
+            if key in EXPR_SINGLE_KEYS:
+                exprs[qep_node[key]] = None
+        return qep_node
+
+    apply(plan, collect)
+    return list(exprs.keys())
+
+
 class ExprTransformer(Transformer):
     """QEP node transform that rewrites expressions in in the QEP node."""
 
+    keys = frozenset(EXPR_LIST_KEYS | EXPR_SINGLE_KEYS)
+
+    # expressions rewritten in a batch when preparing to transform the plan
+    rewritten: dict[str, str] = {}
+
+    def prepare(self, plan: dict):
+        # batching needs all expressions before the traversal transforms any, as
+        # later transformers read the rewritten expressions in the same traversal:
+        # collecting them is the one walk of the plan besides the traversal
+        self.rewritten = self.rewrite_all(collect_exprs(plan))
+
     def transform(self, qep_node: dict, depth: int, subplan: str) -> dict:
         for key in qep_node.keys():
             if key in EXPR_LIST_KEYS:
-                qep_node[key] = [self.rewrite(p, depth, subplan) for p in qep_node[key]]
+                qep_node[key] = [
+                    self.rewritten.get(p) or self.rewrite(p, depth, subplan)
+                    for p in qep_node[key]
+                ]
             if key in EXPR_SINGLE_KEYS:
-                qep_node[key] = self.rewrite(qep_node[key], depth, subplan)
+                expr = qep_node[key]
+                qep_node[key] = self.rewritten.get(expr) or self.rewrite(
+                    expr, depth, subplan
+                )
 
         return qep_node
 
@@ -208,9 +1035,33 @@ class ExprTransformer(Transformer):
     def rewrite(self, expr: str, depth: int, subplan: str) -> str:
         """Rewrite & return the given expression"""
 
+    def rewrite_all(self, exprs: list[str]) -> dict[str, str]:
+        """Rewrite the given expressions in one batch.
+
+        Only rewrites that do not depend on the depth & subplan of the QEP node can be
+        batched: by default no expressions are batched, leaving them to rewrite().
+
+        Args:
+            exprs: Unique expressions to rewrite.
+        Returns:
+            dict[str, str]: Rewritten expression by expression, for those rewritten.
+        """
+        return {}
+
+
+# cache of expressions transpiled by DialectTransformer shared across plans & queries
+TRANSPILE_CACHE = LRUCache(maxsize=8192)
+
 
 class DialectTransformer(ExprTransformer):
-    """QEP node transform that transforms Postgres QEP dialect into Pipeline SQL dialect."""
+    """QEP node transform that transforms Postgres QEP dialect into Pipeline SQL dialect.
+
+    Rewritten expressions are memoized in the given cache, by default the
+    TRANSPILE_CACHE shared by all DialectTransformers. Of the '$1', '$2', ...
+    parameters referenced, only the given no. of parameters of a generic plan's SQL
+    template are named '@p1', '@p2', ... : other parameters, eg. InitPlan outputs
+    on Postgres < 17, are left for subplan resolution.
+    """
 
     SUBPLAN_REGEX = re.compile(r"\((SubPlan \d+)\)")
     COL_REGEX = re.compile(r"\.col[0-9]+")
@@ -218,9 +1069,96 @@ class DialectTransformer(ExprTransformer):
     ORDER_REGEX = re.compile(r"AS `(ASC|DESC)`")
     ANY_RHS_REGEX = re.compile(r"= ANY\(([^\)]*)\)")
     ANY_LHS_REGEX = re.compile(r"ANY\(([^\)]*) = ([^\)]*)\)")
+    # string literals & parameters transpiled from '$1' into '@1'
+    PARAMETER_REGEX = re.compile(r"(?P<quoted>'(?:[^'\\]|\\.)*')|@(?P<param>\d+)\b")
+
+    def __init__(self, cache: Optional[LRUCache] = None, parameters: int = 0):
+        self.cache = TRANSPILE_CACHE if cache is None else cache
+        self.parameters = parameters
 
     def rewrite(self, expr: str, depth: int, subplan: str) -> str:
         """Rewrite the given Postgres QEP expression into Pipeline SQL dialect."""
+        # rewrite only depends on the expression: memoize by the raw expression
+        rewritten = self.cache.get(expr)
+        if rewritten is None:
+            rewritten = self.transpile(expr)
+            self.cache.put(expr, rewritten)
+        return self.name_parameters(rewritten)
+
+    def rewrite_all(self, exprs: list[str]) -> dict[str, str]:
+        """Rewrite the given Postgres QEP expressions into Pipeline SQL dialect,
+        transpiling expressions missing from the cache in one batch."""
+        rewritten = {}
+        for expr in exprs:
+            cached = self.cache.get(expr)
+            if cached is not None:
+                rewritten[expr] = cached
+        missing = [e for e in exprs if e not in rewritten]
+        for expr, result in self.transpile_all(missing).items():
+            self.cache.put(expr, result)
+            rewritten[expr] = result
+        if self.parameters > 0:
+            rewritten = {e: self.name_parameters(r) for e, r in rewritten.items()}
+        return rewritten
+
+    def name_parameters(self, expr: str) -> str:
+        """Name the SQL template parameters transpiled into '@1', '@2', ... in the
+        given expression as '@p1', '@p2', ... as query parameter names cannot start
+        with digits. Cached rewrites are kept unnamed as naming depends on the plan."""
+        if self.parameters == 0:
+            return expr
+
+        def name(match: re.Match) -> str:
+            param = match["param"]
+            if param is None or not 1 <= int(param) <= self.parameters:
+                return match[0]
+            return f"@p{param}"
+
+        return re.sub(self.PARAMETER_REGEX, name, expr)
+
+    def transpile_all(self, exprs: list[str]) -> dict[str, str]:
+        """Transpile the given Postgres QEP expressions into Pipeline SQL dialect
+        with one SQLGlot call, amortizing its per call setup across expressions.
+
+        Batches that fail to transpile are split in halves & retried, so expressions
+        that cannot be transpiled are left out instead of failing the batch.
+
+        Args:
+            exprs: Postgres QEP expressions to transpile.
+        Returns:
+            dict[str, str]: Transpiled expression by expression, for those transpiled.
+        """
+        if len(exprs) == 0:
+            return {}
+        try:
+            # transpile expressions as ';' separated statements in one call
+            results = sqlglot.transpile(
+                ";\n".join(self.clean(e) for e in exprs),
+                read="postgres",
+                write="bigquery",
+            )
+            if len(results) == len(exprs):
+                return {e: self.correct(r) for e, r in zip(exprs, results)}
+        except sqlglot.errors.SqlglotError:
+            pass
+        if len(exprs) == 1:
+            return {}
+        mid = len(exprs) // 2
+        return {**self.transpile_all(exprs[:mid]), **self.transpile_all(exprs[mid:])}
+
+    def transpile(self, expr: str) -> str:
+        """Transpile the given Postgres QEP expression into Pipeline SQL dialect."""
+        # transpile to pipeline sql dialect (bigquery)
+        results = sqlglot.transpile(self.clean(expr), read="postgres", write="bigquery")
+        if len(results) != 1:
+            raise ValueError(
+                "Expected SQLGlot to transpile expression to 1 statement, got: ",
+                len(results),
+            )
+        return self.correct(results[0])
+
+    def clean(self, expr: str) -> str:
+        """Clean up the given Postgres QEP expression for transpiling by SQLGlot."""
         # clean up non sql "hashed" and ".colX" in expr
         expr = expr.replace("hashed ", "")
         expr = re.sub(self.COL_REGEX, "", expr)
@@ -230,16 +1168,10 @@ class DialectTransformer(ExprTransformer):
 
         # quote subplan references
         expr = re.sub(self.SUBPLAN_REGEX, lambda m: f'"{m[0]}"', expr)
+        return expr
 
-        # transpile to pipeline sql dialect (bigquery)
-        results = sqlglot.transpile(expr, read="postgres", write="bigquery")
-        if len(results) != 1:
-            raise ValueError(
-                "Expected SQLGlot to transpile expression to 1 statement, got: ",
-                len(results),
-            )
-        expr = results[0]
-
+    def correct(self, expr: str) -> str:
+        """Correct the given SQLGlot transpiled expression in Pipeline SQL dialect."""
         # correct types
         expr = expr.replace("BPCHAR", "STRING")
 
@@ -260,6 +1192,8 @@ class DialectTransformer(ExprTransformer):
 class CTETransformer(Transformer):
     """QEP node transformer conforms 'CTE Scan' to other scan nodetypes."""
 
+    keys = frozenset({"CTE Name"})
+
     def transform(self, qep_node: dict, depth: int, subplan: str) -> dict:
         if qep_node["Node Type"] == "CTE Scan":
             qep_node["Relation Name"] = qep_node["CTE Name"]
@@ -269,6 +1203,8 @@ class CTETransformer(Transformer):
 class JoinKeyTransformer(Transformer):
     """QEP node transformer standardises Join condition "On" keys"""
 
+    keys = frozenset({"Join Type"})
+
     def transform(self, qep_node: dict, depth: int, subplan: str) -> dict:
         if "Join Type" in qep_node:
             for key in JOIN_ON_KEYS:
@@ -284,6 +1220,8 @@ class JoinKeyTransformer(Transformer):
 class FilterTransformer(Transformer):
     """QEP node transformer standardises filter condition keys."""
 
+    keys = frozenset(FILTER_KEYS)
+
     def transform(self, qep_node: dict, depth: int, subplan: str) -> dict:
         for key in FILTER_KEYS:
             if key in qep_node:
@@ -294,54 +1232,332 @@ class FilterTransformer(Transformer):
         return qep_node
 
 
-def transform(plan: dict, transformers: Iterable[Transformer]) -> dict:
-    """Transform the query execution plan using the given transformers."""
+class SubplanTransformer(Transformer):
+    """QEP node transformer that registers InitPlan & SubPlan QEP nodes
+    into the given list, in traversal order."""
+
+    keys = frozenset({"Parent Relationship"})
+
+    def __init__(self, subplans: list[dict]):
+        self.subplans = subplans
+
+    def transform(self, qep_node: dict, depth: int, subplan: str) -> dict:
+        if qep_node["Parent Relationship"] in ["InitPlan", "SubPlan"]:
+            self.subplans.append(qep_node)
+        return qep_node
+
+
+def compile_transformers(
+    transformers: Iterable[Transformer],
+) -> Callable[[dict, int, str], dict]:
+    """Compile the given transformers into a single transform fn.
 
-    def apply_all(qep_node: dict, depth: int, subplan: str):
-        for transformer in transformers:
-            qep_node = transformer.transform(qep_node, depth, subplan)
+    The transform fn dispatches each QEP node only to the transformers with keys
+    found in the QEP node, in the order the transformers are given.
+    Each transformer is timed if timings are being recorded when compiling.
+    """
+    transformers = list(transformers)
+    transforms = [transformer.transform for transformer in transformers]
+    if timing.current() is not None:
+        transforms = [
+            timing.timed(f"transform.{type(transformer).__name__}")(fn)
+            for transformer, fn in zip(transformers, transforms)
+        ]
+    # positions of transformers by the qep node keys they transform on
+    dispatch: dict[str, list[int]] = {}
+    always = []
+    for i, transformer in enumerate(transformers):
+        if transformer.keys is None:
+            always.append(i)
+            continue
+        for key in transformer.keys:
+            dispatch.setdefault(key, []).append(i)
+
+    def apply_all(qep_node: dict, depth: int, subplan: str) -> dict:
+        matched = set(always)
+        for key in qep_node.keys() & dispatch.keys():
+            matched.update(dispatch[key])
+        for i in sorted(matched):
+            transformer = transformers[i]
+            # recheck keys as earlier transformers may have transformed the qep node
+            if transformer.keys is None or not transformer.keys.isdisjoint(qep_node):
+                qep_node = transforms[i](qep_node, depth, subplan)
         return qep_node
 
-    return apply(plan, apply_all)
+    return apply_all
+
+
+def prune(plan: dict, skip: Callable[[dict], bool]) -> dict:
+    """Copy the given QEP plan without the subtrees of QEP nodes the skip fn returns
+    True for. QEP nodes are copied shallowly: the copy shares their values.
+
+    Args:
+        plan: QEP plan to copy.
+        skip: Fn returning whether to leave out the subtree of the given QEP node.
+    Returns:
+        dict: Pruned copy of the QEP plan.
+    """
+    pruned = dict(plan)
+    # copy with an explicit stack to support deeply nested plans
+    stack = [pruned]
+    while len(stack) > 0:
+        qep_node = stack.pop()
+        if "Plans" in qep_node:
+            qep_node["Plans"] = [
+                dict(child) for child in qep_node["Plans"] if not skip(child)
+            ]
+            stack.extend(qep_node["Plans"])
+    return pruned
+
+
+def transform(
+    plan: dict,
+    transformers: Iterable[Transformer],
+    leave: Optional[Callable[[dict, int, str], None]] = None,
+    skip: Optional[Callable[[dict], bool]] = None,
+) -> dict:
+    """Transform the query execution plan using the given transformers.
+    If given, leave fn is called on each node after its children are transformed.
+    If given, subtrees of QEP nodes the skip fn returns True for are left as is,
+    eg. subtrees already transformed. See apply()."""
+    transformers = list(transformers)
+    # only prepare to transform the qep nodes that are not skipped
+    prepared = plan if skip is None else prune(plan, skip)
+    for transformer in transformers:
+        if type(transformer).prepare is Transformer.prepare:
+            # skip timing transformers that need no preparation
+            transformer.prepare(prepared)
+            continue
+        with timing.span(f"transform.{type(transformer).__name__}.prepare"):
+            transformer.prepare(prepared)
+
+    if leave is not None and timing.current() is not None:
+        leave = timing.timed(f"transform.{leave.__name__}")(leave)
+    with timing.span("transform.traversal"):
+        return apply(plan, compile_transformers(transformers), leave, skip)
+
+
+def pushup_alias(qep_node: dict, depth: int = 0, subplan: str = "MainPlan"):
+    """Push up the alias of the child plans of the given QEP node into the QEP node.
+    Only push up alias if the QEP node does not have one & only 1 child has alias."""
+    if "Plans" in qep_node and "Alias" not in qep_node:
+        aliases = [child["Alias"] for child in qep_node["Plans"] if "Alias" in child]
+        if len(aliases) == 1:
+            qep_node["Alias"] = aliases[0]
 
 
 def pushup_aliases(plan: dict) -> dict:
     """Push up aliases in the QEP plan from child to parent.
     Only push up aliases if the parent only has one child plan.
     """
+    return apply(plan, lambda qep_node, depth, subplan: qep_node, pushup_alias)
+
+
+def preprocess_transformers(
+    db: Union[Postgres, IndexCatalog],
+    subplans: Optional[list[dict]] = None,
+    parameters: int = 0,
+) -> list[Transformer]:
+    """Get the chain of transformers used to preprocess QEP plans.
+    See preprocess_plan()."""
+    return [
+        ParallelTransformer(),
+        IndexKeyTransformer(db),
+        SubplanNameTransformer(),
+        DialectTransformer(parameters=parameters),
+        CTETransformer(),
+        JoinKeyTransformer(),
+        FilterTransformer(),
+        SubplanTransformer([] if subplans is None else subplans),
+    ]
+
+
+def preprocess_plan(
+    plan: dict,
+    db: Union[Postgres, IndexCatalog],
+    subplans: Optional[list[dict]] = None,
+    parameters: int = 0,
+) -> dict:
+    """Preprocess given QEP plan into transformed QEP plan.
+
+    Transforms the QEP plan, pushes up aliases & registers subplans in a single
+    traversal. DialectTransformer walks the plan once before the traversal, to
+    transpile all of its expressions in one batch. See ExprTransformer.prepare().
 
-    def pushup(plan: dict) -> Optional[str]:
-        if "Plans" in plan:
-            # pushup child aliases
-            results = [pushup(child) for child in plan["Plans"]]
-            aliases = [alias for alias in results if alias is not None]
-            # only pushup alias from child if parent does not have one
-            # and the parent has only 1 child with alias
-            if "Alias" not in plan and len(aliases) == 1:
-                plan["Alias"] = aliases[0]
-
-        if "Alias" in plan:
-            return plan["Alias"]
-        return None
-
-    pushup(plan)
-    return plan
+    Args:
+        plan: QEP plan to preprocess.
+        db: Postgres DB or index catalog snapshot to look up index key columns.
+        subplans: If given, list to register the InitPlan & SubPlan QEP nodes into,
+            which can be passed to pipesyntax.generate() to skip searching for them.
+        parameters: No. of '$1', '$2', ... parameters of the SQL template the plan
+            is the generic plan of, named '@p1', '@p2', ... in the transformed plan.
+            See count_parameters().
+    Returns:
+        dict: Transformed QEP plan.
+    """
+    return transform(
+        plan, preprocess_transformers(db, subplans, parameters), leave=pushup_alias
+    )
 
 
-def preprocess(sql: str, db: Postgres) -> dict:
-    """Parses, preprocess given SQL into transformed QEP plan using the given Postgres DB."""
-    plan = db.explain(sql)
-    # 1st pass
-    plan = transform(
-        plan,
+def preprocess(
+    sql: str,
+    db: Postgres,
+    generic: bool = False,
+    parallel: bool = False,
+    analyze: bool = False,
+    timeout: Optional[float] = None,
+    subplans: Optional[list[dict]] = None,
+) -> dict:
+    """Parses, preprocess given SQL into transformed QEP plan using the given Postgres DB.
+
+    If generic, SQL is planned as a template with '$1', '$2', ... parameters,
+    which are carried through to the transformed plan as '@p1', '@p2', ...
+    If parallel, SQL is planned with parallel query planning enabled.
+    If analyze, SQL is executed, within timeout seconds if given, to include actual
+    rows, loops, timings & buffer usage in the transformed plan.
+    See Postgres.explain(). If given, InitPlan & SubPlan QEP nodes are registered
+    into subplans, see preprocess_plan().
+    """
+    return preprocess_plan(
+        db.explain(sql, generic, parallel, analyze, timeout),
+        db,
+        subplans,
+        count_parameters(sql) if generic else 0,
+    )
+
+
+def count_parameters(sql: str) -> int:
+    """Count the no. of '$1', '$2', ... parameters in the given SQL statement.
+
+    Args:
+        sql: SQL statement with parameter placeholders.
+    Returns:
+        int: Highest parameter no. referenced in the SQL statement.
+    """
+    tokens = sqlglot.Dialect.get_or_raise("postgres").tokenize(sql)
+    return max(
         [
-            IndexKeyTransformer(db),
-            SubplanNameTransformer(),
-            DialectTransformer(),
-            CTETransformer(),
-            JoinKeyTransformer(),
-            FilterTransformer(),
+            int(token.text)
+            for prev, token in zip(tokens, tokens[1:])
+            if prev.token_type == sqlglot.TokenType.PARAMETER
+            and token.token_type == sqlglot.TokenType.NUMBER
         ],
+        default=0,
     )
-    plan = pushup_aliases(plan)
-    return plan
+
+
+def split_statements(script: str) -> list[str]:
+    """Split the given SQL script into its SQL statements.
+
+    Statements are split on ';' tokens using SQLGlot's Postgres tokenizer, so that
+    semicolons in string literals & comments do not split statements.
+
+    Args:
+        script: SQL script of ';' separated SQL statements.
+    Returns:
+        list[str]: Text of each SQL statement without the trailing ';'.
+    """
+    tokens = sqlglot.Dialect.get_or_raise("postgres").tokenize(script)
+    statements, start, end = [], None, None
+    for token in tokens + [None]:
+        if token is None or token.token_type == sqlglot.TokenType.SEMICOLON:
+            if start is not None:
+                statements.append(script[start : end + 1])  # type: ignore
+            start = None
+            continue
+        if start is None:
+            start = token.start
+        end = token.end
+    return statements
+
+
+def preprocess_script(
+    script: str, db: Postgres, subplans: Optional[list[list[dict]]] = None
+) -> Iterator[tuple[str, Union[dict, Exception]]]:
+    """Parses, preprocess given SQL script into transformed QEP plans per statement.
+
+    Query plans of all statements are fetched in pipeline mode. See Postgres.explain_script().
+
+    Args:
+        script: SQL script of ';' separated SQL statements.
+        db: Postgres DB to plan SQL statements with.
+        subplans: If given, list to append the InitPlan & SubPlan QEP nodes of each
+            statement's plan into as it is yielded, empty for failed statements.
+            See preprocess_plan().
+    Returns:
+        Iterator of SQL statement & its transformed QEP plan, or the error raised
+        when planning / transforming it, in the order of the statements in the script.
+    """
+    sqls = split_statements(script)
+    for sql, plan in zip(sqls, db.explain_script(sqls)):
+        registered: list[dict] = []
+        if subplans is not None:
+            subplans.append(registered)
+        if isinstance(plan, Exception):
+            yield sql, plan
+            continue
+        try:
+            transformed = preprocess_plan(plan, db, registered)
+        except Exception as e:
+            registered.clear()
+            yield sql, e
+            continue
+        yield sql, transformed
+
+
+def index_schemas(plan: dict) -> set[str]:
+    """Get the schemas of indexes used in the given QEP plan."""
+    schemas = set()
+
+    def collect(qep_node: dict, depth: int, subplan: str) -> dict:
+        if "Index Name" in qep_node:
+            schemas.add(qep_node.get("Schema", "public"))
+        return qep_node
+
+    apply(plan, collect)
+    return schemas
+
+
+async def preprocess_many(
+    sqls: Iterable[str],
+    db: AsyncPostgres,
+    concurrency: int = 4,
+    subplans: Optional[list[list[dict]]] = None,
+) -> list[dict]:
+    """Parses, preprocess given SQLs concurrently into transformed QEP plans.
+
+    Plans up to 'concurrency' SQLs at a time on the given async Postgres DB, while
+    transforming fetched plans on worker threads to keep the event loop free.
+    Size the async connection pool of the DB to at least 'concurrency' connections.
+
+    Args:
+        sqls: SQL statements to preprocess.
+        db: Async Postgres DB to plan SQL statements with.
+        concurrency: Maximum no. of SQL statements planned at the same time.
+        subplans: If given, list to append the InitPlan & SubPlan QEP nodes of each
+            plan into, in the order of the given SQLs. See preprocess_plan().
+    Returns:
+        list[dict]: Transformed QEP plans in the order of the given SQLs.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    sqls = list(sqls)
+    registered: list[list[dict]] = [[] for _ in sqls]
+
+    async def preprocess_one(sql: str, found: list[dict]) -> dict:
+        async with semaphore:
+            plan = await db.explain(sql)
+            # prefetch index key columns so that transform can run without the DB
+            schemas, catalog = index_schemas(plan), db.catalog
+            while not schemas <= catalog.keys.keys():
+                # loading invalidates the snapshot if the catalog version changed,
+                # dropping schemas loaded before: recheck until all are loaded
+                catalog = await db.load_index_keys(schemas - catalog.keys.keys())
+        return await asyncio.to_thread(preprocess_plan, plan, catalog, found)
+
+    plans = await asyncio.gather(
+        *[preprocess_one(sql, found) for sql, found in zip(sqls, registered)]
+    )
+    if subplans is not None:
+        subplans.extend(registered)
+    return plans
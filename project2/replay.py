@@ -0,0 +1,434 @@
+#
+# SC3020
+# Project 2
+# Postgres Record & Replay
+#
+
+import asyncio
+import json
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Iterable, Iterator, Optional, TextIO, Union
+
+import psycopg
+
+import timing
+from preprocessing import BasePostgres, IndexCatalog, LRUCache, Postgres, normalize_sql
+
+
+def call_key(method: str, args: list) -> str:
+    """Key identifying a call to the Postgres facade by method & arguments.
+    SQL statements are normalized so formatting differences replay the same call."""
+    if method == "explain":
+        args = [normalize_sql(args[0]), *args[1:4]]
+    return json.dumps([method, *args])
+
+
+class RecordingPostgres:
+    """Postgres DB facade wrapper that records the requests & responses of every
+    explain(), explain_script() & get_index_key() call to a file, for replay with
+    ReplayPostgres or AsyncReplayPostgres.
+
+    Calls are recorded as JSON lines as they are made, with the planner state
+    plans were fetched under, so that replayed plans are cached the same way.
+    The planner state is captured as the wrapped DB fetches it, instead of being
+    fetched again, and a plan is only recorded again if fetched under a different
+    planner state, eg. once per miss of the wrapped DB's plan cache.
+    Other attributes are delegated to the wrapped Postgres DB facade.
+    """
+
+    def __init__(self, db: Postgres, file: TextIO):
+        self.db = db
+        self.file = file
+        self.lock = threading.Lock()
+        # call keys & planner states of the explain() calls recorded
+        self.recorded: set[tuple[str, Optional[tuple]]] = set()
+        # planner state last fetched by the wrapped DB on each thread
+        self.states = threading.local()
+        fetch_state = db.planner_state
+
+        def planner_state(connection: psycopg.Connection) -> tuple[str, str, str]:
+            self.states.last = fetch_state(connection)
+            return self.states.last
+
+        db.planner_state = planner_state  # type: ignore
+
+    def record(
+        self,
+        method: str,
+        args: list,
+        result: Any = None,
+        error=None,
+        state: Optional[list[str]] = None,
+    ):
+        """Record a call to the given method with the given args & result or error,
+        and the planner state of the call if given."""
+        call: dict[str, Any] = {"method": method, "args": args, "result": result}
+        if error is not None:
+            call["error"] = {"type": type(error).__name__, "message": str(error)}
+        if state is not None:
+            call["state"] = state
+        with self.lock:
+            if method == "explain":
+                # plans fetched again under the same state replay the same
+                recorded = (
+                    call_key(method, args),
+                    None if state is None else tuple(state),
+                )
+                if recorded in self.recorded:
+                    return
+                self.recorded.add(recorded)
+            self.file.write(json.dumps(call) + "\n")
+            self.file.flush()
+
+    def fetched_state(self) -> Optional[list[str]]:
+        """Take the planner state the wrapped DB fetched on this thread since last
+        taken, None if it fetched none, eg. when analyzing."""
+        state = getattr(self.states, "last", None)
+        self.states.last = None
+        return None if state is None else list(state)
+
+    def explain(
+        self,
+        sql: str,
+        generic: bool = False,
+        parallel: bool = False,
+        analyze: bool = False,
+        timeout: Optional[float] = None,
+    ) -> dict:
+        """Fetch & record the query plan of the given sql. See Postgres.explain()."""
+        args = [sql, generic, parallel, analyze]
+        self.fetched_state()
+        try:
+            plan = self.db.explain(sql, generic, parallel, analyze, timeout)
+        except psycopg.Error as e:
+            self.record("explain", args, error=e, state=self.fetched_state())
+            raise
+        # record before plan is transformed in place by preprocessing
+        self.record("explain", args, plan, state=self.fetched_state())
+        return plan
+
+    def explain_script(self, sqls: list[str]) -> Iterator[Union[dict, Exception]]:
+        """Fetch & record the query plans of the given sql statements as explain()
+        calls. See Postgres.explain_script()."""
+        self.fetched_state()
+        state = None
+        for sql, result in zip(sqls, self.db.explain_script(sqls)):
+            # state is fetched by the wrapped DB before yielding the first plan
+            state = self.fetched_state() or state
+            args = [sql, False, False, False]
+            if isinstance(result, Exception):
+                self.record("explain", args, error=result, state=state)
+            else:
+                self.record("explain", args, result, state=state)
+            yield result
+
+    def get_index_key(self, index: str, schema: str = "public") -> list[str]:
+        """Get & record the key columns of the given index.
+        See Postgres.get_index_key()."""
+        key = self.db.get_index_key(index, schema)
+        self.record("get_index_key", [index, schema], key)
+        return key
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.db, name)
+
+
+class BaseReplayPostgres(BasePostgres):
+    """Recorded calls & replay state shared by the sync & async replay facades.
+
+    Replayed calls can be slowed down by a fixed latency per round trip to simulate
+    Postgres: fetching the planner state ("planner_state"), which every replayed
+    call fetching a plan makes, fetching query plans missing from the plan cache
+    ("explain") & index key columns ("get_index_key" or "load_index_keys").
+    Recorded errors are raised again as the same psycopg errors.
+    """
+
+    def __init__(
+        self,
+        file: TextIO,
+        latency: Union[float, dict[str, float]] = 0.0,
+        plan_cache: Optional[LRUCache] = None,
+    ):
+        """Load calls recorded by RecordingPostgres from the given file.
+
+        Args:
+            file: File of calls recorded by RecordingPostgres.
+            latency: Seconds each round trip takes, either for all round trips
+                or by round trip, eg. {"explain": 0.01, "get_index_key": 0.001}.
+            plan_cache: Cache of replayed query plans by the planner state they
+                were recorded under. See BasePostgres.
+        """
+        super().__init__(plan_cache)
+        self.latency = latency
+        # recorded results / errors & planner state of calls by call key,
+        # keeping the last call
+        self.calls: dict[str, tuple[Optional[str], Optional[dict], Optional[list]]] = {}
+        # recorded key columns by index & schema
+        self.index_keys: dict[tuple[str, str], list[str]] = {}
+        for line in file:
+            call = json.loads(line)
+            result = json.dumps(call["result"]) if "error" not in call else None
+            self.calls[call_key(call["method"], call["args"])] = (
+                result,
+                call.get("error"),
+                call.get("state"),
+            )
+            if call["method"] == "get_index_key" and "error" not in call:
+                self.index_keys[tuple(call["args"])] = call["result"]  # type: ignore
+
+    def delay(self, round_trip: str) -> float:
+        """Get the seconds the given round trip takes."""
+        if isinstance(self.latency, dict):
+            return self.latency.get(round_trip, 0.0)
+        return self.latency
+
+    def recorded(self, method: str, args: list) -> tuple:
+        """Get the recorded result, error & planner state of the call of the given
+        method with the given args.
+
+        Raises:
+            KeyError: If the call was not recorded.
+        """
+        key = call_key(method, args)
+        if key not in self.calls:
+            raise KeyError(f"No recorded call to replay: {key}")
+        return self.calls[key]
+
+    def result(self, method: str, args: list) -> str:
+        """Get the recorded result of the given call as JSON.
+
+        Raises:
+            KeyError: If the call was not recorded.
+            psycopg.Error: If the recorded call failed with an error.
+        """
+        result, error, _ = self.recorded(method, args)
+        if error is not None:
+            raise self.error(error)
+        return result  # type: ignore
+
+    def error(self, error: dict) -> Exception:
+        """Recreate the psycopg error of the given recorded error."""
+        return getattr(psycopg.errors, error["type"], psycopg.Error)(error["message"])
+
+    def cache_key(self, args: list) -> Optional[tuple]:
+        """Get the plan cache key of the given recorded explain() call, keyed by the
+        planner state it was recorded under, None if its plan is not cached.
+
+        Raises:
+            KeyError: If the call was not recorded.
+        """
+        sql, generic, _, analyze = args
+        state = self.recorded("explain", args)[2]
+        if state is None or analyze:
+            return None
+        self.validate_catalog(state[0])
+        return self.plan_key(sql, tuple(state), generic)  # type: ignore
+
+
+class ReplayPostgres(BaseReplayPostgres):
+    """Stand-in for the Postgres DB facade that replays calls recorded by
+    RecordingPostgres instead of connecting to Postgres.
+
+    Replayed query plans are served from the plan cache like Postgres.explain(),
+    by the planner state they were recorded under. See BaseReplayPostgres.
+    """
+
+    def __init__(
+        self,
+        file: TextIO,
+        latency: Union[float, dict[str, float]] = 0.0,
+        max_connections: Optional[int] = None,
+        plan_cache: Optional[LRUCache] = None,
+    ):
+        """Load calls recorded by RecordingPostgres from the given file.
+
+        Args:
+            file: File of calls recorded by RecordingPostgres.
+            latency: Seconds each round trip takes, see BaseReplayPostgres.
+            max_connections: Maximum no. of calls replayed at the same time,
+                simulating the connections of a pooled Postgres DB facade,
+                or None to replay any no. of calls at a time.
+            plan_cache: Cache of replayed query plans, see BaseReplayPostgres.
+        """
+        super().__init__(file, latency, plan_cache)
+        self.connections = (
+            None
+            if max_connections is None
+            else threading.BoundedSemaphore(max_connections)
+        )
+
+    @contextmanager
+    def connect(self) -> Iterator[None]:
+        """Hold a simulated connection for the duration of the context, waiting for
+        one to be free if max_connections are in use."""
+        if self.connections is None:
+            yield
+            return
+        with self.connections:
+            yield
+
+    def wait(self, round_trip: str):
+        """Wait for the given round trip to complete. See delay()."""
+        delay = self.delay(round_trip)
+        if delay > 0:
+            time.sleep(delay)
+
+    def replay(self, method: str, args: list) -> Any:
+        """Replay the recorded call of the given method with the given args,
+        taking the latency of the method's round trip.
+
+        Raises:
+            KeyError: If the call was not recorded.
+            psycopg.Error: If the recorded call failed with an error.
+        """
+        with self.connect():
+            self.wait(method)
+            # parse a copy of the result as plans are transformed in place
+            return json.loads(self.result(method, args))
+
+    @timing.timed("postgres.explain")
+    def explain(
+        self,
+        sql: str,
+        generic: bool = False,
+        parallel: bool = False,
+        analyze: bool = False,
+        timeout: Optional[float] = None,
+    ) -> dict:
+        """Replay the recorded query plan of the given sql. See Postgres.explain()."""
+        args = [sql, generic, parallel, analyze]
+        key = self.cache_key(args)
+        if key is None:
+            return self.replay("explain", args)
+
+        with self.connect():
+            self.wait("planner_state")
+            plan_json = self.plan_cache.get(key)
+            if plan_json is None:
+                self.wait("explain")
+                plan_json = self.result("explain", args)
+                self.plan_cache.put(key, plan_json)
+        return json.loads(plan_json)
+
+    def explain_script(self, sqls: list[str]) -> Iterator[Union[dict, Exception]]:
+        """Replay the recorded query plans of the given sql statements, fetching the
+        plans not in the plan cache in one round trip. See Postgres.explain_script().
+
+        Raises:
+            KeyError: If the plan of a statement was not recorded.
+        """
+        calls = [[sql, False, False, False] for sql in sqls]
+        keys = [self.cache_key(args) for args in calls]
+        with self.connect():
+            self.wait("planner_state")
+            results: list[Union[str, Exception, None]] = [
+                None if key is None else self.plan_cache.get(key) for key in keys
+            ]
+            pending = [i for i, result in enumerate(results) if result is None]
+            if len(pending) > 0:
+                self.wait("explain")
+            for i in pending:
+                try:
+                    results[i] = self.result("explain", calls[i])
+                except psycopg.Error as e:
+                    results[i] = e
+                    continue
+                if keys[i] is not None:
+                    self.plan_cache.put(keys[i], results[i])
+
+        for result in results:
+            yield json.loads(result) if isinstance(result, str) else result  # type: ignore
+
+    @timing.timed("postgres.get_index_key")
+    def get_index_key(self, index: str, schema: str = "public") -> list[str]:
+        """Replay the recorded key columns of the given index.
+        See Postgres.get_index_key()."""
+        return self.replay("get_index_key", [index, schema])
+
+    def close(self):
+        """Nothing to close: replay does not connect to Postgres."""
+        pass
+
+
+class AsyncReplayPostgres(BaseReplayPostgres):
+    """Stand-in for the asyncio Postgres DB facade that replays calls recorded by
+    RecordingPostgres instead of connecting to Postgres, eg. to load test
+    preprocess_many(). See AsyncPostgres & BaseReplayPostgres.
+    """
+
+    def __init__(
+        self,
+        file: TextIO,
+        latency: Union[float, dict[str, float]] = 0.0,
+        max_connections: Optional[int] = None,
+        plan_cache: Optional[LRUCache] = None,
+    ):
+        """Load calls recorded by RecordingPostgres from the given file.
+
+        Args:
+            file: File of calls recorded by RecordingPostgres.
+            latency: Seconds each round trip takes, see BaseReplayPostgres.
+            max_connections: Maximum no. of calls replayed at the same time,
+                simulating the async connection pool of AsyncPostgres,
+                or None to replay any no. of calls at a time.
+            plan_cache: Cache of replayed query plans, see BaseReplayPostgres.
+        """
+        super().__init__(file, latency, plan_cache)
+        self.max_connections = max_connections
+        # created on first use to bind to the running event loop
+        self.connections: Optional[asyncio.Semaphore] = None
+
+    @asynccontextmanager
+    async def connect(self) -> AsyncIterator[None]:
+        """Hold a simulated connection for the duration of the context, waiting for
+        one to be free if max_connections are in use."""
+        if self.max_connections is None:
+            yield
+            return
+        if self.connections is None:
+            self.connections = asyncio.Semaphore(self.max_connections)
+        async with self.connections:
+            yield
+
+    async def wait(self, round_trip: str):
+        """Wait for the given round trip to complete. See delay()."""
+        delay = self.delay(round_trip)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        """Nothing to close: replay does not connect to Postgres."""
+        pass
+
+    async def explain(self, sql: str) -> dict:
+        """Replay the recorded query plan of the given sql. See AsyncPostgres.explain()."""
+        args = [sql, False, False, False]
+        key = self.cache_key(args)
+        async with self.connect():
+            if key is not None:
+                await self.wait("planner_state")
+            plan_json = None if key is None else self.plan_cache.get(key)
+            if plan_json is None:
+                await self.wait("explain")
+                plan_json = self.result("explain", args)
+                if key is not None:
+                    self.plan_cache.put(key, plan_json)
+        return json.loads(plan_json)
+
+    async def load_index_keys(self, schemas: Iterable[str]) -> IndexCatalog:
+        """Replay the key columns of all indexes in the given schemas, from the key
+        columns of indexes recorded by get_index_key() calls: indexes without
+        recorded calls are taken to have no key columns.
+        See AsyncPostgres.load_index_keys()."""
+        schemas = list(schemas)
+        async with self.connect():
+            await self.wait("load_index_keys")
+        rows = [
+            (schema, index, column)
+            for (index, schema), key in self.index_keys.items()
+            if schema in schemas
+            for column in key
+        ]
+        return self.update_catalog(rows, schemas)
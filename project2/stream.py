@@ -0,0 +1,233 @@
+#
+# SC3020
+# Project 2
+# Streaming & Offline EXPLAIN Plan Conversion
+#
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+from contextlib import nullcontext
+from typing import Any, Callable, Iterator, TextIO, Union
+
+import timing
+from pipesyntax import generate
+from plannode import decode_node
+from preprocessing import IndexCatalog, Postgres, preprocess_plan
+
+log = logging.getLogger(__name__)
+
+# skips json text up to the next object brace, or string cut off by the chunk
+JSON_SKIP_REGEX = re.compile(r'[^"{}]*(?:"(?:[^"\\]|\\.)*"[^"{}]*)*')
+# skips the rest of a json string up to its closing quote, or escape cut off by the chunk
+JSON_STRING_REGEX = re.compile(r'(?:[^"\\]|\\.)*')
+
+
+def iter_plans(
+    file: TextIO,
+    chunk_size: int = 1 << 20,
+    object_hook: Callable[[dict], Any] = decode_node,
+) -> Iterator[Any]:
+    """Incrementally read QEP plans from the given EXPLAIN FORMAT JSON dump.
+
+    Reads the dump in chunks, parsing each top level {"Plan": ...} document in the
+    JSON array as soon as it has been read, so memory is bounded by the largest plan.
+    Chunks of a document are scanned once & only joined when it has been read, so
+    reading a document spanning many chunks takes time linear in its size.
+
+    Args:
+        file: EXPLAIN FORMAT JSON dump: a JSON array of {"Plan": ...} documents.
+        chunk_size: No. of characters to read from the dump at a time.
+        object_hook: json object_hook used to decode JSON objects of each document,
+            by default decoding QEP nodes into compact PlanNodes.
+    Yields:
+        QEP plan of each document in the dump, in order.
+    Raises:
+        ValueError: If the dump ends in the middle of a document.
+    """
+    # text of the document being read in previous chunks & escape cut off by a chunk
+    parts: list[str] = []
+    carry, depth, in_string = "", 0, False
+    while True:
+        chunk = file.read(chunk_size)
+        text, carry = carry + chunk, ""
+        pos, start = 0, 0
+        while pos < len(text):
+            if in_string:
+                pos = JSON_STRING_REGEX.match(text, pos).end()  # type: ignore
+                if pos == len(text):
+                    break
+                if text[pos] == "\\":
+                    # escape cut off by the chunk: resume from it with the next chunk
+                    text, carry = text[:pos], text[pos:]
+                    break
+                in_string, pos = False, pos + 1
+                continue
+
+            pos = JSON_SKIP_REGEX.match(text, pos).end()  # type: ignore
+            if pos == len(text):
+                break
+            if text[pos] == '"':
+                # string cut off by the chunk: skip the rest of it
+                in_string, pos = True, pos + 1
+                continue
+            if text[pos] == "{":
+                if depth == 0:
+                    start = pos
+                depth += 1
+            else:
+                depth -= 1
+            pos += 1
+            if depth == 0:
+                parts.append(text[start:pos])
+                document = json.loads("".join(parts), object_hook=object_hook)
+                parts = []
+                yield document["Plan"] if "Plan" in document else document
+
+        # keep text of the document still being read
+        if depth > 0:
+            parts.append(text[start:])
+
+        if len(chunk) == 0:
+            break
+    if depth > 0:
+        raise ValueError("EXPLAIN JSON dump ended in the middle of a document")
+
+
+def convert_stream(
+    in_file: TextIO,
+    out_file: TextIO,
+    db: Union[Postgres, IndexCatalog],
+    chunk_size: int = 1 << 20,
+    share: bool = False,
+) -> tuple[int, int]:
+    """Convert the QEP plans in the given EXPLAIN FORMAT JSON dump into pipesyntax SQL.
+
+    Preprocesses & generates pipesyntax SQL for each plan as it is read, writing
+    each plan's SQL, or the error converting it, to the given output as it goes.
+
+    Args:
+        in_file: EXPLAIN FORMAT JSON dump: a JSON array of {"Plan": ...} documents.
+        out_file: Output to write the generated pipesyntax SQL to.
+        db: Postgres DB or index catalog snapshot to look up index key columns.
+        chunk_size: No. of characters to read from the dump at a time.
+        share: Whether to share repeated subtrees & SubPlans as WITH entries.
+            See pipesyntax.PipeSyntax.
+    Returns:
+        tuple[int, int]: No. of plans converted & no. of plans that failed to convert.
+    """
+    converted, failed = 0, 0
+    for i, plan in enumerate(iter_plans(in_file, chunk_size)):
+        try:
+            subplans = []
+            sql = generate(preprocess_plan(plan, db, subplans), subplans, share=share)
+        except Exception as e:
+            log.warning(f"Failed to convert plan {i}: {e}")
+            out_file.write(f"-- plan {i}: failed: {e}\n\n")
+            failed += 1
+            continue
+        out_file.write(f"-- plan {i}\n{sql}\n")
+        converted += 1
+    return converted, failed
+
+
+def add_postgres_args(parser: argparse.ArgumentParser):
+    """Add arguments to connect to Postgres to the given CLI argument parser.
+    Password is taken from the POSTGRES_PASSWORD environment variable."""
+    parser.add_argument("--host", default="localhost", help="Postgres host.")
+    parser.add_argument("--port", type=int, default=5432, help="Postgres port.")
+    parser.add_argument("--dbname", default="postgres", help="Postgres database.")
+    parser.add_argument("--user", default="postgres", help="Postgres user.")
+
+
+def postgres_conn_args(args: argparse.Namespace) -> dict:
+    """Get Postgres connection arguments from CLI arguments added by add_postgres_args()."""
+    return {
+        "host": args.host,
+        "port": args.port,
+        "dbname": args.dbname,
+        "user": args.user,
+        "password": os.environ.get("POSTGRES_PASSWORD", ""),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert QEP plans in an EXPLAIN FORMAT JSON dump into pipesyntax SQL."
+    )
+    parser.add_argument(
+        "dump", nargs="?", help="EXPLAIN FORMAT JSON dump to convert, '-' for stdin."
+    )
+    parser.add_argument(
+        "-o", "--output", default="-", help="File to write SQL to, '-' for stdout."
+    )
+    parser.add_argument(
+        "--catalog",
+        help="Index catalog snapshot to convert with instead of connecting to Postgres.",
+    )
+    parser.add_argument(
+        "--export-catalog",
+        metavar="CATALOG",
+        help="Export an index catalog snapshot of Postgres to the file & exit.",
+    )
+    parser.add_argument(
+        "--schemas",
+        nargs="+",
+        help="Schemas to export in the index catalog snapshot, all if not given.",
+    )
+    parser.add_argument(
+        "--share",
+        action="store_true",
+        help="Generate repeated subtrees & SubPlans once as WITH entries.",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print the time spent in each stage of conversion.",
+    )
+    add_postgres_args(parser)
+    args = parser.parse_args()
+    if args.dump is None and args.export_catalog is None:
+        parser.error("the following arguments are required: dump")
+
+    if args.export_catalog is not None:
+        postgres = Postgres(**postgres_conn_args(args))
+        try:
+            catalog = postgres.snapshot_catalog(args.schemas)
+        finally:
+            postgres.close()
+        with open(args.export_catalog, "w") as f:
+            catalog.save(f)
+        print(
+            f"Exported index catalog of {len(catalog.keys)} schemas.", file=sys.stderr
+        )
+        return
+
+    # convert offline with the index catalog snapshot if given: no db round trips
+    db: Union[Postgres, IndexCatalog]
+    if args.catalog is not None:
+        with open(args.catalog) as f:
+            db = IndexCatalog.load(f)
+    else:
+        db = Postgres(**postgres_conn_args(args))
+    in_file = sys.stdin if args.dump == "-" else open(args.dump)
+    out_file = sys.stdout if args.output == "-" else open(args.output, "w")
+    recording = timing.record() if args.timings else nullcontext()
+    try:
+        with recording as timings:
+            converted, failed = convert_stream(in_file, out_file, db, share=args.share)
+    finally:
+        in_file.close()
+        out_file.close()
+        if isinstance(db, Postgres):
+            db.close()
+    print(f"Converted {converted} plans, {failed} failed.", file=sys.stderr)
+    if timings is not None:
+        print(timings.report(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#
+# SC3020
+# Project 2
+# Batch Conversion Unit Tests
+#
+
+from pathlib import Path
+
+from batch import convert_files, find_sql_files, output_paths, percentile, summarize
+from pipesyntax import generate
+from preprocessing import Postgres, close_pools, preprocess
+
+
+def test_percentile():
+    values = [4.0, 1.0, 3.0, 2.0]
+    assert percentile(values, 50) == 2.0
+    assert percentile(values, 90) == 4.0
+    assert percentile(values, 0) == 1.0
+    assert percentile([], 50) == 0.0
+
+
+def test_output_paths(tmp_path: Path):
+    for path in ["a/q1.sql", "b/q1.sql", "b/c/q2.sql"]:
+        (tmp_path / "sql" / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / "sql" / path).write_text("SELECT 1")
+    paths = find_sql_files(str(tmp_path / "sql" / "**" / "*.sql"))
+    outputs = output_paths(paths, str(tmp_path / "out"))
+
+    # sql files of the same name in different directories should not collide
+    assert sorted(str(p.relative_to(tmp_path / "out")) for p in outputs.values()) == [
+        "a/q1.sql",
+        "b/c/q2.sql",
+        "b/q1.sql",
+    ]
+    # sql files in a single directory should be output by name
+    assert output_paths(paths[:1], "out") == {paths[0]: Path("out", "q1.sql")}
+
+
+def test_convert_files(
+    db: Postgres, conn_args: dict, query_sqls: list[str], tmp_path: Path
+):
+    sql_dir = tmp_path / "sql"
+    sql_dir.mkdir()
+    (sql_dir / "1.sql").write_text(query_sqls[1 - 1])
+    (sql_dir / "6.sql").write_text(query_sqls[6 - 1])
+    (sql_dir / "missing.sql").write_text("SELECT * FROM missing_table")
+    paths = find_sql_files(str(sql_dir))
+
+    pooled = Postgres.pooled(**conn_args)
+    try:
+        results = convert_files(paths, str(tmp_path / "out"), pooled, workers=2)
+    finally:
+        close_pools()
+
+    # queries that fail to convert should not stop conversion of other queries
+    assert [(Path(p).name, e is None) for p, _, e in results] == [
+        ("1.sql", True),
+        ("6.sql", True),
+        ("missing.sql", False),
+    ]
+    for i in [1, 6]:
+        sql = (tmp_path / "out" / f"{i}.sql").read_text()
+        assert sql == generate(preprocess(query_sqls[i - 1], db))
+    assert "Converted 2/3 queries" in summarize(results, 1.0)
@@ -0,0 +1,64 @@
+#
+# SC3020
+# Project 2
+# Benchmarks Unit Tests
+#
+
+import json
+
+import pytest
+
+from benchmark import (
+    CATALOG_PATH,
+    PLANS_PATH,
+    SHAPES,
+    STAGES,
+    benchmark_plans,
+    compare_baseline,
+    deep_plan,
+    time_stages,
+    total_stages,
+)
+from preprocessing import IndexCatalog
+
+
+def test_benchmark_plans():
+    with open(PLANS_PATH) as f:
+        plans = json.load(f)
+    with open(CATALOG_PATH) as f:
+        catalog = IndexCatalog.load(f)
+    # recorded plans of all 22 TPC-H queries & test.json should be benchmarked
+    assert len(plans) == 23
+
+    results, calibration = benchmark_plans(plans, catalog, repeat=1)
+    assert calibration > 0
+    assert all(list(results[str(i)].keys()) == STAGES for i in range(1, 23))
+    # test.json plan lacks projected columns which are required to build its subplans
+    assert list(results["test.json"].keys()) == STAGES[:4]
+    assert list(total_stages(results).keys()) == STAGES
+
+    # plans failing on stages other than known failures should fail the suite
+    with pytest.raises(KeyError):
+        time_stages(plans["test.json"], catalog)
+
+
+def test_compare_baseline():
+    baseline = {"transform": 1.0, "generate": 1.0}
+    totals = {"transform": 1.2, "generate": 1.3, "pushup": 5.0}
+    assert compare_baseline(totals, baseline, tolerance=0.25) == ["generate"]
+
+
+def test_deep_plan():
+    for shape in SHAPES:
+        plan, n_joins, n_scans = deep_plan(10, shape), 0, 0
+        stack = [plan]
+        while len(stack) > 0:
+            node = stack.pop()
+            n_joins += node["Node Type"] == "Hash Join"
+            n_scans += node["Node Type"] == "Seq Scan"
+            stack.extend(node.get("Plans", []))
+        # each shape should join the same no. of tables
+        assert (n_joins, n_scans) == (10, 11)
+    # joins of left & right deep plans should nest on opposite sides
+    assert deep_plan(2, "left")["Plans"][0]["Node Type"] == "Hash Join"
+    assert deep_plan(2, "right")["Plans"][1]["Node Type"] == "Hash Join"
@@ -0,0 +1,113 @@
+#
+# SC3020
+# Project 2
+# Incremental Conversion Unit Tests
+#
+
+import json
+from copy import deepcopy
+
+import timing
+from benchmark import CATALOG_PATH, PLANS_PATH
+from incremental import IncrementalConverter, hash_subtrees
+from pipesyntax import generate
+from preprocessing import IndexCatalog, preprocess_plan
+
+NATION_SCAN = {
+    "Node Type": "Seq Scan",
+    "Parent Relationship": "Member",
+    "Relation Name": "nation",
+    "Alias": "nation",
+    "Total Cost": 1.25,
+    "Plan Rows": 5,
+    "Filter": "(nation.n_regionkey = 1)",
+    "Output": ["nation.n_nationkey"],
+}
+
+
+def append_qep(cost: float) -> dict:
+    return {
+        "Node Type": "Append",
+        "Total Cost": cost,
+        "Plan Rows": 10,
+        "Output": ["nation.n_nationkey"],
+        "Plans": [deepcopy(NATION_SCAN), deepcopy(NATION_SCAN)],
+    }
+
+
+def edit_leaf(plan: dict, cost: float) -> dict:
+    """Copy of the given plan with the cost of its last leaf & its ancestors edited."""
+    plan = deepcopy(plan)
+    node = plan
+    while True:
+        node["Total Cost"] += cost
+        if "Plans" not in node:
+            return plan
+        node = node["Plans"][-1]
+
+
+def test_hash_subtrees():
+    plan = append_qep(2.5)
+    hashes = hash_subtrees(plan)
+    # subtrees with the same content should hash the same
+    assert hashes[id(plan["Plans"][0])] == hashes[id(plan["Plans"][1])]
+    # editing a subtree should only change the hashes of it & its ancestors
+    edited = edit_leaf(plan, 1.0)
+    edited_hashes = hash_subtrees(edited)
+    assert edited_hashes[id(edited)] != hashes[id(plan)]
+    assert edited_hashes[id(edited["Plans"][0])] == hashes[id(plan["Plans"][0])]
+    assert edited_hashes[id(edited["Plans"][1])] != hashes[id(plan["Plans"][1])]
+
+
+def test_convert_plan():
+    with open(PLANS_PATH) as f:
+        plans = json.load(f)
+    with open(CATALOG_PATH) as f:
+        catalog = IndexCatalog.load(f)
+    converter = IncrementalConverter(catalog)
+
+    for name, plan in plans.items():
+        if name == "test.json":
+            # test.json plan lacks projected columns required to generate sql
+            continue
+        expected = generate(preprocess_plan(deepcopy(plan), catalog))
+        assert converter.convert_plan(deepcopy(plan))[1] == expected
+        # reconverting an unchanged plan should reuse the whole plan
+        with timing.record() as timings:
+            assert converter.convert_plan(deepcopy(plan))[1] == expected
+        assert "transform.traversal" not in timings.stages
+
+        # reconverting an edited plan should only transform the changed qep nodes
+        edited = edit_leaf(plan, 1.0)
+        expected = generate(preprocess_plan(deepcopy(edited), catalog))
+        with timing.record() as timings:
+            assert converter.convert_plan(deepcopy(edited))[1] == expected
+        changed = set(hash_subtrees(edited).values()) - set(
+            hash_subtrees(plan).values()
+        )
+        assert timings.stages["transform.traversal"][0] == 1
+        assert timings.stages["transform.pushup_alias"][0] <= len(changed)
+
+        # subplans registered when reusing subtrees should match preprocessing anew
+        edited = edit_leaf(plan, 2.0)
+        expected_subplans: list[dict] = []
+        preprocess_plan(deepcopy(edited), catalog, expected_subplans)
+        for _ in range(2):
+            subplans: list[dict] = []
+            converter.preprocess(deepcopy(edited), subplans=subplans)
+            assert [n["Subplan Name"] for n in subplans] == [
+                n["Subplan Name"] for n in expected_subplans
+            ]
+
+
+def test_convert_plan_shared():
+    catalog = IndexCatalog({})
+    converter = IncrementalConverter(catalog, share=True)
+    converter.convert_plan(append_qep(2.5))
+    # identical subtrees should only be substituted once & be shared
+    plan, sql = converter.convert_plan(append_qep(3.5))
+    assert plan["Plans"][0] is not plan["Plans"][1]
+    assert sql == generate(preprocess_plan(append_qep(3.5), catalog), share=True)
+    assert "WITH `Subtree 1`" in sql
+    # reconverting an unchanged plan should return the cached plan itself
+    assert converter.convert_plan(append_qep(3.5))[0] is plan
@@ -0,0 +1,104 @@
+#
+# SC3020
+# Project 2
+# Pipesyntax Intermediate Representation Unit Tests
+#
+
+from pipeir import (
+    Aggregate,
+    From,
+    Join,
+    Limit,
+    OrderBy,
+    Passthrough,
+    Pipe,
+    Renderer,
+    Rope,
+    Select,
+    SetOperation,
+    Subquery,
+    Where,
+    With,
+    indent,
+)
+
+
+def test_rope():
+    # ropes should render the same as joining & indenting their parts as strings
+    rope = Rope("a\n", Rope("b\nc\n", Rope("d\r", "\ne\n\n", indent=2), indent=2), "f")
+    assert rope.render() == "a\n" + indent("b\nc\n" + indent("d\r\ne\n\n")) + "f"
+    # long text is rendered from ropes in a single pass
+    assert Renderer().render_rope(rope) == rope.render()
+    assert Rope("\n", indent=4).render() == indent("\n", 4)
+    assert Rope(Rope(), "", indent=2).render() == ""
+    assert not Rope(Rope(), "")
+
+
+def test_render_memo():
+    memo: dict = {}
+    pipe = Pipe([From("t", "t")], 1.0)
+    subquery = Subquery(pipe)
+    assert Renderer(memo).render(subquery) == str(subquery)
+    # joined text of nodes should be memoized & reused when rendering them again
+    assert memo[pipe] == str(pipe)
+    memo[pipe] = "FROM `u`"
+    assert Renderer(memo).render(Subquery(pipe)) == "(\n  FROM `u`\n)"
+
+
+def test_render_operators():
+    assert str(From("orders", "o")) == "FROM `orders` AS `o`"
+    assert str(Where(["(a > 1)", "(b < 2)"])) == "WHERE (a > 1) AND (b < 2)"
+    assert str(Select(["a", "b"])) == "SELECT a, b"
+    assert str(Aggregate(["sum(a)"])) == "AGGREGATE sum(a)"
+    assert str(Aggregate(["sum(a)"], ["b"])) == "AGGREGATE sum(a) GROUP BY b"
+    assert str(OrderBy(["a", "b"])) == "ORDER BY a, b"
+    assert str(OrderBy(["a"], "DESC")) == "ORDER BY a DESC"
+    assert str(Limit(10)) == "LIMIT 10"
+
+
+def test_render_pipe():
+    scan = Pipe([From("t", "t"), Select(["t.a"])], 1.0, annotations=["workers: 2"])
+    assert str(scan) == "FROM `t` AS `t`\n|> SELECT t.a\n-- cost: 1.0\n-- workers: 2\n"
+    # empty inputs are not piped
+    assert (
+        str(Pipe([Limit(1)], 2.0, inputs=[Passthrough()])) == "LIMIT 1\n-- cost: 2.0\n"
+    )
+
+    lhs = Pipe([From("a", "a")], 1.0)
+    rhs = Pipe([From("b", "b")], 2.0)
+    join = Join("INNER JOIN", lhs, rhs, rhs_alias="b", condition="(a.x = b.x)")
+    assert str(Pipe([join, Select(["a.x"])], 3.0)) == (
+        "FROM `a` AS `a`\n"
+        "-- cost: 1.0\n"
+        "\n|> INNER JOIN (\n"
+        "  FROM `b` AS `b`\n"
+        "  -- cost: 2.0\n"
+        "  |> AS `b`\n"
+        ") ON (a.x = b.x)\n"
+        "|> SELECT a.x\n"
+        "-- cost: 3.0\n"
+    )
+
+
+def test_render_with():
+    subquery = Subquery(Pipe([Select(["1"])], 0.01))
+    assert str(subquery) == "(\n  SELECT 1\n  -- cost: 0.01\n)"
+    body = Pipe([Select(["2"])], 0.02, inputs=[Pipe([Select(["1"])], 0.01)])
+    assert str(With([("x", subquery), ("y", subquery)], body)) == (
+        f"WITH `x` AS {subquery}, `y` AS {subquery}\n"
+        "SELECT 1\n-- cost: 0.01\n|> SELECT 2\n-- cost: 0.02\n"
+    )
+    assert str(With([], body)) == str(body)
+    assert not With([])
+
+
+def test_render_set_operation():
+    union = SetOperation(
+        "UNION ALL", [Pipe([From("a", "a")], 1.0), Pipe([From("b", "b")], 2.0)], 3.0
+    )
+    assert str(union) == (
+        "FROM `a` AS `a`\n-- cost: 1.0\n"
+        "\nUNION ALL\n"
+        "FROM `b` AS `b`\n-- cost: 2.0\n"
+        "\n-- cost: 3.0\n"
+    )
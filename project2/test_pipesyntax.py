@@ -8,8 +8,9 @@ import docker
 import pytest
 from docker.errors import ContainerError
 
+from benchmark import deep_plan
 from pipesyntax import PipeSyntax, generate
-from preprocessing import Postgres, preprocess
+from preprocessing import IndexCatalog, Postgres, preprocess, preprocess_plan
 
 SCAN_QEP = {
     "Node Type": "Index Only Scan",
@@ -49,14 +50,16 @@ def test_pipesyntax_gen_projection():
     pipesyntax = PipeSyntax()
 
     assert (
-        pipesyntax.gen_projection(
-            {
-                "Output": [
-                    "l_orderkey",
-                    "MAX(A, B)",
-                    "l_comment",
-                ],
-            }
+        str(
+            pipesyntax.gen_projection(
+                {
+                    "Output": [
+                        "l_orderkey",
+                        "MAX(A, B)",
+                        "l_comment",
+                    ],
+                }
+            )
         )
         == "SELECT l_orderkey, MAX(A, B), l_comment"
     )
@@ -64,45 +67,64 @@ def test_pipesyntax_gen_projection():
 
 def test_pipesyntax_gen_filters():
     pipesyntax = PipeSyntax()
-    assert pipesyntax.gen_filters(
+    filters = pipesyntax.gen_filters(
         {
             "Filters": [
                 "(customer.c_custkey = 1)",
                 "(customer.c_nationkey = nation.n_nationkey)",
             ],
         }
-    ) == [
+    )
+    assert [str(f) for f in filters] == [
         "WHERE (customer.c_custkey = 1) AND (customer.c_nationkey = nation.n_nationkey)"
     ]
 
 
 def test_pipesyntax_gen_scan():
     pipesyntax = PipeSyntax()
-    assert pipesyntax.gen_scan(SCAN_QEP) == SCAN_SQL
+    assert str(pipesyntax.gen_scan(SCAN_QEP)) == SCAN_SQL
 
 
-def test_pipesyntax_gen_aggregate():
+def test_pipesyntax_gen_scan_analyze():
     pipesyntax = PipeSyntax()
-    assert (
-        pipesyntax.gen_aggregate(
+    assert str(
+        pipesyntax.gen_scan(
             {
-                "Node Type": "Aggregate",
-                "Strategy": "Sorted",
-                "Partial Mode": "Simple",
-                "Parallel Aware": False,
-                "Async Capable": False,
-                "Startup Cost": 0.42,
-                "Total Cost": 9895.42,
-                "Plan Rows": 150000,
-                "Plan Width": 36,
-                "Plans": [SCAN_QEP],
-                "Output": ["c_custkey", "MIN(c_name)"],
-                "Filters": [
-                    "(customer.c_custkey = 1)",
-                ],
-                "Group Key": ["customer.c_custkey"],
+                **SCAN_QEP,
+                "Actual Rows": 1,
+                "Actual Loops": 1,
+                "Actual Total Time": 0.02,
+                "Shared Hit Blocks": 3,
+                "Shared Read Blocks": 1,
             }
         )
+    ) == (SCAN_SQL + "-- actual: rows=1 loops=1 time=0.02ms shared hit=3 read=1\n")
+
+
+def test_pipesyntax_gen_aggregate():
+    pipesyntax = PipeSyntax()
+    assert (
+        str(
+            pipesyntax.gen_aggregate(
+                {
+                    "Node Type": "Aggregate",
+                    "Strategy": "Sorted",
+                    "Partial Mode": "Simple",
+                    "Parallel Aware": False,
+                    "Async Capable": False,
+                    "Startup Cost": 0.42,
+                    "Total Cost": 9895.42,
+                    "Plan Rows": 150000,
+                    "Plan Width": 36,
+                    "Plans": [SCAN_QEP],
+                    "Output": ["c_custkey", "MIN(c_name)"],
+                    "Filters": [
+                        "(customer.c_custkey = 1)",
+                    ],
+                    "Group Key": ["customer.c_custkey"],
+                }
+            )
+        )
         == SCAN_SQL
         + """|> AGGREGATE MIN(c_name) GROUP BY customer.c_custkey
 |> WHERE (customer.c_custkey = 1)
@@ -114,17 +136,19 @@ def test_pipesyntax_gen_aggregate():
 def test_pipesyntax_gen_orderby():
     pipesyntax = PipeSyntax()
     assert (
-        pipesyntax.gen_orderby(
-            {
-                "Node Type": "Sort",
-                "Startup Cost": 21208.45,
-                "Total Cost": 21583.45,
-                "Plan Rows": 150000,
-                "Plan Width": 19,
-                "Plans": [SCAN_QEP],
-                "Output": ["c_name"],
-                "Sort Key": ["customer.c_name", "customer.c_address DESC"],
-            }
+        str(
+            pipesyntax.gen_orderby(
+                {
+                    "Node Type": "Sort",
+                    "Startup Cost": 21208.45,
+                    "Total Cost": 21583.45,
+                    "Plan Rows": 150000,
+                    "Plan Width": 19,
+                    "Plans": [SCAN_QEP],
+                    "Output": ["c_name"],
+                    "Sort Key": ["customer.c_name", "customer.c_address DESC"],
+                }
+            )
         )
         == SCAN_SQL
         + """|> SELECT c_name
@@ -137,22 +161,24 @@ def test_pipesyntax_gen_orderby():
 def test_pipesyntax_gen_limit():
     pipesyntax = PipeSyntax()
     assert (
-        pipesyntax.gen_limit(
-            {
-                "Node Type": "Limit",
-                "Parallel Aware": False,
-                "Async Capable": False,
-                "Startup Cost": 63423.31,
-                "Total Cost": 63423.32,
-                "Plan Rows": 1000,
-                "Plan Width": 270,
-                "Output": [
-                    "supplier.s_acctbal",
-                    "supplier.s_name",
-                    "nation.n_name",
-                ],
-                "Plans": [SCAN_QEP],
-            }
+        str(
+            pipesyntax.gen_limit(
+                {
+                    "Node Type": "Limit",
+                    "Parallel Aware": False,
+                    "Async Capable": False,
+                    "Startup Cost": 63423.31,
+                    "Total Cost": 63423.32,
+                    "Plan Rows": 1000,
+                    "Plan Width": 270,
+                    "Output": [
+                        "supplier.s_acctbal",
+                        "supplier.s_name",
+                        "nation.n_name",
+                    ],
+                    "Plans": [SCAN_QEP],
+                }
+            )
         )
         == SCAN_SQL
         + """|> LIMIT 1000
@@ -167,71 +193,73 @@ def test_pipesyntax_gen_join():
 
     assert (
         (
-            pipesyntax.gen_join(
-                {
-                    "Node Type": "Hash Join",
-                    "Parallel Aware": False,
-                    "Async Capable": False,
-                    "Join Type": "Inner",
-                    "Startup Cost": 5812.42,
-                    "Total Cost": 11442.18,
-                    "Plan Rows": 150000,
-                    "Plan Width": 19,
-                    "Output": ["c1.c_name"],
-                    "Inner Unique": True,
-                    "Filters": ["(c1.c_name = c2.c_name)"],
-                    "Join On": "(c1.c_custkey = c2.c_custkey)",
-                    "Plans": [
-                        {
-                            "Node Type": "Seq Scan",
-                            "Parent Relationship": "Outer",
-                            "Parallel Aware": False,
-                            "Async Capable": False,
-                            "Relation Name": "customer",
-                            "Schema": "public",
-                            "Alias": "c1",
-                            "Startup Cost": 0.00,
-                            "Total Cost": 5236.00,
-                            "Plan Rows": 150000,
-                            "Plan Width": 23,
-                            "Output": [
-                                "c1.c_custkey",
-                                "c1.c_name",
-                            ],
-                        },
-                        {
-                            "Node Type": "Hash",
-                            "Parent Relationship": "Inner",
-                            "Parallel Aware": False,
-                            "Async Capable": False,
-                            "Startup Cost": 3937.42,
-                            "Total Cost": 3937.42,
-                            "Plan Rows": 150000,
-                            "Plan Width": 4,
-                            "Alias": "c2",
-                            "Output": ["c2.c_custkey"],
-                            "Plans": [
-                                {
-                                    "Node Type": "Index Only Scan",
-                                    "Parent Relationship": "Outer",
-                                    "Parallel Aware": False,
-                                    "Async Capable": False,
-                                    "Scan Direction": "Forward",
-                                    "Index Name": "customer_pkey",
-                                    "Index Key": ["c_custkey"],
-                                    "Relation Name": "customer",
-                                    "Schema": "public",
-                                    "Alias": "c2",
-                                    "Startup Cost": 0.42,
-                                    "Total Cost": 3937.42,
-                                    "Plan Rows": 150000,
-                                    "Plan Width": 4,
-                                    "Output": ["c2.c_custkey"],
-                                }
-                            ],
-                        },
-                    ],
-                }
+            str(
+                pipesyntax.gen_join(
+                    {
+                        "Node Type": "Hash Join",
+                        "Parallel Aware": False,
+                        "Async Capable": False,
+                        "Join Type": "Inner",
+                        "Startup Cost": 5812.42,
+                        "Total Cost": 11442.18,
+                        "Plan Rows": 150000,
+                        "Plan Width": 19,
+                        "Output": ["c1.c_name"],
+                        "Inner Unique": True,
+                        "Filters": ["(c1.c_name = c2.c_name)"],
+                        "Join On": "(c1.c_custkey = c2.c_custkey)",
+                        "Plans": [
+                            {
+                                "Node Type": "Seq Scan",
+                                "Parent Relationship": "Outer",
+                                "Parallel Aware": False,
+                                "Async Capable": False,
+                                "Relation Name": "customer",
+                                "Schema": "public",
+                                "Alias": "c1",
+                                "Startup Cost": 0.00,
+                                "Total Cost": 5236.00,
+                                "Plan Rows": 150000,
+                                "Plan Width": 23,
+                                "Output": [
+                                    "c1.c_custkey",
+                                    "c1.c_name",
+                                ],
+                            },
+                            {
+                                "Node Type": "Hash",
+                                "Parent Relationship": "Inner",
+                                "Parallel Aware": False,
+                                "Async Capable": False,
+                                "Startup Cost": 3937.42,
+                                "Total Cost": 3937.42,
+                                "Plan Rows": 150000,
+                                "Plan Width": 4,
+                                "Alias": "c2",
+                                "Output": ["c2.c_custkey"],
+                                "Plans": [
+                                    {
+                                        "Node Type": "Index Only Scan",
+                                        "Parent Relationship": "Outer",
+                                        "Parallel Aware": False,
+                                        "Async Capable": False,
+                                        "Scan Direction": "Forward",
+                                        "Index Name": "customer_pkey",
+                                        "Index Key": ["c_custkey"],
+                                        "Relation Name": "customer",
+                                        "Schema": "public",
+                                        "Alias": "c2",
+                                        "Startup Cost": 0.42,
+                                        "Total Cost": 3937.42,
+                                        "Plan Rows": 150000,
+                                        "Plan Width": 4,
+                                        "Output": ["c2.c_custkey"],
+                                    }
+                                ],
+                            },
+                        ],
+                    }
+                )
             )
         )
         == """FROM `customer` AS `c1`
@@ -252,6 +280,42 @@ def test_pipesyntax_gen_join():
     )
 
 
+def test_pipesyntax_gen_gather():
+    pipesyntax = PipeSyntax()
+    assert (
+        str(
+            pipesyntax.gen_gather(
+                {
+                    "Node Type": "Gather",
+                    "Workers Planned": 2,
+                    "Total Cost": 4937.42,
+                    "Output": ["customer.c_custkey"],
+                    "Plans": [SCAN_QEP],
+                }
+            )
+        )
+        == SCAN_SQL + "-- workers: 2\n"
+    )
+
+
+def test_pipesyntax_gen_node_unknown_analyze():
+    pipesyntax = PipeSyntax()
+    # actual stats of unknown qep nodes should be kept as annotations
+    assert str(
+        pipesyntax.gen_node(
+            {
+                "Node Type": "Materialize",
+                "Total Cost": 4937.42,
+                "Output": ["customer.c_custkey"],
+                "Actual Rows": 1,
+                "Actual Loops": 2,
+                "Actual Total Time": 0.05,
+                "Plans": [SCAN_QEP],
+            }
+        )
+    ) == (SCAN_SQL + "-- actual: rows=1 loops=2 time=0.05ms shared hit=0 read=0\n")
+
+
 INITPLAN = {
     "Node Type": "Aggregate",
     "Strategy": "Plain",
@@ -301,7 +365,10 @@ INITPLAN_SQL = """(
 def test_pipesyntax_register_subplan():
     pipesyntax = PipeSyntax()
     pipesyntax.register_subplan(INITPLAN)
-    assert pipesyntax.subplans["InitPlan"]["InitPlan 2"] == INITPLAN_SQL
+    # subplans should only be built once referenced
+    assert pipesyntax.subplans["InitPlan"]["InitPlan 2"] is INITPLAN
+    assert pipesyntax.subplan_irs == {}
+    assert str(pipesyntax.subplan_ir("InitPlan 2")) == INITPLAN_SQL
 
 
 def test_pipesyntax_gen_initplan():
@@ -313,11 +380,139 @@ def test_pipesyntax_gen_initplan():
     initplan_1["Subplan Name"] = "InitPlan 1"
     pipesyntax.register_subplan(initplan_1)
     assert (
-        pipesyntax.gen_initplans()
+        str(pipesyntax.gen_initplans())
         == f"WITH `InitPlan 2` AS {INITPLAN_SQL}, `InitPlan 1` AS {INITPLAN_SQL}\n"
     )
 
 
+def test_pipesyntax_resolve_subplan():
+    pipesyntax = PipeSyntax()
+    for name, pattern in [("SubPlan 1", r"'\d+'"), ("SubPlan 2", r"'\w+'")]:
+        pipesyntax.register(
+            {
+                **SCAN_QEP,
+                "Parent Relationship": "SubPlan",
+                "Subplan Name": name,
+                "Filters": [f"(customer.c_phone ~ {pattern})"],
+            }
+        )
+    # subplans should only be built & rendered once referenced
+    assert pipesyntax.subplan_irs == {}
+    assert pipesyntax.subplan_sqls == {}
+
+    sql_1 = str(pipesyntax.subplan_ir("SubPlan 1"))
+    sql_2 = str(pipesyntax.subplan_ir("SubPlan 2"))
+    # every reference should be resolved, without processing backslashes in the sql
+    assert (
+        pipesyntax.resolve_subplan(
+            "(`(SubPlan 1)` = `(SubPlan 2)`) OR (`(SubPlan 1)` = `(SubPlan 3)`)"
+        )
+        == f"({sql_1} = {sql_2}) OR ({sql_1} = `(SubPlan 3)`)"
+    )
+    assert r"'\d+'" in sql_1
+    assert list(pipesyntax.subplan_sqls) == ["SubPlan 1", "SubPlan 2"]
+
+
+NATION_QEP = {
+    "Node Type": "Seq Scan",
+    "Parent Relationship": "Outer",
+    "Relation Name": "nation",
+    "Schema": "public",
+    "Alias": "nation",
+    "Total Cost": 1.25,
+    "Plan Rows": 5,
+    "Filters": ["(nation.n_regionkey = 1)"],
+    "Output": ["nation.n_nationkey"],
+}
+
+
+def self_join_qep(scan: dict) -> dict:
+    return {
+        "Node Type": "Hash Join",
+        "Join Type": "Inner",
+        "Total Cost": 2.6,
+        "Plan Rows": 5,
+        "Join On": "(nation.n_nationkey = nation.n_nationkey)",
+        "Output": ["nation.n_nationkey"],
+        "Plans": [scan, {**scan, "Parent Relationship": "Inner"}],
+    }
+
+
+def test_generate_shared_subtree():
+    # identical subtrees should only be shared if sharing is enabled
+    sql = generate(self_join_qep(NATION_QEP))
+    assert "WITH" not in sql
+    assert sql.count("FROM `nation` AS `nation`") == 2
+    # identical subtrees should be generated once as a WITH entry
+    assert generate(self_join_qep(NATION_QEP), share=True) == (
+        """WITH `Subtree 1` AS (
+  FROM `nation` AS `nation`
+  |> WHERE (nation.n_regionkey = 1)
+  |> SELECT nation.n_nationkey
+  -- cost: 1.25
+)
+FROM `Subtree 1` AS `nation`
+-- cost: 1.25
+|> AS `nation`
+|> INNER JOIN (
+  FROM `Subtree 1` AS `nation`
+  -- cost: 1.25
+  |> AS `nation`
+) ON (nation.n_nationkey = nation.n_nationkey)
+|> SELECT nation.n_nationkey
+-- cost: 2.6
+"""
+    )
+
+    # correlated subtrees referencing outer tables should not be shared
+    correlated = {**NATION_QEP, "Filters": ["(nation.n_regionkey = region.r_key)"]}
+    sql = generate(self_join_qep(correlated), share=True)
+    assert "WITH" not in sql
+    assert sql.count("FROM `nation` AS `nation`") == 2
+
+
+def test_generate_shared_subplan():
+    subplan = {
+        **NATION_QEP,
+        "Parent Relationship": "SubPlan",
+        "Subplan Name": "SubPlan 1",
+    }
+    plan = {
+        **SCAN_QEP,
+        "Filters": [
+            "(customer.c_nationkey > ANY (`(SubPlan 1)`))",
+            "(customer.c_custkey < ANY (`(SubPlan 1)`))",
+        ],
+        "Plans": [subplan],
+    }
+    # subplans referenced more than once should be generated once as a WITH entry
+    assert generate(plan, share=True) == (
+        """WITH `SubPlan 1` AS (
+  FROM `nation` AS `nation`
+  |> WHERE (nation.n_regionkey = 1)
+  |> SELECT nation.n_nationkey
+  -- cost: 1.25
+  |> SELECT nation.n_nationkey
+  -- cost: 1.25
+)
+FROM `customer` AS `customer`
+|> WHERE (customer.c_nationkey > ANY ((FROM `SubPlan 1`)))"""
+        """ AND (customer.c_custkey < ANY ((FROM `SubPlan 1`)))
+|> SELECT customer.c_custkey
+|> ORDER BY c_custkey ASC
+-- cost: 3937.42
+"""
+    )
+
+
+def test_generate_deep():
+    # plans nested deeper than the python recursion limit should be generated
+    plan = preprocess_plan(deep_plan(3000), IndexCatalog({"public": {}}))
+    sql = generate(plan)
+    assert sql.count("INNER JOIN") == 3000
+    assert sql.startswith("FROM `t0` AS `t0`\n|> WHERE (t0.y > 0)")
+
+
 def test_generate(query_plans: list[dict]):
     """Test pipesyntax generation from query plans."""
     docker_cli = docker.from_env()
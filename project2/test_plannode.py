@@ -0,0 +1,54 @@
+#
+# SC3020
+# Project 2
+# Compact QEP Plan Node Unit Tests
+#
+
+import json
+
+import pytest
+
+from benchmark import deep_plan
+from pipesyntax import generate
+from plannode import PlanNode, decode_plan, loads_plan
+from preprocessing import IndexCatalog, preprocess_plan
+
+with open("test.json") as f:
+    TEST_PLAN = json.load(f)[0]["Plan"]
+
+
+def test_plan_node():
+    node = PlanNode({"Node Type": "Seq Scan", "Output": ["a"]})
+    assert "Node Type" in node and "Alias" not in node
+    assert node.get("Alias", "t") == "t"
+    assert list(node.keys()) == ["Node Type", "Output"]
+
+    node["Plans"] = [PlanNode({"Node Type": "Hash"})]
+    assert isinstance(node["Plans"], tuple)
+    del node["Output"]
+    assert len(node) == 2
+    with pytest.raises(KeyError):
+        node["Plan Width"] = 4
+
+
+def test_decode_plan():
+    node = decode_plan(TEST_PLAN)
+    # unused EXPLAIN keys should be dropped
+    assert "Plan Width" not in node and "Startup Cost" not in node
+    assert node["Node Type"] == TEST_PLAN["Node Type"]
+    assert all(isinstance(child, PlanNode) for child in node["Plans"])
+    assert node == loads_plan(json.dumps([{"Plan": TEST_PLAN}]))
+
+    # identical expressions should share the same interned string
+    text = json.dumps({"Node Type": "Result", "Output": ["(a + b)", "(a + b)"]})
+    node = loads_plan(json.dumps({"Plan": json.loads(text)}))
+    assert node is not None and node["Output"][0] is node["Output"][1]
+
+
+def test_plan_node_preprocess_generate():
+    db = IndexCatalog({"public": {}})
+    plan = preprocess_plan(deep_plan(5), db)
+    node = preprocess_plan(decode_plan(deep_plan(5)), db)
+    # compact plan nodes should preprocess & generate the same as qep node dicts
+    assert generate(node) == generate(plan)
+    assert generate(node.to_dict()) == generate(plan)
@@ -4,21 +4,45 @@
 # Preprocessing Unit Tests
 #
 
+import asyncio
+import io
+import json
+import threading
+import time
 from copy import deepcopy
 
+import psycopg
+import pytest
+
+from pipesyntax import generate
 from preprocessing import (
     EXPR_LIST_KEYS,
     EXPR_SINGLE_KEYS,
+    AsyncPostgres,
+    BasePostgres,
     CTETransformer,
     DialectTransformer,
     FilterTransformer,
+    IndexCatalog,
     JoinKeyTransformer,
+    LRUCache,
+    ParallelTransformer,
     Postgres,
     SubplanNameTransformer,
+    Transformer,
     apply,
+    close_pools,
+    compile_transformers,
     correct_sql_arrays,
+    count_parameters,
+    normalize_sql,
     preprocess,
+    preprocess_many,
+    preprocess_plan,
+    preprocess_script,
+    prune,
     pushup_aliases,
+    split_statements,
     transform,
 )
 
@@ -51,14 +75,228 @@ def test_correct_arrays():
         assert correct_sql_arrays(expr) == expected
 
 
+def test_normalize_sql():
+    assert (
+        normalize_sql(
+            """SELECT  'a  -- b', "x  y" -- comment
+            /* multi
+               line */
+            FROM t;
+            """
+        )
+        == """SELECT 'a  -- b', "x  y" FROM t"""
+    )
+    # whitespace in dollar quoted strings should be kept
+    assert normalize_sql("SELECT $$a  b$$") != normalize_sql("SELECT $$a b$$")
+    assert normalize_sql("SELECT  $q$a  $$ b$q$,  $1") == "SELECT $q$a  $$ b$q$, $1"
+    # backslash escaped quotes should not end E'...' strings
+    assert normalize_sql("SELECT  E'x\\'  y',  'a  b'") == "SELECT E'x\\'  y', 'a  b'"
+    assert normalize_sql("SELECT E'x\\'  y'") != normalize_sql("SELECT E'x\\' y'")
+
+
+def test_split_statements():
+    assert (
+        split_statements(
+            """SELECT ';' AS x; -- comment;
+        CREATE TABLE t (a INT);;
+        SELECT $$;$$ /* end; */"""
+        )
+        == ["SELECT ';' AS x", "CREATE TABLE t (a INT)", "SELECT $$;$$"]
+    )
+
+
+def test_count_parameters():
+    assert count_parameters("SELECT $1, '$5' FROM t WHERE a = $10") == 10
+    assert count_parameters("SELECT 1") == 0
+
+
+def test_dialect_transform_parameters():
+    expr = "((nation.n_name <> '@1'::bpchar) AND (nation.n_regionkey = $1))"
+    assert (
+        DialectTransformer(parameters=1).rewrite(expr, depth=0, subplan="MainPlan")
+        == "((nation.n_name <> CAST('@1' AS STRING)) AND (nation.n_regionkey = @p1))"
+    )
+    # only parameters of generic plans' sql templates should be named
+    assert (
+        DialectTransformer().rewrite(expr, depth=0, subplan="MainPlan")
+        == "((nation.n_name <> CAST('@1' AS STRING)) AND (nation.n_regionkey = @1))"
+    )
+    assert DialectTransformer(parameters=1).rewrite_all(["(x = $2)"]) == {
+        "(x = $2)": "(x = @2)"
+    }
+
+
+def test_dialect_transform_cache():
+    transformer = DialectTransformer(LRUCache())
+    expr = "(part.p_brand <> 'Brand#53'::bpchar)"
+    assert transformer.rewrite(expr, depth=0, subplan="MainPlan") == (
+        transformer.rewrite(expr, depth=1, subplan="MainPlan")
+    )
+    # repeated expressions should be served from the cache
+    assert transformer.cache.stats()["hits"] == 1
+
+
+def test_dialect_transform_batch():
+    exprs = [
+        "(part.p_brand <> 'Brand#53'::bpchar)",
+        "(lineitem.l_shipdate <= '1998-09-02 00:00:00'::timestamp without time zone)",
+        "sum((lineitem.l_extendedprice * ('1'::numeric - lineitem.l_discount)))",
+        "(",
+    ]
+    rewritten = DialectTransformer(LRUCache()).rewrite_all(exprs)
+    # batched rewrites should match rewriting each expression on its own
+    transformer = DialectTransformer(LRUCache())
+    assert rewritten == {
+        e: transformer.rewrite(e, depth=0, subplan="MainPlan") for e in exprs[:-1]
+    }
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    # least recently used 'b' should be evicted
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats() == {"hits": 2, "misses": 1, "hit_rate": 2 / 3, "size": 2}
+
+    # entries should expire after ttl
+    cache = LRUCache(ttl=0)
+    cache.put("a", 1)
+    assert cache.get("a") is None
+
+
 def test_postgres_explain(db: Postgres, query_sqls: list[str]):
     # run explain on each query in queries
     for sql in query_sqls:
         db.explain(sql)
 
 
+def test_postgres_plan_cache(db: Postgres, query_sqls: list[str]):
+    db.plan_cache.clear()
+    hits, misses = db.plan_cache.hits, db.plan_cache.misses
+    plan = db.explain(query_sqls[0])
+    # whitespace & comments should not affect plan cache lookup
+    assert db.explain("-- cached\n" + query_sqls[0] + "\n\n") == plan
+    assert (db.plan_cache.hits - hits, db.plan_cache.misses - misses) == (1, 1)
+
+    # changes to planner settings should miss plan cache
+    with db.connect() as connection:
+        connection.execute("SET enable_hashagg = off")
+        try:
+            db.explain(query_sqls[0])
+            assert db.plan_cache.misses - misses == 2
+        finally:
+            connection.execute("RESET enable_hashagg")
+
+
+def test_postgres_explain_script(db: Postgres, query_sqls: list[str]):
+    db.plan_cache.clear()
+    sqls = [query_sqls[0], "SELECT * FROM missing_table", query_sqls[1]]
+    plans = list(db.explain_script(sqls))
+    # failing statements should not abort the statements after them
+    assert isinstance(plans[1], psycopg.errors.UndefinedTable)
+    assert plans[2] == db.explain(query_sqls[1])
+    # plans fetched by script should be shared with explain via the plan cache
+    hits = db.plan_cache.hits
+    assert db.explain(query_sqls[0]) == plans[0]
+    assert db.plan_cache.hits - hits == 1
+
+
+def test_postgres_explain_generic(db: Postgres):
+    plan = db.explain(
+        "SELECT n_name FROM nation WHERE n_regionkey = $1 AND n_nationkey < $2",
+        generic=True,
+    )
+    assert "$1" in plan["Filter"] and "$2" in plan["Filter"]
+
+
+def test_postgres_explain_analyze(db: Postgres):
+    plan = db.explain("SELECT * FROM nation", analyze=True, timeout=10)
+    assert plan["Actual Rows"] == 25
+    assert "Actual Total Time" in plan and "Shared Hit Blocks" in plan
+
+    # analyzed statements should be rolled back
+    db.explain(
+        "INSERT INTO region VALUES (99, 'TEST', 'test')", analyze=True, timeout=10
+    )
+    with db.connect() as connection:
+        result = connection.execute(
+            "SELECT COUNT(*) FROM region WHERE r_regionkey = 99"
+        ).fetchone()
+    assert result == (0,)
+
+
+def test_postgres_cancel(db: Postgres):
+    # cancelling should abort the statement running on the server
+    timer = threading.Timer(0.5, db.cancel)
+    timer.start()
+    started = time.monotonic()
+    with pytest.raises(psycopg.errors.QueryCanceled):
+        db.explain("SELECT pg_sleep(30)", analyze=True)
+    timer.join()
+    assert time.monotonic() - started < 10
+    # connection should be usable after the cancelled statement
+    assert db.explain("SELECT * FROM nation")["Node Type"] == "Seq Scan"
+
+
+def test_postgres_pooled(db: Postgres, conn_args: dict, query_sqls: list[str]):
+    pooled = Postgres.pooled(max_size=2, **conn_args)
+    try:
+        # facades with the same connection args & sizing should share the same pool
+        assert Postgres.pooled(max_size=2, **conn_args).pool is pooled.pool
+        # facades asking for a differently sized pool should not get the shared pool
+        assert Postgres.pooled(max_size=3, **conn_args).pool is not pooled.pool
+        for sql in query_sqls:
+            pooled.explain(sql)
+        # connections should be returned to the pool after use
+        assert pooled.pool is not None
+        assert pooled.pool.get_stats()["pool_size"] <= 2
+    finally:
+        close_pools()
+
+
 def test_postgres_get_index_key(db: Postgres):
     assert db.get_index_key("idx_lineitem_part_supp") == ["l_partkey", "l_suppkey"]
+    # key columns should be returned in index key order
+    assert db.get_index_key("idx_lineitem_shipdate") == [
+        "l_shipdate",
+        "l_discount",
+        "l_quantity",
+    ]
+
+
+def test_postgres_index_catalog_invalidate(db: Postgres):
+    # snapshot index key columns of schema
+    assert db.get_index_key("idx_nation_test") == []
+
+    with db.connect() as connection:
+        connection.execute(
+            "CREATE INDEX idx_nation_test ON nation (n_regionkey, n_nationkey)"
+        )
+        connection.commit()
+    try:
+        # DDL should invalidate the snapshot on the next explain
+        db.explain("SELECT * FROM nation")
+        assert db.get_index_key("idx_nation_test") == ["n_regionkey", "n_nationkey"]
+    finally:
+        with db.connect() as connection:
+            connection.execute("DROP INDEX idx_nation_test")
+            connection.commit()
+
+
+def test_postgres_snapshot_catalog(db: Postgres, query_sqls: list[str]):
+    snapshot = io.StringIO()
+    db.snapshot_catalog().save(snapshot)
+    snapshot.seek(0)
+    catalog = IndexCatalog.load(snapshot)
+    assert catalog.get_index_key("idx_lineitem_shipdate")[0] == "l_shipdate"
+
+    # saved plans should preprocess the same with the snapshot as with the db
+    for sql in query_sqls:
+        assert preprocess_plan(db.explain(sql), catalog) == preprocess(sql, db)
 
 
 def test_cte_transform(db: Postgres, query_sqls: list[str]):
@@ -167,6 +405,117 @@ def test_dialect_transform(db: Postgres, query_sqls: list[str]):
     )
 
 
+PARALLEL_SCAN_QEP = {
+    "Node Type": "Seq Scan",
+    "Parent Relationship": "Outer",
+    "Parallel Aware": True,
+    "Relation Name": "lineitem",
+    "Alias": "lineitem",
+    "Total Cost": 12356.0,
+    "Output": ["l_returnflag", "l_quantity"],
+}
+
+
+def test_apply_deep():
+    # plans nested deeper than the python recursion limit should be traversed
+    plan = {"Node Type": "Result"}
+    for _ in range(5000):
+        plan = {"Node Type": "Limit", "Plans": [plan]}
+
+    depths, leaves = [], []
+    apply(
+        plan,
+        lambda qep_node, depth, subplan: depths.append(depth) or qep_node,
+        lambda qep_node, depth, subplan: leaves.append(depth),
+    )
+    assert depths == list(range(5001))
+    # qep nodes should be left after their children
+    assert leaves == list(reversed(range(5001)))
+
+
+def parallel_qep(partial: dict) -> dict:
+    return {
+        "Node Type": "Aggregate",
+        "Partial Mode": "Finalize",
+        "Total Cost": 21106.17,
+        "Plan Rows": 4,
+        "Group Key": ["lineitem.l_returnflag"],
+        "Output": ["l_returnflag", "sum(l_quantity)"],
+        "Plans": [
+            {
+                "Node Type": "Gather Merge",
+                "Workers Planned": 2,
+                "Workers Launched": 1,
+                "Output": ["l_returnflag", "(PARTIAL sum(l_quantity))"],
+                "Plans": [
+                    {
+                        "Node Type": "Sort",
+                        "Sort Key": ["lineitem.l_returnflag"],
+                        "Output": ["l_returnflag", "(PARTIAL sum(l_quantity))"],
+                        "Plans": [partial],
+                    }
+                ],
+            }
+        ],
+    }
+
+
+def partial_qep(scan: dict) -> dict:
+    return {
+        "Node Type": "Aggregate",
+        "Partial Mode": "Partial",
+        "Group Key": ["lineitem.l_returnflag"],
+        "Output": ["l_returnflag", "PARTIAL sum(l_quantity)"],
+        "Plans": [scan],
+    }
+
+
+def test_parallel_transform():
+    plan = transform(
+        parallel_qep(partial_qep(PARALLEL_SCAN_QEP)), [ParallelTransformer()]
+    )
+
+    # partial aggregation & gather should be folded into the finalize aggregate
+    assert plan["Plans"] == [PARALLEL_SCAN_QEP]
+    assert plan["Workers Planned"] == 2
+    assert plan["Workers Launched"] == 1
+
+    # folded plans should generate a single aggregate without partial aggregates
+    plan = parallel_qep(partial_qep(PARALLEL_SCAN_QEP))
+    assert generate(preprocess_plan(plan, IndexCatalog({}))) == (
+        """FROM `lineitem` AS `lineitem`
+|> SELECT l_returnflag, l_quantity
+-- cost: 12356.0
+|> AGGREGATE SUM(l_quantity) GROUP BY lineitem.l_returnflag
+-- cost: 21106.17
+-- workers: 2 (launched: 1)
+"""
+    )
+
+    # partial aggregates that cannot be folded should raise a clear error
+    append = {
+        "Node Type": "Append",
+        "Output": ["l_returnflag", "(PARTIAL sum(l_quantity))"],
+        "Plans": [partial_qep(PARALLEL_SCAN_QEP), partial_qep(PARALLEL_SCAN_QEP)],
+    }
+    with pytest.raises(ValueError, match="'Partial' aggregates under Append"):
+        preprocess_plan(parallel_qep(append), IndexCatalog({}))
+
+
+def test_preprocess_parallel(db: Postgres, query_sqls: list[str]):
+    with db.connect() as connection:
+        # make parallel plans cheap to ensure parallel query planning is used
+        connection.execute("SET parallel_setup_cost = 0")
+        connection.execute("SET parallel_tuple_cost = 0")
+        try:
+            plan = db.explain(query_sqls[1 - 1], parallel=True)
+            assert "Workers Planned" in json.dumps(plan)
+            preprocess(query_sqls[1 - 1], db, parallel=True)
+        finally:
+            connection.execute("RESET parallel_setup_cost")
+            connection.execute("RESET parallel_tuple_cost")
+
+
 def test_pushup_alias(db: Postgres, query_sqls: list[str]):
     plan = pushup_aliases(
         {
@@ -183,6 +532,153 @@ def test_pushup_alias(db: Postgres, query_sqls: list[str]):
     assert plan["Plans"][0]["Alias"] == "a"
 
 
+def test_compile_transformers():
+    class KeyTransformer(Transformer):
+        keys = frozenset({"Join Type"})
+
+        def __init__(self):
+            self.visited = []
+
+        def transform(self, qep_node: dict, depth: int, subplan: str) -> dict:
+            self.visited.append(qep_node["Node Type"])
+            return qep_node
+
+    key_transformer = KeyTransformer()
+    plan = apply(
+        {
+            "Node Type": "Hash Join",
+            "Join Type": "Inner",
+            "Hash Cond": "(a.x = b.x)",
+            "Plans": [{"Node Type": "Seq Scan"}, {"Node Type": "Hash"}],
+        },
+        compile_transformers([JoinKeyTransformer(), key_transformer]),
+    )
+    # qep nodes should only be dispatched to transformers on their keys
+    assert key_transformer.visited == ["Hash Join"]
+    assert plan["Join On"] == "(a.x = b.x)"
+
+
+def test_transform_skip():
+    done = {"Node Type": "Seq Scan", "Filters": ["(b.y > 1)"], "Alias": "b"}
+    plan = {
+        "Node Type": "Nested Loop",
+        "Join Type": "Inner",
+        "Join Filter": "(a.x = b.x)",
+        "Plans": [{"Node Type": "Seq Scan", "Filter": "(a.x > 1)"}, done],
+    }
+
+    def skip(qep_node: dict) -> bool:
+        return qep_node is done
+
+    # skipped subtrees should be left out when preparing to transform
+    assert prune(plan, skip)["Plans"] == [plan["Plans"][0]]
+    transform(plan, [FilterTransformer()], skip=skip)
+    # skipped subtrees should not be transformed again
+    assert done["Filters"] == ["(b.y > 1)"]
+    assert plan["Plans"][0]["Filters"] == ["(a.x > 1)"]
+    assert plan["Filters"] == ["(a.x = b.x)"]
+
+
 def test_preprocess(db: Postgres, query_sqls: list[str]):
     for sql in query_sqls:
-        preprocess(sql, db)
+        subplans = []
+        plan = preprocess(sql, db, subplans=subplans)
+
+        expected = []
+
+        def collect(qep_node: dict, depth: int, subplan: str):
+            if qep_node.get("Parent Relationship") in ["InitPlan", "SubPlan"]:
+                expected.append(qep_node)
+            return qep_node
+
+        # subplans should be registered in traversal order
+        apply(plan, collect)
+        assert [id(n) for n in subplans] == [id(n) for n in expected]
+
+
+def test_preprocess_many(db: Postgres, conn_args: dict, query_sqls: list[str]):
+    async def preprocess_all() -> list[dict]:
+        async_db = await AsyncPostgres.pooled(max_size=4, **conn_args)
+        try:
+            return await preprocess_many(query_sqls, async_db, concurrency=4)
+        finally:
+            await async_db.close()
+
+    # concurrent preprocessing should match sequential preprocessing in order
+    assert asyncio.run(preprocess_all()) == [preprocess(sql, db) for sql in query_sqls]
+
+
+class VersionedAsyncDB(BasePostgres):
+    """Fake async DB whose catalog version changes after the first index key load."""
+
+    def __init__(self, plans: dict[str, dict]):
+        super().__init__()
+        self.plans = plans
+        self.loads = 0
+
+    async def explain(self, sql: str) -> dict:
+        await asyncio.sleep(0)
+        return deepcopy(self.plans[sql])
+
+    async def load_index_keys(self, schemas) -> IndexCatalog:
+        schemas = list(schemas)
+        self.loads += 1
+        await asyncio.sleep(0)
+        self.validate_catalog("v1" if self.loads == 1 else "v2")
+        rows = [(schema, f"{schema}_pkey", "n_nationkey") for schema in schemas]
+        return self.update_catalog(rows, schemas)
+
+
+def index_scan_qep(schema: str) -> dict:
+    return {
+        "Node Type": "Index Scan",
+        "Relation Name": "nation",
+        "Schema": schema,
+        "Alias": "nation",
+        "Index Name": f"{schema}_pkey",
+        "Scan Direction": "Forward",
+        "Total Cost": 1.25,
+        "Plan Rows": 5,
+        "Output": ["nation.n_nationkey"],
+    }
+
+
+def test_preprocess_many_catalog_change():
+    plans = {
+        "a": index_scan_qep("public"),
+        "b": {
+            "Node Type": "Append",
+            "Total Cost": 2.5,
+            "Plan Rows": 10,
+            "Output": ["nation.n_nationkey"],
+            "Plans": [index_scan_qep("public"), index_scan_qep("other")],
+        },
+    }
+    db = VersionedAsyncDB(plans)
+    # catalog version changing mid batch should not drop schemas plans need
+    subplans: list[list[dict]] = []
+    results = asyncio.run(preprocess_many(["a", "b"], db, 1, subplans))
+    catalog = IndexCatalog(
+        {s: {f"{s}_pkey": ["n_nationkey"]} for s in ["public", "other"]}
+    )
+    assert results == [preprocess_plan(deepcopy(plans[s]), catalog) for s in "ab"]
+    assert db.loads == 3
+    assert subplans == [[], []]
+
+
+def test_preprocess_script(db: Postgres):
+    sqls = [
+        "SELECT * FROM nation WHERE n_regionkey = 1",
+        "SELECT * FROM missing_table",
+        "SELECT r_name FROM region ORDER BY r_name",
+    ]
+    subplans: list[list[dict]] = []
+    results = list(preprocess_script(";\n".join(sqls), db, subplans))
+
+    # errors should be reported per statement without aborting the batch
+    assert [sql for sql, _ in results] == sqls
+    assert results[0][1] == preprocess(sqls[0], db)
+    assert isinstance(results[1][1], Exception)
+    assert results[2][1] == preprocess(sqls[2], db)
+    # subplans should be registered per statement
+    assert subplans == [[], [], []]
@@ -0,0 +1,133 @@
+#
+# SC3020
+# Project 2
+# Postgres Record & Replay Unit Tests
+#
+
+import asyncio
+import io
+import json
+import threading
+import time
+from pathlib import Path
+
+import psycopg
+import pytest
+
+from pipesyntax import generate
+from preprocessing import (
+    IndexCatalog,
+    Postgres,
+    preprocess,
+    preprocess_many,
+    preprocess_plan,
+    preprocess_script,
+)
+from replay import AsyncReplayPostgres, RecordingPostgres, ReplayPostgres
+
+# calls recorded converting TPC-H queries 1, 4 & 6 & index catalog snapshot
+RECORDING_PATH = Path(__file__).parent / "benchmarks" / "replay.jsonl"
+CATALOG_PATH = Path(__file__).parent / "benchmarks" / "catalog.json"
+
+
+def test_record_replay(db: Postgres, query_sqls: list[str]):
+    sqls = [query_sqls[1 - 1], query_sqls[6 - 1]]
+    recording = io.StringIO()
+    recorder = RecordingPostgres(db, recording)
+    expected = [generate(preprocess(sql, recorder)) for sql in sqls]
+    # plans fetched again under the same planner state should not be recorded again
+    recorded = recording.getvalue()
+    recorder.explain(sqls[0])
+    assert recording.getvalue() == recorded
+    with pytest.raises(psycopg.Error):
+        recorder.explain("SELECT * FROM missing_table")
+
+    recording.seek(0)
+    replay = ReplayPostgres(recording, latency={"explain": 0.05})
+    started = time.perf_counter()
+    # replayed calls should convert to the same pipesyntax sql as recorded calls
+    assert [generate(preprocess(sql, replay)) for sql in sqls] == expected
+    assert time.perf_counter() - started >= 0.05 * len(sqls)
+    # plans replayed again should not be affected by preprocessing in place
+    assert [generate(preprocess(sql, replay)) for sql in sqls] == expected
+
+    with pytest.raises(psycopg.errors.UndefinedTable):
+        replay.explain("SELECT *  FROM missing_table")
+    with pytest.raises(KeyError):
+        replay.explain("SELECT 1")
+
+    # replayed plans should be served from the plan cache by recorded planner state
+    hits = replay.plan_cache.hits
+    replay.explain(sqls[0])
+    assert replay.plan_cache.hits - hits == 1
+
+
+def test_record_replay_script(db: Postgres, query_sqls: list[str]):
+    script = ";\n".join([query_sqls[1 - 1], "SELECT * FROM missing_table"])
+    recording = io.StringIO()
+    expected = list(preprocess_script(script, RecordingPostgres(db, recording)))
+
+    recording.seek(0)
+    replay = ReplayPostgres(recording)
+    results = list(preprocess_script(script, replay))
+    assert results[0] == expected[0]
+    assert isinstance(results[1][1], psycopg.errors.UndefinedTable)
+    # script & single statement replays should share plan cache entries
+    hits = replay.plan_cache.hits
+    replay.explain(query_sqls[1 - 1])
+    assert replay.plan_cache.hits - hits == 1
+
+
+def test_replay_max_connections(db: Postgres, query_sqls: list[str]):
+    recording = io.StringIO()
+    RecordingPostgres(db, recording).explain(query_sqls[0], analyze=True)
+
+    recording.seek(0)
+    replay = ReplayPostgres(recording, latency=0.05, max_connections=1)
+    threads = [
+        threading.Thread(
+            target=replay.explain, args=(query_sqls[0], False, False, True)
+        )
+        for _ in range(3)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # calls should wait for the single connection to be free
+    assert time.perf_counter() - started >= 0.05 * len(threads)
+
+
+def test_async_replay(db: Postgres, query_sqls: list[str]):
+    sqls = [query_sqls[1 - 1], query_sqls[6 - 1]]
+    recording = io.StringIO()
+    recorder = RecordingPostgres(db, recording)
+    expected = [preprocess(sql, recorder) for sql in sqls]
+
+    recording.seek(0)
+    replay = AsyncReplayPostgres(recording, latency=0.05, max_connections=1)
+    started = time.perf_counter()
+    # async replays should preprocess the same plans as recorded calls
+    assert asyncio.run(preprocess_many(sqls, replay)) == expected
+    # each explain waits for the single connection to fetch the planner state & plan
+    assert time.perf_counter() - started >= 0.05 * 2 * len(sqls)
+
+
+def test_replay_recording(query_sqls: list[str]):
+    sqls = [query_sqls[1 - 1], query_sqls[4 - 1], query_sqls[6 - 1]]
+    with open(RECORDING_PATH) as f:
+        calls = [json.loads(line) for line in f]
+    with open(CATALOG_PATH) as f:
+        catalog = IndexCatalog.load(f)
+    plans = {c["args"][0]: c["result"] for c in calls if c["method"] == "explain"}
+    expected = [generate(preprocess_plan(plans[sql], catalog)) for sql in sqls]
+
+    # replays should convert the recorded plans without connecting to Postgres
+    with open(RECORDING_PATH) as f:
+        replay = ReplayPostgres(f, max_connections=1)
+    assert [generate(preprocess(sql, replay)) for sql in sqls] == expected
+    with open(RECORDING_PATH) as f:
+        async_replay = AsyncReplayPostgres(f, max_connections=2)
+    plans = asyncio.run(preprocess_many(sqls, async_replay))
+    assert [generate(plan) for plan in plans] == expected
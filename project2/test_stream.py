@@ -0,0 +1,49 @@
+#
+# SC3020
+# Project 2
+# Streaming EXPLAIN Plan Conversion Unit Tests
+#
+
+import io
+import json
+
+import pytest
+
+from benchmark import deep_plan
+from pipesyntax import generate
+from preprocessing import IndexCatalog, preprocess_plan
+from stream import convert_stream, iter_plans
+
+with open("test.json") as f:
+    TEST_DUMP = f.read()
+
+
+def test_iter_plans():
+    documents = json.loads(TEST_DUMP) + [
+        # braces & escaped quotes in strings should not be mistaken for json syntax
+        {"Plan": {"Node Type": "Result", "Output": ['"{a}\\"', '}{"\\"}']}}
+    ]
+    dump = json.dumps(documents, indent=2)
+    # plans should be read the same regardless of where chunks are cut
+    for chunk_size in [1, 7, 1 << 20]:
+        plans = iter_plans(io.StringIO(dump), chunk_size, object_hook=dict)
+        assert list(plans) == [d["Plan"] for d in documents]
+
+    with pytest.raises(ValueError):
+        list(iter_plans(io.StringIO(TEST_DUMP[: len(TEST_DUMP) // 2])))
+
+
+def test_convert_stream():
+    db = IndexCatalog({"public": {}})
+    dump = json.dumps(
+        [
+            {"Plan": deep_plan(2)},
+            {"Plan": {"Node Type": "Seq Scan", "Relation Name": "t"}},
+        ]
+    )
+    out = io.StringIO()
+
+    # plans that fail to convert should not stop conversion of other plans
+    assert convert_stream(io.StringIO(dump), out, db, chunk_size=16) == (1, 1)
+    sql = generate(preprocess_plan(deep_plan(2), db))
+    assert out.getvalue().startswith(f"-- plan 0\n{sql}\n-- plan 1: failed: ")
@@ -0,0 +1,50 @@
+#
+# SC3020
+# Project 2
+# Conversion Timing Unit Tests
+#
+
+import time
+
+import timing
+from benchmark import deep_plan
+from pipesyntax import generate
+from preprocessing import IndexCatalog, preprocess_plan
+
+
+def test_span():
+    # spans should be no-ops when not recording
+    with timing.span("outer"):
+        assert timing.current() is None
+
+    with timing.record() as timings:
+        with timing.span("outer"):
+            with timing.span("inner"):
+                time.sleep(0.02)
+            with timing.span("inner"):
+                pass
+    assert timing.current() is None
+
+    calls, total, self_seconds = timings.stages["inner"]
+    assert calls == 2 and total >= 0.02 and self_seconds == total
+    calls, total, self_seconds = timings.stages["outer"]
+    # self time of outer span should exclude time spent in inner spans
+    assert calls == 1 and total >= 0.02 and self_seconds < 0.02
+    assert abs(timings.total() - total) < 1e-9
+    assert [stage[0] for stage in timings.breakdown()] == ["inner", "outer"]
+
+
+def test_record_conversion():
+    sql = generate(preprocess_plan(deep_plan(3), IndexCatalog({"public": {}})))
+    with timing.record() as timings:
+        subplans = []
+        plan = preprocess_plan(deep_plan(3), IndexCatalog({"public": {}}), subplans)
+        # timings should not change generated sql
+        assert generate(plan, subplans) == sql
+
+    assert timings.stages["transform.DialectTransformer.prepare"][0] == 1
+    assert timings.stages["transform.JoinKeyTransformer"][0] == 3
+    assert timings.stages["transform.pushup_alias"][0] == 7
+    assert timings.stages["pipesyntax.gen_join"][0] == 3
+    assert timings.stages["pipesyntax.gen_scan"][0] == 4
+    assert "transform.traversal" in timings.report()
@@ -0,0 +1,138 @@
+#
+# SC3020
+# Project 2
+# Conversion Timing
+#
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Callable, Iterator, Optional, TypeVar
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class Timings:
+    """Per stage timings of a conversion, collected from spans timed while recording.
+
+    Spans may nest: each stage is credited with its total time & its self time,
+    which excludes time spent in nested spans, so self times sum to the time spent
+    in all spans.
+    """
+
+    def __init__(self):
+        # [calls, total seconds, self seconds] by stage name
+        self.stages: dict[str, list] = {}
+        # seconds spent in nested spans of each span currently being timed
+        self.nested: list[float] = []
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Time the enclosed code as a span of the given stage."""
+        self.nested.append(0.0)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            nested = self.nested.pop()
+            if len(self.nested) > 0:
+                self.nested[-1] += elapsed
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += 1
+            stage[1] += elapsed
+            stage[2] += elapsed - nested
+
+    def total(self) -> float:
+        """Seconds spent in all spans."""
+        return sum(stage[2] for stage in self.stages.values())
+
+    def breakdown(self) -> list[tuple[str, int, float, float]]:
+        """Get the timings of each stage, slowest self time first.
+
+        Returns:
+            list[tuple[str, int, float, float]]: For each stage: name, no. of calls,
+                total seconds & self seconds excluding nested spans.
+        """
+        return sorted(
+            ((name, *stage) for name, stage in self.stages.items()),
+            key=lambda stage: stage[3],
+            reverse=True,
+        )
+
+    def summary(self, limit: int = 3) -> str:
+        """One line summary of total time & the given no. of slowest stages."""
+        slowest = ", ".join(
+            f"{name} {self_seconds * 1000:.1f}ms"
+            for name, _, _, self_seconds in self.breakdown()[:limit]
+        )
+        return f"{self.total() * 1000:.1f}ms ({slowest})"
+
+    def report(self) -> str:
+        """Human readable table of the timings of each stage."""
+        lines = [f"{'stage':<40} {'calls':>6} {'self (ms)':>10} {'total (ms)':>11}"]
+        for name, calls, total, self_seconds in self.breakdown():
+            lines.append(
+                f"{name:<40} {calls:>6} {self_seconds * 1000:>10.2f}"
+                f" {total * 1000:>11.2f}"
+            )
+        lines.append(f"{'total':<40} {'':>6} {self.total() * 1000:>10.2f}")
+        return "\n".join(lines)
+
+
+# timings being recorded in the current context, None if not recording
+_TIMINGS: ContextVar[Optional[Timings]] = ContextVar("timings", default=None)
+
+
+def current() -> Optional[Timings]:
+    """Timings being recorded in the current context, None if not recording."""
+    return _TIMINGS.get()
+
+
+@contextmanager
+def record() -> Iterator[Timings]:
+    """Record timings of the spans timed in the enclosed code.
+
+    Timing is disabled outside of record(), where spans cost a single lookup.
+
+    Example:
+        with timing.record() as timings:
+            sql = generate(preprocess(query, db))
+        print(timings.report())
+    """
+    timings = Timings()
+    token = _TIMINGS.set(timings)
+    try:
+        yield timings
+    finally:
+        _TIMINGS.reset(token)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Time the enclosed code as a span of the given stage if recording timings."""
+    timings = _TIMINGS.get()
+    if timings is None:
+        yield
+        return
+    with timings.span(name):
+        yield
+
+
+def timed(name: str) -> Callable[[F], F]:
+    """Decorator timing each call of the decorated fn as a span of the given stage
+    if recording timings."""
+
+    def decorate(fn: F) -> F:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            timings = _TIMINGS.get()
+            if timings is None:
+                return fn(*args, **kwargs)
+            with timings.span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper  # type: ignore
+
+    return decorate